@@ -35,7 +35,6 @@ from gateway.observer import Observer
 from ioc import INJECTED, Inject, Injectable, Singleton
 from platform_utils import Platform
 from power import power_api
-from serial_utils import CommunicationTimedOutException
 
 if False:  # MYPY:
     from typing import Any, Dict, List
@@ -43,13 +42,6 @@ if False:  # MYPY:
 logger = logging.getLogger('openmotics')
 
 
-def convert_nan(number):
-    """ Convert nan to 0. """
-    if math.isnan(number):
-        logger.warning('Got an unexpected NaN')
-    return 0.0 if math.isnan(number) else number
-
-
 def check_basic_action(ret_dict):
     """ Checks if the response is 'OK', throws a ValueError otherwise. """
     if ret_dict['resp'] != 'OK':
@@ -65,7 +57,8 @@ class GatewayApi(object):
     def __init__(self,
                  master_controller=INJECTED, power_communicator=INJECTED,
                  power_controller=INJECTED, pulse_controller=INJECTED,
-                 message_client=INJECTED, observer=INJECTED, configuration_controller=INJECTED, shutter_controller=INJECTED):
+                 message_client=INJECTED, observer=INJECTED, configuration_controller=INJECTED, shutter_controller=INJECTED,
+                 power_snapshot_cache=INJECTED, power_analytics=INJECTED):
         """
         :param master_communicator: Master communicator
         :type master_communicator: master.master_communicator.MasterCommunicator
@@ -87,6 +80,10 @@ class GatewayApi(object):
         :type configuration_controller: gateway.config.ConfigurationController
         :param shutter_controller: Shutter Controller
         :type shutter_controller: gateway.shutters.ShutterController
+        :param power_snapshot_cache: Power snapshot cache
+        :type power_snapshot_cache: power.power_snapshots.PowerSnapshotCache
+        :param power_analytics: Power analytics
+        :type power_analytics: power.power_analytics.PowerAnalytics
         """
         self.__master_controller = master_controller  # type: MasterController
         self.__config_controller = configuration_controller
@@ -96,6 +93,8 @@ class GatewayApi(object):
         self.__message_client = message_client
         self.__observer = observer
         self.__shutter_controller = shutter_controller
+        self.__power_snapshot_cache = power_snapshot_cache
+        self.__power_analytics = power_analytics
 
         self.__previous_on_outputs = set()
 
@@ -1234,6 +1233,7 @@ class GatewayApi(object):
 
         for mod in modules:
             self.__power_controller.update_power_module(mod)
+            self.__power_snapshot_cache.invalidate(mod['id'])
 
             version = self.__power_controller.get_version(mod['id'])
             addr = self.__power_controller.get_address(mod['id'])
@@ -1278,121 +1278,39 @@ class GatewayApi(object):
 
         return dict()
 
-    def get_realtime_power(self):
+    def get_realtime_power(self, force_fresh=False, module_ids=None):
         """ Get the realtime power measurement values.
 
+        :param force_fresh: Read the values from the modules, instead of using recent values.
+        :param module_ids: Only get the values of these modules, defaults to all modules.
         :returns: dict with the module id as key and the following array as value: \
         [voltage, frequency, current, power].
         """
-        output = {}
-        if self.__power_communicator is None or self.__power_controller is None:
-            return output
-
-        modules = self.__power_controller.get_power_modules()
-        for module_id in sorted(modules.keys()):
-            try:
-                addr = modules[module_id]['address']
-                version = modules[module_id]['version']
-                num_ports = power_api.NUM_PORTS[version]
-
-                volt = [0.0] * num_ports  # TODO: Initialse to None is supported upstream
-                freq = [0.0] * num_ports
-                current = [0.0] * num_ports
-                power = [0.0] * num_ports
-                if version in [power_api.POWER_MODULE, power_api.ENERGY_MODULE]:
-                    if version == power_api.POWER_MODULE:
-                        raw_volt = self.__power_communicator.do_command(addr, power_api.get_voltage(version))
-                        raw_freq = self.__power_communicator.do_command(addr, power_api.get_frequency(version))
-
-                        volt = [raw_volt[0]] * num_ports
-                        freq = [raw_freq[0]] * num_ports
-                    else:
-                        volt = self.__power_communicator.do_command(addr, power_api.get_voltage(version))
-                        freq = self.__power_communicator.do_command(addr, power_api.get_frequency(version))
-
-                    current = self.__power_communicator.do_command(addr, power_api.get_current(version))
-                    power = self.__power_communicator.do_command(addr, power_api.get_power(version))
-                elif version == power_api.P1_CONCENTRATOR:
-                    status = self.__power_communicator.do_command(addr, power_api.get_status_p1(version))[0]
-                    raw_volt = self.__power_communicator.do_command(addr, power_api.get_voltage(version, phase=1))[0]  # TODO: Average?
-                    raw_current_ph1 = self.__power_communicator.do_command(addr, power_api.get_current(version, phase=1))[0]
-                    raw_current_ph2 = self.__power_communicator.do_command(addr, power_api.get_current(version, phase=2))[0]
-                    raw_current_ph3 = self.__power_communicator.do_command(addr, power_api.get_current(version, phase=3))[0]
-                    delivered_power = self.__power_communicator.do_command(addr, power_api.get_delivered_power(version))[0]
-                    received_power = self.__power_communicator.do_command(addr, power_api.get_received_power(version))[0]
-                    for port in xrange(num_ports):
-                        try:
-                            if status & 1 << port:
-                                volt[port] = float(raw_volt[port * 7:(port + 1) * 7][:5])
-                                current[port] = (float(raw_current_ph1[port * 5:(port + 1) * 6][:3]) +
-                                                 float(raw_current_ph2[port * 5:(port + 1) * 6][:3]) +
-                                                 float(raw_current_ph3[port * 5:(port + 1) * 6][:3]))
-                                power[port] = (float(delivered_power[port * 9:(port + 1) * 9][:6]) -
-                                               float(received_power[port * 9:(port + 1) * 9][:6])) * 1000
-                        except ValueError:
-                            pass
-                else:
-                    raise ValueError('Unknown power api version')
-
-                out = []
-                for i in range(num_ports):
-                    out.append([convert_nan(volt[i]), convert_nan(freq[i]),
-                                convert_nan(current[i]), convert_nan(power[i])])
-
-                output[str(module_id)] = out
-            except CommunicationTimedOutException:
-                logger.error('Communication timeout while fetching realtime power from {0}: CommunicationTimedOutException'.format(module_id))
-            except Exception as ex:
-                logger.exception('Got exception while fetching realtime power from {0}: {1}'.format(module_id, ex))
-
-        return output
-
-    def get_total_energy(self):
+        return self.__power_snapshot_cache.get_realtime_power(force_fresh=force_fresh, module_ids=module_ids)
+
+    def get_total_energy(self, force_fresh=False, module_ids=None):
         """ Get the total energy (kWh) consumed by the power modules.
 
+        :param force_fresh: Read the values from the modules, instead of using recent values.
+        :param module_ids: Only get the values of these modules, defaults to all modules.
         :returns: dict with the module id as key and the following array as value: [day, night].
         """
-        output = {}
+        return self.__power_snapshot_cache.get_total_energy(force_fresh=force_fresh, module_ids=module_ids)
+
+    def get_power_bus_statistics(self):
+        """ Get the latency, failure and utilization statistics of the power bus.
+
+        :returns: dict with the statistics per module address (eg. E1) in 'modules', per command \
+        (eg. GVOL) in 'commands' and the bus utilization (percentage) per window in 'utilization'.
+        """
         if self.__power_communicator is None or self.__power_controller is None:
-            return output
-
-        modules = self.__power_controller.get_power_modules()
-        for module_id in sorted(modules.keys()):
-            try:
-                addr = modules[module_id]['address']
-                version = modules[module_id]['version']
-                num_ports = power_api.NUM_PORTS[version]
-
-                day = [0] * num_ports  # TODO: Initialse to None is supported upstream
-                night = [0] * num_ports
-                if version in [power_api.ENERGY_MODULE, power_api.POWER_MODULE]:
-                    day = self.__power_communicator.do_command(addr, power_api.get_day_energy(version))
-                    night = self.__power_communicator.do_command(addr, power_api.get_night_energy(version))
-                elif version == power_api.P1_CONCENTRATOR:
-                    status = self.__power_communicator.do_command(addr, power_api.get_status_p1(version))[0]
-                    raw_day = self.__power_communicator.do_command(addr, power_api.get_day_energy(version))[0]
-                    raw_night = self.__power_communicator.do_command(addr, power_api.get_night_energy(version))[0]
-                    for port in xrange(num_ports):
-                        try:
-                            if status & 1 << port:
-                                day[port] = int(float(raw_day[port * 14:(port + 1) * 14][:10]) * 1000)
-                                night[port] = int(float(raw_night[port * 14:(port + 1) * 14][:10]) * 1000)
-                        except ValueError:
-                            pass
-                else:
-                    raise ValueError('Unknown power api version')
-
-                out = []
-                for i in range(num_ports):
-                    out.append([convert_nan(day[i]), convert_nan(night[i])])
-
-                output[str(module_id)] = out
-            except CommunicationTimedOutException:
-                logger.error('Communication timeout while fetching total energy from {0}: CommunicationTimedOutException'.format(module_id))
-            except Exception as ex:
-                logger.exception('Got exception while fetching total energy from {0}: {1}'.format(module_id, ex))
-
-        return output
+            return {}
+
+        statistics = self.__power_communicator.get_statistics()
+        versions = dict((module.address, module.version) for module in self.__power_controller.get_modules().values())
+        statistics['modules'] = dict(('{0}{1}'.format('C' if versions.get(address) == power_api.P1_CONCENTRATOR else 'E', address), summary)
+                                     for address, summary in statistics['modules'].iteritems())
+        return statistics
 
     def start_power_address_mode(self):
         """ Start the address mode on the power modules.
@@ -1447,31 +1365,11 @@ class GatewayApi(object):
         if self.__power_communicator is None or self.__power_controller is None:
             return {}
 
-        addr = self.__power_controller.get_address(module_id)
-        version = self.__power_controller.get_version(module_id)
-        if version != power_api.ENERGY_MODULE:
-            raise ValueError('Unknown power api version')
-        if input_id is None:
-            input_ids = range(12)
-        else:
-            input_id = int(input_id)
-            if input_id < 0 or input_id > 11:
-                raise ValueError('Invalid input_id (should be 0-11)')
-            input_ids = [input_id]
         data = {}
-        for input_id in input_ids:
-            voltage = list(self.__power_communicator.do_command(addr, power_api.get_voltage_sample_time(version), input_id, 0))
-            current = list(self.__power_communicator.do_command(addr, power_api.get_current_sample_time(version), input_id, 0))
-            for entry in self.__power_communicator.do_command(addr, power_api.get_voltage_sample_time(version), input_id, 1):
-                if entry == float('inf'):
-                    break
-                voltage.append(entry)
-            for entry in self.__power_communicator.do_command(addr, power_api.get_current_sample_time(version), input_id, 1):
-                if entry == float('inf'):
-                    break
-                current.append(entry)
-            data[str(input_id)] = {'voltage': voltage,
-                                   'current': current}
+        for input_id in GatewayApi.__get_energy_input_ids(input_id):
+            samples = self.__power_analytics.read_time_samples(module_id, input_id)
+            data[str(input_id)] = {'voltage': samples['voltage'].tolist(),
+                                   'current': samples['current'].tolist()}
         return data
 
     def get_energy_frequency(self, module_id, input_id=None):
@@ -1482,27 +1380,34 @@ class GatewayApi(object):
         if self.__power_communicator is None or self.__power_controller is None:
             return {}
 
-        addr = self.__power_controller.get_address(module_id)
-        version = self.__power_controller.get_version(module_id)
-        if version != power_api.ENERGY_MODULE:
-            raise ValueError('Unknown power api version')
-        if input_id is None:
-            input_ids = range(12)
-        else:
-            input_id = int(input_id)
-            if input_id < 0 or input_id > 11:
-                raise ValueError('Invalid input_id (should be 0-11)')
-            input_ids = [input_id]
         data = {}
-        for input_id in input_ids:
-            voltage = self.__power_communicator.do_command(addr, power_api.get_voltage_sample_frequency(version), input_id, 20)
-            current = self.__power_communicator.do_command(addr, power_api.get_current_sample_frequency(version), input_id, 20)
+        for input_id in GatewayApi.__get_energy_input_ids(input_id):
+            samples = self.__power_analytics.read_frequency_samples(module_id, input_id)
             # The received data has a length of 40; 20 harmonics entries, and 20 phase entries. For easier usage, the
             # API calls splits them into two parts so the customers doesn't have to do the splitting.
-            data[str(input_id)] = {'voltage': [voltage[:20], voltage[20:]],
-                                   'current': [current[:20], current[20:]]}
+            data[str(input_id)] = {'voltage': [samples['voltage'][0].tolist(), samples['voltage'][1].tolist()],
+                                   'current': [samples['current'][0].tolist(), samples['current'][1].tolist()]}
         return data
 
+    def get_energy_summary(self, module_id, input_id):
+        """ Get the RMS, peak and THD of the voltage and current of an input
+
+        :returns: dict with 'voltage_rms', 'voltage_peak', 'voltage_thd', 'current_rms', 'current_peak' and 'current_thd'
+        """
+        if self.__power_communicator is None or self.__power_controller is None:
+            return {}
+
+        return self.__power_analytics.get_summary(module_id, GatewayApi.__get_energy_input_ids(input_id)[0])
+
+    @staticmethod
+    def __get_energy_input_ids(input_id):
+        if input_id is None:
+            return range(12)
+        input_id = int(input_id)
+        if input_id < 0 or input_id > 11:
+            raise ValueError('Invalid input_id (should be 0-11)')
+        return [input_id]
+
     def do_raw_energy_command(self, address, mode, command, data):
         """ Perform a raw energy module command, for debugging purposes.
 
@@ -27,6 +27,8 @@ from serial_utils import CommunicationTimedOutException
 from gateway.observer import Event as ObserverEvent
 from gateway.maintenance_communicator import InMaintenanceModeException
 from power import power_api
+from power.power_polling import PowerPollScheduler
+from power.power_statistics import PowerBusStatistics
 
 logger = logging.getLogger("openmotics")
 
@@ -39,7 +41,8 @@ class MetricsCollector(object):
     """
 
     @Inject
-    def __init__(self, gateway_api=INJECTED, pulse_controller=INJECTED, thermostat_controller=INJECTED):
+    def __init__(self, gateway_api=INJECTED, pulse_controller=INJECTED, thermostat_controller=INJECTED,
+                 api_statistics=INJECTED):
         """
         :param gateway_api: Gateway API
         :type gateway_api: gateway.gateway_api.GatewayApi
@@ -47,6 +50,8 @@ class MetricsCollector(object):
         :type pulse_controller: gateway.pulses.PulseCounterController
         :param thermostat_controller: Thermostat Controller
         :type thermostat_controller: gateway.thermostat.thermostat_controller.ThermostatController
+        :param api_statistics: API call statistics
+        :type api_statistics: gateway.webservice.ApiStatistics
         """
         self._start = time.time()
         self._last_service_uptime = 0
@@ -64,7 +69,11 @@ class MetricsCollector(object):
                                'error': 120,
                                'counter': 30,
                                'energy': 5,
-                               'energy_analytics': 300}
+                               'energy_analytics': 300,
+                               'energy_summary': 300,
+                               'api': 60,
+                               'power_bus': 60,
+                               'plugin': 60}
         self.intervals = {metric_type: 900 for metric_type in self._min_intervals}
         self._plugin_intervals = {metric_type: [] for metric_type in self._min_intervals}
         self._websocket_intervals = {metric_type: {} for metric_type in self._min_intervals}
@@ -75,8 +84,10 @@ class MetricsCollector(object):
 
         self._gateway_api = gateway_api
         self._thermostat_controller = thermostat_controller
+        self._api_statistics = api_statistics
         self._pulse_controller = pulse_controller
         self._metrics_queue = deque()
+        self._power_poll_scheduler = PowerPollScheduler()
 
     def start(self):
         self._start = time.time()
@@ -90,6 +101,10 @@ class MetricsCollector(object):
         MetricsCollector._start_thread(self._run_pulsecounters, 'counter')
         MetricsCollector._start_thread(self._run_power_openmotics, 'energy')
         MetricsCollector._start_thread(self._run_power_openmotics_analytics, 'energy_analytics')
+        MetricsCollector._start_thread(self._run_energy_summary, 'energy_summary')
+        MetricsCollector._start_thread(self._run_api, 'api')
+        MetricsCollector._start_thread(self._run_power_bus, 'power_bus')
+        MetricsCollector._start_thread(self._run_plugins, 'plugin')
         thread = Thread(target=self._sleep_manager)
         thread.setName('Metric collector - Sleep manager')
         thread.daemon = True
@@ -142,6 +157,10 @@ class MetricsCollector(object):
                     self._plugin_intervals[metric_type].append(interval_info['interval'])
                     self._update_intervals(metric_type)
 
+    def get_power_poll_rates(self):
+        """ Returns the effective poll rate per power module """
+        return dict((str(module_id), rate) for module_id, rate in self._power_poll_scheduler.get_poll_rates().iteritems())
+
     def _update_intervals(self, metric_type):
         min_interval = self._min_intervals[metric_type]
         interval = max(min_interval, self._cloud_intervals[metric_type])
@@ -395,6 +414,72 @@ class MetricsCollector(object):
                 return
             self._pause(start, metric_type)
 
+    def _run_api(self, metric_type):
+        while not self._stopped:
+            start = time.time()
+            try:
+                for name, summary in self._api_statistics.get_summaries().iteritems():
+                    values = {}
+                    for key, value in summary.iteritems():
+                        if value is not None:
+                            values[key] = int(value) if key in ['requests', 'errors'] else float(value)
+                    self._enqueue_metrics(metric_type=metric_type,
+                                          values=values,
+                                          tags={'name': name},
+                                          timestamp=start)
+            except Exception as ex:
+                logger.exception('Error loading api metrics: {0}'.format(ex))
+            if self._stopped:
+                return
+            self._pause(start, metric_type)
+
+    def _run_power_bus(self, metric_type):
+        while not self._stopped:
+            start = time.time()
+            try:
+                statistics = self._gateway_api.get_power_bus_statistics()
+                for section in ['modules', 'commands']:
+                    for name, summary in statistics.get(section, {}).iteritems():
+                        values = dict((key, int(value) if key in PowerBusStatistics.COUNTERS else float(value))
+                                      for key, value in summary.iteritems() if value is not None)
+                        self._enqueue_metrics(metric_type=metric_type,
+                                              values=values,
+                                              tags={'section': section, 'name': name},
+                                              timestamp=start)
+                if 'utilization' in statistics:
+                    self._enqueue_metrics(metric_type=metric_type,
+                                          values=dict(('utilization_{0}s'.format(window), float(utilization))
+                                                      for window, utilization in statistics['utilization'].iteritems()),
+                                          tags={'section': 'bus', 'name': 'power'},
+                                          timestamp=start)
+            except Exception as ex:
+                logger.exception('Error loading power bus metrics: {0}'.format(ex))
+            if self._stopped:
+                return
+            self._pause(start, metric_type)
+
+    def _run_plugins(self, metric_type):
+        while not self._stopped:
+            start = time.time()
+            try:
+                if self._plugin_controller is not None:
+                    for name, usage in self._plugin_controller.get_resource_usage().iteritems():
+                        values = {'throttled': {None: 0, 'slow': 1, 'pause': 2}[usage['throttle']]}
+                        for key, value in usage.iteritems():
+                            if key == 'throttle' or value is None:
+                                continue
+                            values[key] = float(value) if key in ['cpu_time', 'cpu_percent', 'command_avg',
+                                                                  'command_p95', 'command_max'] else int(value)
+                        self._enqueue_metrics(metric_type=metric_type,
+                                              values=values,
+                                              tags={'name': name},
+                                              timestamp=start)
+            except Exception as ex:
+                logger.exception('Error loading plugin metrics: {0}'.format(ex))
+            if self._stopped:
+                return
+            self._pause(start, metric_type)
+
     def _run_outputs(self, metric_type):
         while not self._stopped:
             start = time.time()
@@ -582,39 +667,30 @@ class MetricsCollector(object):
                 logger.info('Error getting power modules: InMaintenanceModeException')
             except Exception as ex:
                 logger.exception('Error getting power modules: {0}'.format(ex))
-            try:
-                result = self._gateway_api.get_realtime_power()
-                for module_id, device_id in mapping.iteritems():
-                    if module_id in result:
-                        for index, entry in enumerate(result[module_id]):
-                            if device_id.format(index) in power_data:
-                                usage = power_data[device_id.format(index)]
-                                usage.update({'voltage': entry[0],
-                                              'frequency': entry[1],
-                                              'current': entry[2],
-                                              'power': entry[3]})
-            except CommunicationTimedOutException:
-                logger.error('Error getting realtime power: CommunicationTimedOutException')
-            except InMaintenanceModeException:
-                logger.info('Error getting realtime power: InMaintenanceModeException')
-            except Exception as ex:
-                logger.exception('Error getting realtime power: {0}'.format(ex))
-            try:
-                result = self._gateway_api.get_total_energy()
-                for module_id, device_id in mapping.iteritems():
-                    if module_id in result:
-                        for index, entry in enumerate(result[module_id]):
-                            if device_id.format(index) in power_data:
-                                usage = power_data[device_id.format(index)]
-                                usage.update({'counter': entry[0] + entry[1],
-                                              'counter_day': entry[0],
-                                              'counter_night': entry[1]})
-            except CommunicationTimedOutException:
-                logger.error('Error getting total energy: CommunicationTimedOutException')
-            except InMaintenanceModeException:
-                logger.info('Error getting total energy: InMaintenanceModeException')
-            except Exception as ex:
-                logger.exception('Error getting total energy: {0}'.format(ex))
+            # Only the modules that are due are read, and only those are reported
+            interval = self.intervals[metric_type]
+            power_values = {}  # module id -> (realtime power, total energy)
+            for module_id in self._power_poll_scheduler.get_due_modules([int(module_id) for module_id in mapping], interval, now=start):
+                values = self._read_power_module(module_id, interval)
+                if values is not None:
+                    power_values[str(module_id)] = values
+            for module_id, device_id in mapping.iteritems():
+                if module_id not in power_values:
+                    continue
+                realtime_power, total_energy = power_values[module_id]
+                for index, entry in enumerate(realtime_power):
+                    if device_id.format(index) in power_data:
+                        usage = power_data[device_id.format(index)]
+                        usage.update({'voltage': entry[0],
+                                      'frequency': entry[1],
+                                      'current': entry[2],
+                                      'power': entry[3]})
+                for index, entry in enumerate(total_energy):
+                    if device_id.format(index) in power_data:
+                        usage = power_data[device_id.format(index)]
+                        usage.update({'counter': entry[0] + entry[1],
+                                      'counter_day': entry[0],
+                                      'counter_night': entry[1]})
             for device_id in power_data:
                 device = power_data[device_id]
                 try:
@@ -637,6 +713,31 @@ class MetricsCollector(object):
                 return
             self._pause(start, metric_type)
 
+    def _read_power_module(self, module_id, interval):
+        start = time.time()
+        realtime_power = None
+        total_energy = None
+        try:
+            realtime_power = self._gateway_api.get_realtime_power(module_ids=[module_id]).get(str(module_id))
+        except CommunicationTimedOutException:
+            logger.error('Error getting realtime power: CommunicationTimedOutException')
+        except InMaintenanceModeException:
+            logger.info('Error getting realtime power: InMaintenanceModeException')
+        except Exception as ex:
+            logger.exception('Error getting realtime power: {0}'.format(ex))
+        try:
+            total_energy = self._gateway_api.get_total_energy(module_ids=[module_id]).get(str(module_id))
+        except CommunicationTimedOutException:
+            logger.error('Error getting total energy: CommunicationTimedOutException')
+        except InMaintenanceModeException:
+            logger.info('Error getting total energy: InMaintenanceModeException')
+        except Exception as ex:
+            logger.exception('Error getting total energy: {0}'.format(ex))
+        if realtime_power is None or total_energy is None:
+            return None  # The module stays due, so it is read again on the next run
+        self._power_poll_scheduler.update(module_id, [entry[3] for entry in realtime_power], time.time() - start, interval)
+        return realtime_power, total_energy
+
     def _run_power_openmotics_analytics(self, metric_type):
         while not self._stopped:
             start = time.time()
@@ -697,6 +798,36 @@ class MetricsCollector(object):
                 return
             self._pause(start, metric_type)
 
+    def _run_energy_summary(self, metric_type):
+        while not self._stopped:
+            start = time.time()
+            try:
+                now = time.time()
+                result = self._gateway_api.get_power_modules()
+                for power_module in result:
+                    device_id = '{0}.{{0}}'.format(power_module['address'])
+                    if power_module['version'] != power_api.ENERGY_MODULE:
+                        continue
+                    # Only a summary per input is shipped, the samples are available through the API
+                    for i in xrange(power_api.NUM_PORTS[power_api.ENERGY_MODULE]):
+                        name = power_module['input{0}'.format(i)]
+                        if name == '':
+                            continue
+                        self._enqueue_metrics(metric_type=metric_type,
+                                              values=self._gateway_api.get_energy_summary(power_module['id'], i),
+                                              tags={'id': device_id.format(i),
+                                                    'name': name},
+                                              timestamp=now)
+            except CommunicationTimedOutException:
+                logger.error('Error getting energy summaries: CommunicationTimedOutException')
+            except InMaintenanceModeException:
+                logger.info('Error getting energy summaries: InMaintenanceModeException')
+            except Exception as ex:
+                logger.exception('Error getting energy summaries: {0}'.format(ex))
+            if self._stopped:
+                return
+            self._pause(start, metric_type)
+
     def _load_environment_configurations(self, name, interval):
         while not self._stopped:
             start = time.time()
@@ -1099,5 +1230,193 @@ class MetricsCollector(object):
                          {'name': 'voltage_phase',
                           'description': 'Voltage phase',
                           'type': 'gauge',
+                          'unit': ''}]},
+            # energy_summary
+            {'type': 'energy_summary',
+             'tags': ['id', 'name'],
+             'metrics': [{'name': 'voltage_rms',
+                          'description': 'RMS voltage',
+                          'type': 'gauge',
+                          'unit': 'V'},
+                         {'name': 'voltage_peak',
+                          'description': 'Peak voltage',
+                          'type': 'gauge',
+                          'unit': 'V'},
+                         {'name': 'voltage_thd',
+                          'description': 'Total harmonic distortion of the voltage',
+                          'type': 'gauge',
+                          'unit': ''},
+                         {'name': 'current_rms',
+                          'description': 'RMS current',
+                          'type': 'gauge',
+                          'unit': 'A'},
+                         {'name': 'current_peak',
+                          'description': 'Peak current',
+                          'type': 'gauge',
+                          'unit': 'A'},
+                         {'name': 'current_thd',
+                          'description': 'Total harmonic distortion of the current',
+                          'type': 'gauge',
+                          'unit': ''}]},
+            # api
+            {'type': 'api',
+             'tags': ['name'],
+             'metrics': [{'name': 'requests',
+                          'description': 'Amount of calls',
+                          'type': 'counter',
+                          'unit': ''},
+                         {'name': 'errors',
+                          'description': 'Amount of failed calls',
+                          'type': 'counter',
+                          'unit': ''},
+                         {'name': 'total_avg',
+                          'description': 'Total call duration (average)',
+                          'type': 'gauge',
+                          'unit': 'ms'},
+                         {'name': 'total_p50',
+                          'description': 'Total call duration (50th percentile)',
+                          'type': 'gauge',
+                          'unit': 'ms'},
+                         {'name': 'total_p95',
+                          'description': 'Total call duration (95th percentile)',
+                          'type': 'gauge',
+                          'unit': 'ms'},
+                         {'name': 'total_p99',
+                          'description': 'Total call duration (99th percentile)',
+                          'type': 'gauge',
+                          'unit': 'ms'},
+                         {'name': 'total_max',
+                          'description': 'Total call duration (maximum)',
+                          'type': 'gauge',
+                          'unit': 'ms'},
+                         {'name': 'handler_avg',
+                          'description': 'Handler duration (average)',
+                          'type': 'gauge',
+                          'unit': 'ms'},
+                         {'name': 'handler_p50',
+                          'description': 'Handler duration (50th percentile)',
+                          'type': 'gauge',
+                          'unit': 'ms'},
+                         {'name': 'handler_p95',
+                          'description': 'Handler duration (95th percentile)',
+                          'type': 'gauge',
+                          'unit': 'ms'},
+                         {'name': 'handler_p99',
+                          'description': 'Handler duration (99th percentile)',
+                          'type': 'gauge',
+                          'unit': 'ms'},
+                         {'name': 'handler_max',
+                          'description': 'Handler duration (maximum)',
+                          'type': 'gauge',
+                          'unit': 'ms'},
+                         {'name': 'serialization_avg',
+                          'description': 'Serialization duration (average)',
+                          'type': 'gauge',
+                          'unit': 'ms'},
+                         {'name': 'serialization_p50',
+                          'description': 'Serialization duration (50th percentile)',
+                          'type': 'gauge',
+                          'unit': 'ms'},
+                         {'name': 'serialization_p95',
+                          'description': 'Serialization duration (95th percentile)',
+                          'type': 'gauge',
+                          'unit': 'ms'},
+                         {'name': 'serialization_p99',
+                          'description': 'Serialization duration (99th percentile)',
+                          'type': 'gauge',
+                          'unit': 'ms'},
+                         {'name': 'serialization_max',
+                          'description': 'Serialization duration (maximum)',
+                          'type': 'gauge',
+                          'unit': 'ms'}]},
+            # power_bus
+            {'type': 'power_bus',
+             'tags': ['section', 'name'],
+             'metrics': [{'name': 'commands',
+                          'description': 'Amount of answered commands',
+                          'type': 'counter',
+                          'unit': ''},
+                         {'name': 'retries',
+                          'description': 'Amount of resent commands',
+                          'type': 'counter',
+                          'unit': ''},
+                         {'name': 'timeouts',
+                          'description': 'Amount of commands without answer',
+                          'type': 'counter',
+                          'unit': ''},
+                         {'name': 'crc_errors',
+                          'description': 'Amount of answers with a CRC mismatch',
+                          'type': 'counter',
+                          'unit': ''},
+                         {'name': 'latency_avg',
+                          'description': 'Command latency (average)',
+                          'type': 'gauge',
+                          'unit': 'ms'},
+                         {'name': 'latency_p50',
+                          'description': 'Command latency (50th percentile)',
+                          'type': 'gauge',
+                          'unit': 'ms'},
+                         {'name': 'latency_p95',
+                          'description': 'Command latency (95th percentile)',
+                          'type': 'gauge',
+                          'unit': 'ms'},
+                         {'name': 'latency_max',
+                          'description': 'Command latency (maximum)',
+                          'type': 'gauge',
+                          'unit': 'ms'}] +
+                        [{'name': 'utilization_{0}s'.format(window),
+                          'description': 'Bus utilization (last {0} seconds)'.format(window),
+                          'type': 'gauge',
+                          'unit': 'percent'} for window in PowerBusStatistics.WINDOWS]},
+            # plugin
+            {'type': 'plugin',
+             'tags': ['name'],
+             'metrics': [{'name': 'cpu_time',
+                          'description': 'CPU time used by the plugin runtime',
+                          'type': 'counter',
+                          'unit': 'seconds'},
+                         {'name': 'cpu_percent',
+                          'description': 'CPU usage of the plugin runtime',
+                          'type': 'gauge',
+                          'unit': 'percent'},
+                         {'name': 'rss',
+                          'description': 'Resident memory of the plugin runtime',
+                          'type': 'gauge',
+                          'unit': 'bytes'},
+                         {'name': 'ipc_in',
+                          'description': 'Data received from the plugin runtime',
+                          'type': 'counter',
+                          'unit': 'bytes'},
+                         {'name': 'ipc_out',
+                          'description': 'Data sent to the plugin runtime',
+                          'type': 'counter',
+                          'unit': 'bytes'},
+                         {'name': 'commands',
+                          'description': 'Amount of commands',
+                          'type': 'counter',
+                          'unit': ''},
+                         {'name': 'command_avg',
+                          'description': 'Command duration (average)',
+                          'type': 'gauge',
+                          'unit': 'ms'},
+                         {'name': 'command_p95',
+                          'description': 'Command duration (95th percentile)',
+                          'type': 'gauge',
+                          'unit': 'ms'},
+                         {'name': 'command_max',
+                          'description': 'Command duration (maximum)',
+                          'type': 'gauge',
+                          'unit': 'ms'},
+                         {'name': 'queue_length',
+                          'description': 'Amount of queued events',
+                          'type': 'gauge',
+                          'unit': ''},
+                         {'name': 'queue_drops',
+                          'description': 'Amount of dropped events',
+                          'type': 'counter',
+                          'unit': ''},
+                         {'name': 'throttled',
+                          'description': 'Event delivery throttling (0: none, 1: slowed down, 2: paused)',
+                          'type': 'gauge',
                           'unit': ''}]}
         ]
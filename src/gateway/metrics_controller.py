@@ -36,6 +36,8 @@ class MetricsController(object):
     The Metrics Controller collects all metrics and pushses them to all subscribers
     """
 
+    PLUGIN_COLLECTION_TIMEOUT = 1.0
+
     @Inject
     def __init__(self, plugin_controller=INJECTED, metrics_collector=INJECTED, metrics_cache_controller=INJECTED, configuration_controller=INJECTED, gateway_uuid=INJECTED):
         """
@@ -448,7 +450,7 @@ class MetricsController(object):
         """
         while not self._stopped:
             start = time.time()
-            for metric in self._plugin_controller.collect_metrics():
+            for metric in self._plugin_controller.collect_metrics(timeout=MetricsController.PLUGIN_COLLECTION_TIMEOUT):
                 # Validation, part 1
                 source = metric['source']
                 log = self._plugin_controller.get_logger(source)
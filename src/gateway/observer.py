@@ -54,6 +54,7 @@ class Event(object):
         ACTION = 'ACTION'
         PING = 'PING'
         PONG = 'PONG'
+        POWER_ADDRESS_MODE = 'POWER_ADDRESS_MODE'
 
     def __init__(self, event_type, data):
         self.type = event_type
@@ -19,11 +19,16 @@ and authenticating users.
 
 import sqlite3
 import hashlib
+import heapq
+import logging
 import uuid
 import time
 from random import randint
+from threading import Lock, Timer
 from ioc import Injectable, Inject, Singleton, INJECTED
 
+logger = logging.getLogger('openmotics')
+
 
 @Injectable.named('user_controller')
 @Singleton
@@ -31,6 +36,8 @@ class UserController(object):
     """ The UserController provides methods for the creation and authentication of users. """
 
     TERMS_VERSION = 1
+    CREDENTIALS_CACHE_TIMEOUT = 60
+    TOKEN_PERSIST_DELAY = 5
 
     @Inject
     def __init__(self, user_db=INJECTED, user_db_lock=INJECTED, config=INJECTED, token_timeout=INJECTED):
@@ -51,13 +58,20 @@ class UserController(object):
                                            isolation_level=None)
         self._cursor = self._connection.cursor()
         self._token_timeout = token_timeout
-        self._tokens = {}
+        self._tokens = {}  # token hash -> (username, valid_until)
+        self._token_expiries = []  # Heap of (valid_until, token hash)
+        self._added_tokens = {}  # token hash -> (username, valid_until), not yet persisted
+        self._removed_tokens = set()  # token hashes, not yet removed from the database
+        self._token_timer = None
+        self._token_lock = Lock()
+        self._credentials_cache = {}  # (username, hashed password) -> (user_id, valid_until)
         self._schema = {'username': "TEXT UNIQUE",
                         'password': "TEXT",
                         'role': "TEXT",
                         'enabled': "INT",
                         'accepted_terms': "INT default 0"}
         self._check_tables()
+        self._load_tokens()
 
         # Create the user for the cloud
         self.create_user(self._config['username'].lower(), self._config['password'], "admin", True, True)
@@ -89,6 +103,17 @@ class UserController(object):
             for field, field_type in self._schema.iteritems():
                 if field not in fields:
                     self._execute("ALTER TABLE users ADD COLUMN {0} {1};".format(field, field_type), lock=False)
+            self._execute("CREATE TABLE IF NOT EXISTS tokens (token_hash TEXT PRIMARY KEY, username TEXT, valid_until REAL);", lock=False)
+
+    def _load_tokens(self):
+        """ Loads the tokens that are still valid, so clients don't need to login again after a restart """
+        self._execute("DELETE FROM tokens WHERE valid_until < ?;", (time.time(),))
+        with self._token_lock:
+            for row in self._execute("SELECT token_hash, username, valid_until FROM tokens;"):
+                token_hash, username, valid_until = str(row[0]), row[1], row[2]
+                self._tokens[token_hash] = (username, valid_until)
+                self._token_expiries.append((valid_until, token_hash))
+            heapq.heapify(self._token_expiries)
 
     @staticmethod
     def _hash(password):
@@ -98,6 +123,13 @@ class UserController(object):
         sha.update(password)
         return sha.hexdigest()
 
+    @staticmethod
+    def _hash_token(token):
+        """ Hash the token using sha256, only the hashes are kept. """
+        if isinstance(token, unicode):
+            token = token.encode('utf-8')
+        return hashlib.sha256(token).hexdigest()
+
     def create_user(self, username, password, role, enabled, accept_terms=False):
         """ Create a new user using a username, password, role and enabled. The username is case
         insensitive.
@@ -113,6 +145,7 @@ class UserController(object):
 
         self._execute("INSERT OR REPLACE INTO users (username, password, role, enabled, accepted_terms) VALUES (?, ?, ?, ?, ?);",
                       (username, UserController._hash(password), role, int(enabled), accepted_terms))
+        self._clear_credentials_cache(username)
 
     def get_usernames(self):
         """ Get all usernames.
@@ -135,14 +168,14 @@ class UserController(object):
             raise Exception("Cannot delete last admin account")
         else:
             self._execute("DELETE FROM users WHERE username = ?;", (username,))
+            self._clear_credentials_cache(username)
 
-            to_remove = []
-            for token in self._tokens:
-                if self._tokens[token][0] == username:
-                    to_remove.append(token)
-
-            for token in to_remove:
-                del self._tokens[token]
+            with self._token_lock:
+                for token_hash in [token_hash for token_hash, data in self._tokens.iteritems() if data[0] == username]:
+                    del self._tokens[token_hash]
+                    self._added_tokens.pop(token_hash, None)
+            # After the in-memory removal, so a running persist can't add them again afterwards
+            self._execute("DELETE FROM tokens WHERE username = ?;", (username,))
 
     def _get_num_admins(self):
         """ Get the number of admin users in the system. """
@@ -165,10 +198,16 @@ class UserController(object):
         if timeout is None:
             timeout = self._token_timeout
 
+        hashed_password = UserController._hash(password)
+        cached_credentials = self._credentials_cache.get((username, hashed_password))
+        if cached_credentials is not None and cached_credentials[1] >= time.time():
+            return True, self._gen_token(username, time.time() + timeout)
+
         for row in self._execute("SELECT id, accepted_terms FROM users WHERE username = ? AND password = ? AND enabled = ?;",
-                                 (username, UserController._hash(password), 1)):
+                                 (username, hashed_password, 1)):
             user_id, accepted_terms = row[0], row[1]
             if accepted_terms == UserController.TERMS_VERSION:
+                self._credentials_cache[(username, hashed_password)] = (user_id, time.time() + UserController.CREDENTIALS_CACHE_TIMEOUT)
                 return True, self._gen_token(username, time.time() + timeout)
             if accept_terms is True:
                 self._execute("UPDATE users SET accepted_terms = ? WHERE id = ?;",
@@ -179,7 +218,19 @@ class UserController(object):
 
     def logout(self, token):
         """ Removes the token from the controller. """
-        self._tokens.pop(token, None)
+        if not isinstance(token, basestring):
+            return
+        token_hash = UserController._hash_token(token)
+        with self._token_lock:
+            if self._tokens.pop(token_hash, None) is None:
+                return
+            if self._added_tokens.pop(token_hash, None) is None:
+                self._removed_tokens.add(token_hash)
+                self._schedule_persist_tokens()
+
+    def _clear_credentials_cache(self, username):
+        for key in [key for key in self._credentials_cache.keys() if key[0] == username]:
+            self._credentials_cache.pop(key, None)
 
     def get_role(self, username):
         """ Get the role for a certain user. Returns None is user was not found. """
@@ -191,24 +242,87 @@ class UserController(object):
         return None
 
     def _gen_token(self, username, valid_until):
-        """ Generate a token and insert it into the tokens dict. """
+        """ Generate a token and insert it into the tokens dict. It is persisted later on, in a batch. """
         ret = uuid.uuid4().hex
-        self._tokens[ret] = (username, valid_until)
-
-        # Delete the expired tokens
-        for token in self._tokens.keys():
-            if self._tokens[token][1] < time.time():
-                self._tokens.pop(token, None)
-
+        token_hash = UserController._hash_token(ret)
+        with self._token_lock:
+            self._tokens[token_hash] = (username, valid_until)
+            heapq.heappush(self._token_expiries, (valid_until, token_hash))
+            self._added_tokens[token_hash] = (username, valid_until)
+            self._schedule_persist_tokens()
+
+        self._evict_tokens()
         return ret
 
+    def _evict_tokens(self):
+        """ Delete the expired tokens, using the expiry heap so only expired tokens are visited """
+        now = time.time()
+        with self._token_lock:
+            while self._token_expiries and self._token_expiries[0][0] < now:
+                _, token_hash = heapq.heappop(self._token_expiries)
+                if self._tokens.pop(token_hash, None) is None:
+                    continue  # Already logged out
+                if self._added_tokens.pop(token_hash, None) is None:
+                    self._removed_tokens.add(token_hash)
+                    self._schedule_persist_tokens()
+
+    def _schedule_persist_tokens(self):
+        """ Schedules persisting the token changes, should be called with the token lock held """
+        if self._token_timer is None:
+            self._token_timer = Timer(UserController.TOKEN_PERSIST_DELAY, self.persist_tokens)
+            self._token_timer.daemon = True
+            self._token_timer.start()
+
+    def persist_tokens(self):
+        """ Writes the added and removed tokens to the database in one transaction """
+        with self._lock:
+            with self._token_lock:
+                if self._token_timer is not None:
+                    self._token_timer.cancel()
+                    self._token_timer = None
+                added, self._added_tokens = self._added_tokens, {}
+                removed, self._removed_tokens = self._removed_tokens, set()
+            if not added and not removed:
+                return
+            try:
+                self._execute("BEGIN;", lock=False)
+                self._cursor.executemany("INSERT OR REPLACE INTO tokens (token_hash, username, valid_until) VALUES (?, ?, ?);",
+                                         [(token_hash, data[0], data[1]) for token_hash, data in added.iteritems()])
+                self._cursor.executemany("DELETE FROM tokens WHERE token_hash = ?;",
+                                         [(token_hash,) for token_hash in removed])
+                self._execute("COMMIT;", lock=False)
+            except Exception:
+                logger.exception('Could not persist tokens')
+                try:
+                    self._execute("ROLLBACK;", lock=False)
+                except sqlite3.Error:
+                    pass  # The transaction was not started
+                self._requeue_tokens(added, removed)
+
+    def _requeue_tokens(self, added, removed):
+        """ Queues the changes of a failed persist again, unless they were overtaken in the meantime """
+        with self._token_lock:
+            for token_hash, data in added.iteritems():
+                if token_hash in self._tokens:
+                    self._added_tokens.setdefault(token_hash, data)
+            for token_hash in removed:
+                if token_hash not in self._added_tokens:
+                    self._removed_tokens.add(token_hash)
+            self._schedule_persist_tokens()
+
     def check_token(self, token):
         """ Returns True if the token is valid, False if the token is invalid. """
-        if token is None or token not in self._tokens:
+        if not isinstance(token, basestring):
             return False
-        else:
-            return self._tokens[token][1] >= time.time()
+        data = self._tokens.get(UserController._hash_token(token))
+        return data is not None and data[1] >= time.time()
+
+    def stop(self):
+        """ Persists the pending token changes. """
+        self.persist_tokens()
 
     def close(self):
-        """ Cose the database connection. """
+        """ Persists the pending token changes and closes the database connection. """
+        self.persist_tokens()
         self._connection.close()
+
@@ -16,6 +16,7 @@
 
 
 import base64
+import inspect
 import logging
 import os
 import subprocess
@@ -23,11 +24,14 @@ import sys
 import threading
 import time
 import uuid
+import zlib
+from collections import deque
 
 import cherrypy
 import msgpack
 import requests
 import ujson as json
+from cherrypy.lib.encoding import set_vary_header
 from cherrypy.lib.static import serve_file
 from decorator import decorator
 
@@ -43,6 +47,7 @@ from models import Feature
 from platform_utils import System
 from power.power_communicator import InAddressModeException
 from serial_utils import CommunicationTimedOutException
+from toolbox import Histogram
 
 logger = logging.getLogger("openmotics")
 
@@ -106,7 +111,8 @@ def params_parser(params, param_types):
             elif param_types[key] == bool:
                 params[key] = str(value).lower() not in ['false', '0', '0.0', 'no']
             elif param_types[key] == 'json':
-                params[key] = json.loads(value)
+                if isinstance(value, basestring):
+                    params[key] = json.loads(value)
             elif param_types[key] == int:
                 # Double convertion. Params come in as strings, and int('0.0') fails, while int(float('0.0')) works as expected
                 params[key] = int(float(value))
@@ -176,16 +182,192 @@ def authentication_handler(pass_token=False):
         request.handler = None
 
 
+def compression_handler(threshold=1024, compress_level=5, mime_types=('application/json', 'text/plain', 'text/html')):
+    """ Compresses (gzip or deflate, as accepted by the client) responses larger than the given threshold. """
+    request = cherrypy.serving.request
+    response = cherrypy.serving.response
+    if response.stream or not isinstance(response.body, list):
+        return  # Streamed responses and files are not compressed
+    if response.headers.get('Content-Type', '').split(';')[0].strip() not in mime_types:
+        return
+    set_vary_header(response, 'Accept-Encoding')
+    if 'Content-Encoding' in response.headers:
+        return
+    body = ''.join(response.body)
+    if len(body) < threshold:
+        return
+    encoding = None
+    for element in request.headers.elements('Accept-Encoding'):
+        if element.qvalue > 0 and element.value in ['gzip', 'x-gzip', 'deflate']:
+            encoding = element.value
+            break
+    if encoding is None:
+        return
+    if encoding == 'deflate':
+        compressed = zlib.compress(body, compress_level)
+    else:
+        compressor = zlib.compressobj(compress_level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+        compressed = compressor.compress(body) + compressor.flush()
+    response.headers['Content-Encoding'] = encoding
+    response.headers.pop('Content-Length', None)
+    response.body = [compressed]
+
+
+def statistics_handler(statistics):
+    """ Registers the latency of a finished request with the statistics of the server that handled it. """
+    request = cherrypy.serving.request
+    response = cherrypy.serving.response
+    try:
+        status = int(str(response.status)[:3])
+    except ValueError:
+        status = 500
+    statistics.register(request.local.port, time.time() - response.time, status)
+
+
+class ServerStatistics(object):
+    """ Keeps track of request statistics of the web servers, per server port. """
+
+    WINDOW = 100  # Amount of recent requests used for the recent latency figures
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._servers = {}
+        self._statistics = {}
+
+    def add_server(self, name, server):
+        """
+        Adds a server of which the statistics are reported.
+
+        :type name: str
+        :type server: cherrypy._cpserver.Server
+        """
+        with self._lock:
+            self._servers[server.socket_port] = (name, server)
+            self._statistics[server.socket_port] = {'requests': 0,
+                                                    'errors': 0,
+                                                    'latency_total': 0.0,
+                                                    'latency_max': 0.0,
+                                                    'recent': deque(maxlen=ServerStatistics.WINDOW)}
+
+    def register(self, port, latency, status):
+        with self._lock:
+            statistics = self._statistics.get(port)
+            if statistics is None:
+                return
+            statistics['requests'] += 1
+            if status >= 500:
+                statistics['errors'] += 1
+            statistics['latency_total'] += latency
+            statistics['latency_max'] = max(statistics['latency_max'], latency)
+            statistics['recent'].append(latency)
+
+    def get_statistics(self):
+        """
+        Returns the statistics of all servers.
+
+        :returns: Per server name: request count, error count, latencies (seconds), queue length and connection counters
+        :rtype: dict
+        """
+        data = {}
+        with self._lock:
+            for port, (name, server) in self._servers.iteritems():
+                statistics = self._statistics[port]
+                recent = sorted(statistics['recent'])
+                requests = statistics['requests']
+                entry = {'port': port,
+                         'requests': requests,
+                         'errors': statistics['errors'],
+                         'latency_avg': statistics['latency_total'] / requests if requests else None,
+                         'latency_max': statistics['latency_max'] if requests else None,
+                         'latency_recent_avg': sum(recent) / len(recent) if recent else None,
+                         'latency_recent_p95': recent[int(len(recent) * 0.95)] if recent else None,
+                         'queue': None,
+                         'threads': None,
+                         'active_connections': None}
+                pool = getattr(server.httpserver, 'requests', None)
+                if pool is not None:
+                    threads = len(getattr(pool, '_threads', []))
+                    entry.update({'queue': pool.qsize,
+                                  'threads': threads,
+                                  'active_connections': threads - pool.idle})
+                data[name] = entry
+        return data
+
+
+@Injectable.named('api_statistics')
+@Singleton
+class ApiStatistics(object):
+    """ Keeps track of request counts, error counts and latency histograms (in milliseconds) per API call. """
+
+    BUCKETS = [1, 2.5, 5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000]
+    TIMINGS = ['total', 'handler', 'serialization']
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._statistics = {}
+
+    def register(self, name, error, timings):
+        """
+        Registers a finished API call.
+
+        :param name: Name of the API call
+        :param error: Whether the call failed
+        :param timings: Durations (in seconds) per timing, e.g. {'total': 0.12, 'handler': 0.1, 'serialization': 0.02}
+        """
+        with self._lock:
+            statistics = self._statistics.get(name)
+            if statistics is None:
+                statistics = {'requests': 0,
+                              'errors': 0,
+                              'timings': dict((timing, Histogram(ApiStatistics.BUCKETS)) for timing in ApiStatistics.TIMINGS)}
+                self._statistics[name] = statistics
+            statistics['requests'] += 1
+            if error:
+                statistics['errors'] += 1
+            for timing, duration in timings.iteritems():
+                statistics['timings'][timing].add(duration * 1000)
+
+    def get_statistics(self):
+        """
+        :returns: Per API call the request and error counts and, per timing, the histogram
+        :rtype: dict
+        """
+        with self._lock:
+            return dict((name, {'requests': statistics['requests'],
+                                'errors': statistics['errors'],
+                                'timings': dict((timing, histogram.serialize())
+                                                for timing, histogram in statistics['timings'].iteritems())})
+                        for name, statistics in self._statistics.iteritems())
+
+    def get_summaries(self):
+        """
+        :returns: Per API call the request and error counts and, per timing, the average, 50th, 95th, 99th percentile and maximum
+        :rtype: dict
+        """
+        summaries = {}
+        with self._lock:
+            for name, statistics in self._statistics.iteritems():
+                summary = {'requests': statistics['requests'],
+                           'errors': statistics['errors']}
+                for timing, histogram in statistics['timings'].iteritems():
+                    summary['{0}_avg'.format(timing)] = histogram.average
+                    summary['{0}_max'.format(timing)] = histogram.max
+                    for percentile in [50, 95, 99]:
+                        summary['{0}_p{1}'.format(timing, percentile)] = histogram.percentile(percentile)
+                summaries[name] = summary
+        return summaries
+
+
 cherrypy.tools.timestamp_filter = cherrypy.Tool('before_handler', timestamp_handler)
 cherrypy.tools.cors = cherrypy.Tool('before_handler', cors_handler, priority=10)
 cherrypy.tools.authenticated = cherrypy.Tool('before_handler', authentication_handler)
 cherrypy.tools.params = cherrypy.Tool('before_handler', params_handler)
+cherrypy.tools.compress = cherrypy.Tool('before_finalize', compression_handler, priority=80)
+cherrypy.tools.server_statistics = cherrypy.Tool('on_end_request', statistics_handler)
 
 
-@decorator
-def _openmotics_api(f, *args, **kwargs):
-    start = time.time()
-    timings = {}
+def _call_api(f, *args, **kwargs):
+    """ Executes an API call and translates its outcome into a (status, data) tuple """
     status = 200  # OK
     try:
         return_data = f(*args, **kwargs)
@@ -204,10 +386,23 @@ def _openmotics_api(f, *args, **kwargs):
         logger.exception('Unexpected error during API call %s', f.__name__)
         status = 200  # OK
         data = {'success': False, 'msg': str(ex)}
+    return status, data
+
+
+@decorator
+def _openmotics_api(f, *args, **kwargs):
+    start = time.time()
+    timings = {}
+    status, data = _call_api(f, *args, **kwargs)
     timings['process'] = ('Processing', time.time() - start)
     serialization_start = time.time()
     contents = json.dumps(data)
     timings['serialization'] = 'Serialization', time.time() - serialization_start
+    web_interface = args[0]
+    web_interface._api_statistics.register(f.__name__, status >= 400 or data.get('success') is False,
+                                           {'total': time.time() - start,
+                                            'handler': timings['process'][1],
+                                            'serialization': timings['serialization'][1]})
     cherrypy.response.headers['Content-Type'] = 'application/json'
     cherrypy.response.headers['Server-Timing'] = ','.join(['{0}={1}; "{2}"'.format(key, value[1] * 1000, value[0])
                                                            for key, value in timings.iteritems()])
@@ -227,6 +422,7 @@ def openmotics_api(auth=False, check=None, pass_token=False, plugin_exposed=True
             func = cherrypy.tools.params(**check)(func)
         func.exposed = True
         func.plugin_exposed = plugin_exposed
+        func.pass_token = pass_token
         func.check = check
         return func
     return wrapper
@@ -241,10 +437,14 @@ def types(**kwargs):
 class WebInterface(object):
     """ This class defines the web interface served by cherrypy. """
 
+    BATCH_CONCURRENCY = 5
+    PLUGIN_API_MANIFEST_VERSION = 1
+    _plugin_api_manifest = None
+
     @Inject
     def __init__(self, user_controller=INJECTED, gateway_api=INJECTED, maintenance_controller=INJECTED,
                  message_client=INJECTED, configuration_controller=INJECTED, scheduling_controller=INJECTED,
-                 thermostat_controller=INJECTED):
+                 thermostat_controller=INJECTED, api_statistics=INJECTED):
         """
         Constructor for the WebInterface.
 
@@ -255,11 +455,13 @@ class WebInterface(object):
         :type configuration_controller: gateway.config.ConfigController
         :type scheduling_controller: gateway.scheduling.SchedulingController
         :type thermostat_controller: gateway.thermostat.thermostat_controller.ThermostatController
+        :type api_statistics: gateway.webservice.ApiStatistics
         """
         self._user_controller = user_controller
         self._config_controller = configuration_controller
         self._scheduling_controller = scheduling_controller
         self._thermostat_controller = thermostat_controller
+        self._api_statistics = api_statistics
         self._plugin_controller = None
 
         self._gateway_api = gateway_api
@@ -268,6 +470,7 @@ class WebInterface(object):
         self._plugin_controller = None
         self._metrics_collector = None
         self._metrics_controller = None
+        self._web_service = None
 
         self._ws_metrics_registered = False
         self._power_dirty = False
@@ -340,6 +543,64 @@ class WebInterface(object):
         """ Sets the metrics controller """
         self._metrics_controller = metrics_controller
 
+    def set_web_service(self, web_service):
+        """ Sets the web service """
+        self._web_service = web_service
+
+    @classmethod
+    def get_plugin_api_manifest(cls):
+        """
+        Gets the manifest of the API calls that are exposed to plugins. It is generated once, by
+        inspecting the decorated methods, and is sent to the plugin runtimes when they are started.
+
+        :returns: 'version': manifest version, 'gateway': gateway version, 'calls': dict with per call the list of arguments
+        :rtype: dict
+        """
+        if cls._plugin_api_manifest is None:
+            calls = {}
+            for name, method in inspect.getmembers(cls, predicate=inspect.ismethod):
+                if getattr(method, 'plugin_exposed', False) is True:
+                    calls[name] = inspect.getargspec(method).args[1:]
+            cls._plugin_api_manifest = {'version': WebInterface.PLUGIN_API_MANIFEST_VERSION,
+                                        'gateway': gateway.__version__,
+                                        'calls': calls}
+        return cls._plugin_api_manifest
+
+    def execute_api_call(self, name, parameters=None, plugin_exposed_only=False):
+        """
+        Executes an exposed API call in-process, bypassing the HTTP stack. Parameters are
+        converted the same way as for an HTTP request.
+
+        :param name: Name of the API call
+        :type name: str
+        :param parameters: Parameters of the API call
+        :type parameters: dict
+        :param plugin_exposed_only: Only allow calls that are exposed to plugins
+        :type plugin_exposed_only: bool
+        :returns: Tuple of the HTTP status and the response data
+        :rtype: tuple
+        """
+        func = None
+        if isinstance(name, basestring) and not name.startswith('_'):
+            func = getattr(self, name, None)
+        if func is None or not hasattr(func, 'check') or getattr(func, 'pass_token', False) or \
+                (plugin_exposed_only and not func.plugin_exposed):
+            return 404, {'success': False, 'msg': 'unknown_call'}
+        if parameters is not None and not isinstance(parameters, dict):
+            return 406, {'success': False, 'msg': 'invalid_parameters'}
+        try:
+            params = dict(parameters or {})
+            params_parser(params, func.check or {})
+        except (TypeError, ValueError):
+            return 406, {'success': False, 'msg': 'invalid_parameters'}
+        start = time.time()
+        status, data = _call_api(func.__wrapped__, self, **params)
+        duration = time.time() - start
+        self._api_statistics.register(name, status >= 400 or data.get('success') is False,
+                                      {'total': duration,
+                                       'handler': duration})
+        return status, data
+
     @cherrypy.expose
     def index(self):
         """
@@ -1911,25 +2172,42 @@ class WebInterface(object):
         """
         return self._gateway_api.set_power_modules(json.loads(modules))
 
-    @openmotics_api(auth=True)
-    def get_realtime_power(self):
+    @openmotics_api(auth=True, check=types(fresh=bool))
+    def get_realtime_power(self, fresh=False):
         """
         Get the realtime power measurements.
 
+        :param fresh: Read the measurements from the modules, instead of using recent measurements.
+        :type fresh: bool
         :returns: module id as the keys: [voltage, frequency, current, power].
         :rtype: dict
         """
-        return self._gateway_api.get_realtime_power()
+        return self._gateway_api.get_realtime_power(force_fresh=fresh)
 
-    @openmotics_api(auth=True)
-    def get_total_energy(self):
+    @openmotics_api(auth=True, check=types(fresh=bool))
+    def get_total_energy(self, fresh=False):
         """
         Get the total energy (Wh) consumed by the power modules.
 
+        :param fresh: Read the counters from the modules, instead of using recent values.
+        :type fresh: bool
         :returns: modules id as key: [day, night].
         :rtype: dict
         """
-        return self._gateway_api.get_total_energy()
+        return self._gateway_api.get_total_energy(force_fresh=fresh)
+
+    @openmotics_api(auth=True)
+    def get_power_poll_rates(self):
+        """
+        Get the rate at which the power modules are polled for metrics. Modules with stable
+        readings are polled less often.
+
+        :returns: module id as key: {'interval': <seconds between reads>, 'stable': <bool>, 'bus_time': <seconds per read>}
+        :rtype: dict
+        """
+        if self._metrics_collector is None:
+            return {}
+        return self._metrics_collector.get_power_poll_rates()
 
     @openmotics_api(auth=True)
     def start_power_address_mode(self):
@@ -2238,6 +2516,23 @@ class WebInterface(object):
         """
         return {'logs': self._plugin_controller.get_logs()}
 
+    @openmotics_api(auth=True, check=types(cursor=int, limit=int), plugin_exposed=False)
+    def get_plugin_log_records(self, name, cursor=None, limit=None):
+        """
+        Get the log records of a plugin that were added after the given cursor.
+
+        :param name: Name of the plugin.
+        :type name: str
+        :param cursor: The cursor returned by a previous call, None to get all records.
+        :type cursor: int
+        :param limit: The maximum amount of records.
+        :type limit: int
+        :returns: 'records': list of dicts with id, timestamp, level and message, oldest first. \
+            'cursor': the cursor to get the next records.
+        :rtype: dict
+        """
+        return self._plugin_controller.get_log_records(name, cursor=cursor, limit=limit)
+
     @openmotics_api(auth=True, plugin_exposed=False)
     def install_plugin(self, md5, package_data):
         """
@@ -2277,6 +2572,17 @@ class WebInterface(object):
         running = self._plugin_controller.start_plugin(name)
         return {'status': 'RUNNING' if running else 'STOPPED'}
 
+    @openmotics_api(auth=True, plugin_exposed=False)
+    def get_plugin_collector_statistics(self):
+        """
+        Gets the statistics of the metric collectors of all plugins.
+
+        :returns: 'statistics': dict with per plugin and metric collector the amount of runs, errors, timeouts
+                  and late results, and the skew and duration (in milliseconds).
+        :rtype: dict
+        """
+        return {'statistics': self._plugin_controller.get_collector_statistics()}
+
     @openmotics_api(auth=True, check=types(settings='json'), plugin_exposed=False)
     def get_settings(self, settings):
         """
@@ -2355,12 +2661,88 @@ class WebInterface(object):
         return {'health': health,
                 'health_version': 1.0}
 
+    @openmotics_api(auth=True, plugin_exposed=False)
+    def get_webserver_statistics(self):
+        """
+        Gets the request statistics of the web servers.
+
+        :returns: 'statistics': dict with per server the request and error counts, the request latencies (in seconds),
+                  the length of the connection queue and the amount of active connections.
+        :rtype: dict
+        """
+        if self._web_service is None:
+            return {'statistics': {}}
+        return {'statistics': self._web_service.get_statistics()}
+
+    @openmotics_api(auth=True, plugin_exposed=False)
+    def get_api_statistics(self):
+        """
+        Gets the statistics of the API calls since startup.
+
+        :returns: 'statistics': dict with per API call the request and error counts and the latency histograms
+                  (in milliseconds) of the total duration, the handler and the serialization.
+        :rtype: dict
+        """
+        return {'statistics': self._api_statistics.get_statistics()}
+
     @openmotics_api(auth=True)
     def indicate(self):
         """ Blinks the Status led on the Gateway to indicate the module """
         self._message_client.send_event(OMBusEvents.INDICATE_GATEWAY, None)
         return {}
 
+    @openmotics_api(auth=True, check=types(calls='json', concurrent=bool), plugin_exposed=False)
+    def batch(self, calls, concurrent=False):
+        """
+        Executes multiple API calls in a single request. The request is only authenticated once.
+
+        :param calls: List of calls, e.g. [{"name": "get_output_status"}, {"name": "set_output", "parameters": {"id": 1, "is_on": true}}]
+        :type calls: list
+        :param concurrent: Execute consecutive read calls (get_*) concurrently
+        :type concurrent: bool
+        :returns: 'results': list with the result of every call, in the order of the calls.
+        :rtype: dict
+        """
+        if not isinstance(calls, list):
+            raise ValueError('calls should be a list')
+        results = [None] * len(calls)
+        reads = []
+        for index, call in enumerate(calls):
+            if concurrent and isinstance(call, dict) and str(call.get('name')).startswith('get_'):
+                reads.append(index)
+                continue
+            self._execute_batch_calls(calls, reads, results)
+            reads = []
+            results[index] = self._execute_batch_call(call)
+        self._execute_batch_calls(calls, reads, results)
+        return {'results': results}
+
+    def _execute_batch_call(self, call):
+        if not isinstance(call, dict) or call.get('name') == 'batch':
+            return {'success': False, 'msg': 'invalid_call'}
+        _, data = self.execute_api_call(call.get('name'), call.get('parameters'))
+        return data
+
+    def _execute_batch_calls(self, calls, indexes, results):
+        """ Executes the given calls concurrently, in chunks of at most BATCH_CONCURRENCY calls """
+        if len(indexes) == 1:
+            results[indexes[0]] = self._execute_batch_call(calls[indexes[0]])
+            return
+
+        def _execute(_index):
+            results[_index] = self._execute_batch_call(calls[_index])
+
+        for i in xrange(0, len(indexes), WebInterface.BATCH_CONCURRENCY):
+            threads = []
+            for index in indexes[i:i + WebInterface.BATCH_CONCURRENCY]:
+                thread = threading.Thread(target=_execute, args=(index,))
+                thread.setName('Batch call thread')
+                thread.daemon = True
+                thread.start()
+                threads.append(thread)
+            for thread in threads:
+                thread.join()
+
     @cherrypy.expose
     @cherrypy.tools.cors()
     @cherrypy.tools.authenticated(pass_token=True)
@@ -2389,6 +2771,19 @@ class WebInterface(object):
                                                 'interface': self}
 
 
+class PluginDispatcher(object):
+    """
+    Dispatches requests for /plugins/<name>/... to the web service of the plugin. Plugins
+    are looked up on every request, so they can be attached and detached at runtime.
+    """
+
+    def __init__(self, services):
+        self._services = services
+
+    def _cp_dispatch(self, vpath):
+        return self._services.get(vpath.pop(0))
+
+
 @Injectable.named('web_service')
 @Singleton
 class WebService(object):
@@ -2396,12 +2791,21 @@ class WebService(object):
 
     name = 'web'
 
+    SERVER_DEFAULTS = {'thread_pool': 10,
+                       'thread_pool_max': -1,
+                       'socket_queue_size': 5,
+                       'keep_alive_timeout': 60,
+                       'compression_threshold': 1024,
+                       'compression_level': 5}
+
     @Inject
     def __init__(self, web_interface=INJECTED, configuration_controller=INJECTED, verbose=False):
         self._webinterface = web_interface
         self._config_controller = configuration_controller
         self._https_server = None
         self._http_server = None
+        self._statistics = ServerStatistics()
+        self._plugin_services = {}
         self._running = False
         if not verbose:
             logging.getLogger("cherrypy").propagate = False
@@ -2429,23 +2833,27 @@ class WebService(object):
 
             cherrypy.tree.mount(root=self._webinterface,
                                 config=config)
-
-            cherrypy.config.update({'engine.autoreload.on': False})
+            cherrypy.tree.mount(root=PluginDispatcher(self._plugin_services),
+                                script_name='/plugins',
+                                config={'/': {'tools.sessions.on': False,
+                                              'tools.trailing_slash.on': False,
+                                              'tools.cors.on': self._config_controller.get_setting('cors_enabled', False)}})
+
+            cherrypy.config.update({'engine.autoreload.on': False,
+                                    'tools.compress.on': self._get_setting('compression_threshold') > 0,
+                                    'tools.compress.threshold': self._get_setting('compression_threshold'),
+                                    'tools.compress.compress_level': self._get_setting('compression_level'),
+                                    'tools.server_statistics.on': True,
+                                    'tools.server_statistics.statistics': self._statistics})
             cherrypy.server.unsubscribe()
 
-            self._https_server = cherrypy._cpserver.Server()
-            self._https_server.socket_port = 443
-            self._https_server._socket_host = '0.0.0.0'
-            self._https_server.socket_timeout = 60
+            self._https_server = self._build_server('https', '0.0.0.0', 443)
             System.setup_cherrypy_ssl(self._https_server,
                                       private_key_filename=constants.get_ssl_private_key_file(),
                                       certificate_filename=constants.get_ssl_certificate_file())
             self._https_server.subscribe()
 
-            self._http_server = cherrypy._cpserver.Server()
-            self._http_server.socket_port = 80
-            self._http_server._socket_host = '127.0.0.1'
-            self._http_server.socket_timeout = 60
+            self._http_server = self._build_server('http', '127.0.0.1', 80)
             self._http_server.subscribe()
 
             cherrypy.engine.autoreload_on = False
@@ -2462,6 +2870,31 @@ class WebService(object):
             logger.exception("Could not start webservice. Dying...")
             sys.exit(1)
 
+    def _get_setting(self, setting, server_name=None):
+        """
+        Loads a web server setting. A server specific value (e.g. `webserver_thread_pool|https`)
+        takes precedence over the general value (e.g. `webserver_thread_pool`).
+        """
+        value = self._config_controller.get_setting('webserver_{0}'.format(setting), WebService.SERVER_DEFAULTS[setting])
+        if server_name is not None:
+            value = self._config_controller.get_setting('webserver_{0}|{1}'.format(setting, server_name), value)
+        return value
+
+    def _build_server(self, name, host, port):
+        server = cherrypy._cpserver.Server()
+        server.socket_port = port
+        server._socket_host = host
+        server.socket_timeout = self._get_setting('keep_alive_timeout', name)  # Idle time before a keep-alive connection is closed
+        server.socket_queue_size = self._get_setting('socket_queue_size', name)
+        server.thread_pool = self._get_setting('thread_pool', name)
+        server.thread_pool_max = self._get_setting('thread_pool_max', name)
+        self._statistics.add_server(name, server)
+        return server
+
+    def get_statistics(self):
+        """ Returns the request statistics of the web servers """
+        return self._statistics.get_statistics()
+
     @staticmethod
     def _http_server_logger(msg='', level=20, traceback=False):
         """
@@ -2493,12 +2926,14 @@ class WebService(object):
             time.sleep(0.1)
         logger.info('Stopping webserver... Done')
 
-    def update_tree(self, mounts):
-        self._http_server.stop()
-        self._https_server.stop()
-        for mount in mounts:
-            cherrypy.tree.mount(**mount)
-        self._http_server.start()
-        self._https_server.start()
-        self._https_server.httpserver.error_log = WebService._http_server_logger
-        self._http_server.httpserver.error_log = WebService._http_server_logger
+    def mount_plugin(self, name, root):
+        """ Serves the given root under /plugins/<name>, without restarting the servers """
+        self._plugin_services[name] = root
+
+    def unmount_plugin(self, name):
+        """ Stops serving /plugins/<name> """
+        self._plugin_services.pop(name, None)
+
+    def get_plugin_mounts(self):
+        """ Returns the names of the mounted plugins """
+        return self._plugin_services.keys()
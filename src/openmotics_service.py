@@ -69,7 +69,7 @@ class OpenmoticsService(object):
         # instances that are used in @Inject decorated functions below, and is also needed to specify
         # abstract implementations depending on e.g. the platform (classic vs core) or certain settings (classic
         # thermostats vs gateway thermostats)
-        from power import power_communicator, power_controller
+        from power import power_communicator, power_controller, power_snapshots, power_analytics
         from plugins import base
         from gateway import (metrics_controller, webservice, scheduling, observer, gateway_api, metrics_collector,
                              maintenance_controller, comm_led_controller, users, pulses, config as config_controller,
@@ -77,7 +77,7 @@ class OpenmoticsService(object):
         from cloud import events
         _ = (metrics_controller, webservice, scheduling, observer, gateway_api, metrics_collector,
              maintenance_controller, base, events, power_communicator, comm_led_controller, users,
-             power_controller, pulses, config_controller, metrics_caching)
+             power_controller, power_snapshots, power_analytics, pulses, config_controller, metrics_caching)
         if Platform.get_platform() == Platform.Type.CORE_PLUS:
             from gateway.hal import master_controller_core
             from master_core import maintenance, core_communicator, ucan_communicator
@@ -170,17 +170,21 @@ class OpenmoticsService(object):
     @Inject
     def fix_dependencies(metrics_controller=INJECTED, message_client=INJECTED, web_interface=INJECTED, scheduling_controller=INJECTED,
                          observer=INJECTED, gateway_api=INJECTED, metrics_collector=INJECTED, plugin_controller=INJECTED,
-                         web_service=INJECTED, event_sender=INJECTED, maintenance_controller=INJECTED, thermostat_controller=INJECTED):
+                         web_service=INJECTED, event_sender=INJECTED, maintenance_controller=INJECTED, thermostat_controller=INJECTED,
+                         power_communicator=INJECTED):
 
         # TODO: Fix circular dependencies
 
         thermostat_controller.subscribe_events(web_interface.send_event_websocket)
         thermostat_controller.subscribe_events(event_sender.enqueue_event)
         thermostat_controller.subscribe_events(plugin_controller.process_observer_event)
+        if power_communicator is not None:
+            power_communicator.subscribe_events(web_interface.send_event_websocket)
         message_client.add_event_handler(metrics_controller.event_receiver)
         web_interface.set_plugin_controller(plugin_controller)
         web_interface.set_metrics_collector(metrics_collector)
         web_interface.set_metrics_controller(metrics_controller)
+        web_interface.set_web_service(web_service)
         gateway_api.set_plugin_controller(plugin_controller)
         metrics_controller.add_receiver(metrics_controller.receiver)
         metrics_controller.add_receiver(web_interface.distribute_metric)
@@ -206,7 +210,8 @@ class OpenmoticsService(object):
     def start(master_controller=INJECTED, maintenance_controller=INJECTED,
               observer=INJECTED, power_communicator=INJECTED, metrics_controller=INJECTED, passthrough_service=INJECTED,
               scheduling_controller=INJECTED, metrics_collector=INJECTED, web_service=INJECTED, gateway_api=INJECTED, plugin_controller=INJECTED,
-              communication_led_controller=INJECTED, event_sender=INJECTED, thermostat_controller=INJECTED):
+              communication_led_controller=INJECTED, event_sender=INJECTED, thermostat_controller=INJECTED,
+              user_controller=INJECTED):
         """ Main function. """
         logger.info('Starting OM core service...')
 
@@ -239,6 +244,7 @@ class OpenmoticsService(object):
             thermostat_controller.stop()
             plugin_controller.stop()
             event_sender.stop()
+            user_controller.stop()
             logger.info('Stopping OM core service... Done')
             signal_request['stop'] = True
 
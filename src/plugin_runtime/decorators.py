@@ -21,7 +21,7 @@ import logging
 logger = logging.getLogger('openmotics')
 
 
-def om_expose(method=None, auth=True, content_type='application/json'):
+def om_expose(method=None, auth=True, content_type='application/json', stream_body=False):
     """
     Decorator to expose a method of the plugin class through the
     webinterface. The url will be /plugins/<plugin-name>/<method>.
@@ -40,11 +40,23 @@ def om_expose(method=None, auth=True, content_type='application/json'):
     @om_expose(auth=False)
     def method_to_expose(self, ...):
         pass
+
+    The request body can be streamed to the method, instead of being parsed
+    into the parameters. The method receives it as a file-like `body`
+    parameter, which can also be iterated over in chunks:
+
+    @om_expose(stream_body=True)
+    def method_to_expose(self, body, ...):
+        pass
+
+    A method that returns a generator or a file-like object streams the
+    response in chunks, so it doesn't need to be kept in memory as a whole.
     """
     def decorate(_method):
         _method.om_expose = {'method': _method,
                              'auth': auth,
-                             'content_type': content_type}
+                             'content_type': content_type,
+                             'stream_body': stream_body}
         return _method
 
     if method is not None:
@@ -74,7 +86,7 @@ def input_status(method=None, version=1):
     return wrapper
 
 
-def output_status(method):
+def output_status(method=None, version=1):
     """
     Decorator to indicate that the method should receive output status messages.
     The receiving method should accept one parameter, a list of tuples (output, dimmer value).
@@ -82,9 +94,19 @@ def output_status(method):
 
     Important! This method should not block, as this will result in an unresponsive system.
     Please use a separate thread to perform complex actions on output status messages.
+
+    Changes that happen shortly after each other (e.g. a group action) are delivered at once. Initially the
+    receiving method got the state of all outputs that are on, version 2 only gets the changed outputs as
+    a list of dicts with the id, status and dimmer value.
     """
-    method.output_status = True
-    return method
+    if method is not None:
+        method.output_status = {'version': 1}
+        return method
+
+    def wrapper(_method):
+        _method.output_status = {'version': version}
+        return _method
+    return wrapper
 
 
 def shutter_status(method):
@@ -2,14 +2,16 @@ import os
 import sys
 import traceback
 import time
-from threading import Thread
+import types
+from Queue import Queue, Empty
+from threading import Thread, Lock
 
 sys.path.insert(0, '/opt/openmotics/python')
 
 from platform_utils import System
 System.import_libs()
 
-from toolbox import PluginIPCStream
+from toolbox import PluginIPCStream, IPCStreamSender, IPCStreamReceiver
 from gateway.observer import Event
 from plugin_runtime import base
 from plugin_runtime.utils import get_plugin_class, check_plugin, get_special_methods
@@ -19,8 +21,12 @@ from plugin_runtime.web import WebInterfaceDispatcher
 
 class PluginRuntime:
 
+    WORKERS = 5
+
     def __init__(self, path):
         self._stopped = False
+        self._message_queue = Queue()
+        self._command_queue = Queue()
         self._path = path.rstrip('/')
 
         self._input_status_receivers = []
@@ -38,9 +44,12 @@ class PluginRuntime:
         self._metric_receivers = []
 
         self._plugin = None
-        self._stream = PluginIPCStream(sys.stdin, IO._log_exception)
+        self._stream = PluginIPCStream(sys.stdin, IO._log_exception, command_receiver=self._receive_message)
+        self._stream_senders = {}  # cid -> IPCStreamSender, for streamed responses
+        self._stream_receivers = {}  # cid -> IPCStreamReceiver, for streamed request bodies
 
-        self._webinterface = WebInterfaceDispatcher(IO._log)
+        self._api_channel = ApiChannel()
+        self._webinterface = WebInterfaceDispatcher(IO._log, api_channel=self._api_channel)
 
     def _init_plugin(self):
         plugin_root = os.path.dirname(self._path)
@@ -85,7 +94,8 @@ class PluginRuntime:
         for method in get_special_methods(self._plugin, 'om_expose'):
             self._exposes.append({'name': method.__name__,
                                   'auth': method.om_expose['auth'],
-                                  'content_type': method.om_expose['content_type']})
+                                  'content_type': method.om_expose['content_type'],
+                                  'stream_body': method.om_expose.get('stream_body', False)})
 
         # Set the metric definitions
         if has_interface(plugin_class, 'metrics', '1.0'):
@@ -126,50 +136,101 @@ class PluginRuntime:
 
     def process_stdin(self):
         self._stream.start()
+        for i in xrange(PluginRuntime.WORKERS):
+            thread = Thread(target=self._process_commands)
+            thread.name = 'Command worker {0}'.format(i)
+            thread.daemon = True
+            thread.start()
         while not self._stopped:
-            command = self._stream.get(block=True)
-            if command is None:
-                continue
-
-            action = command['action']
-            response = {'cid': command['cid'], 'action': action}
-            try:
-                ret = None
-                if action == 'start':
-                    ret = self._handle_start()
-                elif action == 'stop':
-                    ret = self._handle_stop()
-                elif action == 'input_status':
-                    ret = self._handle_input_status(command['event'])
-                elif action == 'output_status':
-                    ret = self._handle_output_status(command['status'])
-                elif action == 'shutter_status':
-                    ret = self._handle_shutter_status(command)
-                elif action == 'receive_events':
-                    ret = self._handle_receive_events(command['code'])
-                elif action == 'get_metric_definitions':
-                    ret = self._handle_get_metric_definitions()
-                elif action == 'collect_metrics':
-                    ret = self._handle_collect_metrics(command['name'])
-                elif action == 'distribute_metrics':
-                    ret = self._handle_distribute_metrics(command['name'], command['metrics'])
-                elif action == 'request':
-                    ret = self._handle_request(command['method'], command['args'], command['kwargs'])
-                elif action == 'remove_callback':
-                    ret = self._handle_remove_callback()
+            command = self._message_queue.get()
+            if command['action'] in ['start', 'stop']:
+                # The plugin must be fully started before other commands are processed, stopping
+                # must not wait for other commands to complete.
+                self._process_command(command)
+            else:
+                # Commands are processed concurrently, their responses are matched by cid
+                self._command_queue.put(command)
+
+    def _receive_message(self, message):
+        """ Handles a received message. Responses and streams are handled right away, in the reader thread. """
+        action = message['action']
+        if action == 'api_response':
+            self._api_channel.process_response(message)
+        elif action in ['stream_chunk', 'stream_end']:
+            receiver = self._stream_receivers.get(message['stream_id'])
+            if receiver is not None:
+                receiver.process_message(message)
+        elif action in ['stream_ack', 'stream_cancel']:
+            sender = self._stream_senders.get(message['stream_id'])
+            if sender is not None:
+                if action == 'stream_ack':
+                    sender.ack()
                 else:
-                    raise RuntimeError('Unknown action: {0}'.format(action))
+                    sender.cancel()
+        else:
+            if message.get('stream_body') is True:
+                # Registered right away, as the body follows the command
+                self._stream_receivers[message['cid']] = IPCStreamReceiver(message['cid'], IO._write)
+            self._message_queue.put(message)
+
+    def _process_commands(self):
+        while True:
+            self._process_command(self._command_queue.get())
 
-                if ret is not None:
-                    response.update(ret)
-            except Exception as exception:
-                response['_exception'] = str(exception)
-            IO._write(response)
+    def _process_command(self, command):
+        action = command['action']
+        response = {'cid': command['cid'], 'action': action}
+        stream = None
+        try:
+            ret = None
+            if action == 'start':
+                ret = self._handle_start(command.get('api_manifest'))
+            elif action == 'stop':
+                ret = self._handle_stop()
+            elif action == 'input_status':
+                ret = self._handle_input_status(command['event'])
+            elif action == 'output_status':
+                ret = self._handle_output_status(command.get('status'), command.get('changes'))
+            elif action == 'shutter_status':
+                ret = self._handle_shutter_status(command)
+            elif action == 'receive_events':
+                ret = self._handle_receive_events(command['code'])
+            elif action == 'get_metric_definitions':
+                ret = self._handle_get_metric_definitions()
+            elif action == 'collect_metrics':
+                ret = self._handle_collect_metrics(command['name'])
+            elif action == 'distribute_metrics':
+                ret = self._handle_distribute_metrics(command['name'], command['metrics'])
+            elif action == 'request':
+                body = self._stream_receivers.get(command['cid'])
+                try:
+                    ret = self._handle_request(command['method'], command['args'], command['kwargs'], body=body)
+                finally:
+                    if body is not None:
+                        body.close()  # Stops the upload of a body that wasn't read
+                        self._stream_receivers.pop(command['cid'], None)
+                stream = ret.pop('stream_body', None)
+            elif action == 'remove_callback':
+                ret = self._handle_remove_callback()
+            else:
+                raise RuntimeError('Unknown action: {0}'.format(action))
 
-    def _handle_start(self):
+            if ret is not None:
+                response.update(ret)
+        except Exception as exception:
+            response['_exception'] = str(exception)
+        IO._write(response)
+        if stream is not None:
+            thread = Thread(target=self._send_stream, args=(command['cid'], stream))
+            thread.name = 'Stream sender {0}'.format(command['cid'])
+            thread.daemon = True
+            thread.start()
+
+    def _handle_start(self, api_manifest):
         """ Handles the start command. Cover exceptions manually to make sure as much metadata is returned as possible. """
         data = {}
         try:
+            self._webinterface.set_api_manifest(api_manifest)
             self._init_plugin()
             self._start_background_tasks()
         except Exception as exception:
@@ -180,7 +241,9 @@ class PluginRuntime:
                      'exposes': self._exposes,
                      'interfaces': self._interfaces,
                      'metric_collectors': self._metric_collectors,
-                     'metric_receivers': self._metric_receivers})
+                     'metric_receivers': self._metric_receivers,
+                     'receiver_versions': {'output_status': sorted(set(receiver.output_status['version']
+                                                                       for receiver in self._output_status_receivers))}})
         return data
 
     def _handle_stop(self):
@@ -214,9 +277,19 @@ class PluginRuntime:
                 error = NotImplementedError('Version {} is not supported for input status decorators'.format(version))
                 IO._log_exception('input status', error)
 
-    def _handle_output_status(self, status):
+    def _handle_output_status(self, status, changes):
         for receiver in self._output_status_receivers:
-            IO._with_catch('output status', receiver, [status])
+            version = receiver.output_status.get('version', 1)
+            if version == 1:
+                if status is not None:
+                    IO._with_catch('output status', receiver, [status])
+            elif version == 2:
+                # Version 2 only receives the changed outputs
+                if changes:
+                    IO._with_catch('output status', receiver, [changes])
+            else:
+                error = NotImplementedError('Version {} is not supported for output status decorators'.format(version))
+                IO._log_exception('output status', error)
 
     def _handle_shutter_status(self, status):
         for receiver in self._shutter_status_receivers:
@@ -246,12 +319,28 @@ class PluginRuntime:
         for metric in metrics:
             IO._with_catch('distribute metric', receive, [metric])
 
-    def _handle_request(self, method, args, kwargs):
+    def _handle_request(self, method, args, kwargs, body=None):
         func = getattr(self._plugin, method)
+        if body is not None:
+            kwargs['body'] = body
         try:
-            return {'success': True, 'response': func(*args, **kwargs)}
+            response = func(*args, **kwargs)
         except Exception as exception:
             return {'success': False, 'exception': str(exception), 'stacktrace': traceback.format_exc()}
+        if isinstance(response, types.GeneratorType) or hasattr(response, 'read'):
+            # The body is streamed once the response is sent
+            return {'success': True, 'stream': True, 'stream_body': response}
+        return {'success': True, 'response': response}
+
+    def _send_stream(self, cid, body):
+        sender = IPCStreamSender(cid, IO._write)
+        self._stream_senders[cid] = sender
+        try:
+            sender.send(body)
+        except Exception as exception:
+            IO._log_exception('stream', exception)
+        finally:
+            self._stream_senders.pop(cid, None)
 
     def _handle_remove_callback(self):
         for method in get_special_methods(self._plugin, 'on_remove'):
@@ -261,14 +350,49 @@ class PluginRuntime:
                 IO._log_exception('on remove', exception)
 
 
+class ApiChannel(object):
+    """ Executes gateway API calls over the IPC pipe, instead of over HTTP """
+
+    def __init__(self, timeout=30.0):
+        self._timeout = timeout
+        self._lock = Lock()
+        self._call_id = 0
+        self._response_queues = {}
+
+    def call(self, name, parameters):
+        with self._lock:
+            self._call_id += 1
+            call_id = self._call_id
+        response_queue = Queue(1)
+        self._response_queues[call_id] = response_queue
+        try:
+            IO._write({'cid': 0,
+                       'action': 'api_call',
+                       'call_id': call_id,
+                       'name': name,
+                       'parameters': parameters})
+            return response_queue.get(block=True, timeout=self._timeout)['data']
+        except Empty:
+            raise RuntimeError('No response within {0}s ({1})'.format(self._timeout, name))
+        finally:
+            self._response_queues.pop(call_id, None)
+
+    def process_response(self, response):
+        response_queue = self._response_queues.get(response['call_id'])
+        if response_queue is not None:
+            response_queue.put(response)
+
+
 class IO(object):
+    _write_lock = Lock()
+
     @staticmethod
-    def _log(msg):
-        IO._write({'cid': 0, 'action': 'logs', 'logs': str(msg)})
+    def _log(msg, level='INFO'):
+        IO._write({'cid': 0, 'action': 'logs', 'logs': str(msg), 'level': level})
 
     @staticmethod
     def _log_exception(name, exception):
-        IO._log('Exception ({0}) in {1}: {2}'.format(exception, name, traceback.format_exc()))
+        IO._log('Exception ({0}) in {1}: {2}'.format(exception, name, traceback.format_exc()), level='ERROR')
 
     @staticmethod
     def _with_catch(name, target, args):
@@ -280,23 +404,30 @@ class IO(object):
 
     @staticmethod
     def _write(msg):
-        sys.stdout.write(PluginIPCStream.write(msg))
-        sys.stdout.flush()
+        data = PluginIPCStream.write(msg)
+        with IO._write_lock:
+            sys.stdout.write(data)
+            sys.stdout.flush()
 
 
-if __name__ == '__main__':
-    if len(sys.argv) < 3 or sys.argv[1] != 'start':
-        sys.stderr.write('Usage: python {0} start <path>\n'.format(sys.argv[0]))
-        sys.stderr.flush()
-        sys.exit(1)
-
+def run(path, gateway_pid=None):
+    """
+    Runs the runtime for the plugin at the given path, until the plugin is stopped. Never returns.
+    The gateway_pid is given when the runtime isn't a direct child of the gateway.
+    """
     def watch_parent():
         parent = os.getppid()
         # If the parent process gets kills, this process will be attached to init.
         # In that case the plugin should stop running.
         while True:
-            if os.getppid() != parent:
-                os._exit(1)
+            if gateway_pid is None:
+                if os.getppid() != parent:
+                    os._exit(1)
+            else:
+                try:
+                    os.kill(gateway_pid, 0)
+                except OSError:
+                    os._exit(1)
             time.sleep(1)
 
     # Keep an eye on our parent process
@@ -306,10 +437,19 @@ if __name__ == '__main__':
 
     # Start the runtime
     try:
-        runtime = PluginRuntime(path=sys.argv[2])
+        runtime = PluginRuntime(path=path)
         runtime.process_stdin()
     except BaseException as ex:
         IO._log_exception('__main__', ex)
         os._exit(1)
 
     os._exit(0)
+
+
+if __name__ == '__main__':
+    if len(sys.argv) < 3 or sys.argv[1] != 'start':
+        sys.stderr.write('Usage: python {0} start <path>\n'.format(sys.argv[0]))
+        sys.stderr.flush()
+        sys.exit(1)
+
+    run(sys.argv[2])
@@ -1,4 +1,3 @@
-import re
 import requests
 
 try:
@@ -8,41 +7,31 @@ except ImportError:
     import json  # type: ignore
 
 
-def _load_webinterface():
-    """
-    This method parses the webinterface sourcecode and parses all API calls that are available to the plugins.
-    It uses this method to prevent the runtime from having to load the file and its dependencies.
-    """
-    import gateway
-    def_regex = re.compile(r'^\s*?def ([^(]+)\((.*?)\):\s*$')
-    with open('{0}/webservice.py'.format(gateway.__path__[0]), 'r') as source:
-        contents = source.readlines()
-    calls = {}
-    found_call = False
-    for line in contents:
-        if found_call is True:
-            # This line is a call definition and needs to be parsed/loaded
-            match = def_regex.match(line)
-            if match is not None:
-                groups = match.groups()
-                calls[groups[0]] = [argument.split('=')[0] for argument in groups[1].split(', ')
-                                    if argument != 'self']
-            found_call = False
-        elif '@openmotics_api' in line and 'plugin_exposed=False' not in line:
-            # This line is decorated, the next one is a call definition
-            found_call = True
-    return calls
-
-
 class WebInterfaceDispatcher(object):
     # TODO: Use SDK in the future
 
-    def __init__(self, logger, hostname='localhost', port=80):
+    API_MANIFEST_VERSION = 1
+
+    def __init__(self, logger, hostname='localhost', port=80, api_channel=None):
         self.__logger = logger
         self.__hostname = hostname
         self.__port = port
+        self.__api_channel = api_channel
         self.__warned = False
-        self.__available_calls = _load_webinterface()
+        self.__available_calls = {}
+
+    def set_api_manifest(self, api_manifest):
+        """
+        Loads the API calls that are available to the plugins from the manifest that is
+        generated by the gateway, so the runtime does not need to load the gateway sources.
+        """
+        if api_manifest is None:
+            self.__logger('[W] No API manifest available, API calls are disabled')
+            return
+        if api_manifest.get('version') != WebInterfaceDispatcher.API_MANIFEST_VERSION:
+            self.__logger('[W] Unsupported API manifest version: {0}'.format(api_manifest.get('version')))
+            return
+        self.__available_calls = api_manifest['calls']
 
     def __getattr__(self, attribute):
         if attribute in self.__available_calls:
@@ -78,8 +67,10 @@ class WebInterfaceDispatcher(object):
             for arg in kwargs:
                 if kwargs[arg] is None:
                     kwargs[arg] = 'None'
-            # 4. Perform the http call
+            # 4. Perform the call, over the api channel if available
             try:
+                if self.__api_channel is not None:
+                    return json.dumps(self.__api_channel.call(name, kwargs))
                 response = requests.get('http://{0}:{1}/{2}'.format(self.__hostname, self.__port, name),
                                         params=kwargs,
                                         timeout=30.0)
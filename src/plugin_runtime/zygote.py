@@ -0,0 +1,153 @@
+"""
+The zygote preloads the plugin runtime once and forks a new runtime for every plugin, so
+plugins don't need to wait for a fresh interpreter to import the runtime and its dependencies.
+
+Communication with the gateway uses the same length-prefixed msgpack framing as the runtime,
+over the stdin/stdout of the zygote:
+* {'action': 'fork', 'id': <id>, 'path': <plugin path>, 'stdin': <fifo>, 'stdout': <fifo>}
+  is answered by {'action': 'forked', 'id': <id>, 'pid': <pid>}
+* {'action': 'usage', 'id': <id>, 'pid': <pid>}
+  is answered by {'action': 'usage', 'id': <id>, 'usage': {'cpu_time': <seconds>, 'rss': <bytes>} or None}
+* {'action': 'exited', 'pid': <pid>, 'exit_code': <exit code>} is sent when a runtime exits
+
+The forked runtime uses the given fifos as its stdin and stdout.
+"""
+
+import errno
+import os
+import sys
+import traceback
+from select import select, error as SelectError
+
+import msgpack
+import psutil
+
+import runtime  # Preloads the runtime and all its dependencies
+from toolbox import PluginIPCStream
+
+
+class Zygote(object):
+
+    def __init__(self):
+        self._stdin_fd = sys.stdin.fileno()
+        self._stdout = sys.stdout
+        self._children = set()
+        self._gateway_pid = os.getppid()
+
+    def run(self):
+        self._write({'action': 'ready'})
+        while True:
+            # If the gateway is gone, this process is attached to init. The runtimes keep an
+            # eye on the gateway themselves, so they can outlive a crashing zygote.
+            if os.getppid() != self._gateway_pid:
+                os._exit(1)
+            self._reap_children()
+            try:
+                read_available, _, _ = select([self._stdin_fd], [], [], 0.5)
+            except SelectError as ex:
+                if ex.args[0] == errno.EINTR:
+                    continue
+                raise
+            if not read_available:
+                continue
+            command = self._read()
+            if command is None:
+                os._exit(0)  # The gateway closed the pipe
+            if command.get('action') == 'fork':
+                self._fork(command)
+            elif command.get('action') == 'usage':
+                self._usage(command)
+
+    def _fork(self, command):
+        try:
+            pid = os.fork()
+        except OSError as ex:
+            self._write({'action': 'forked',
+                         'id': command['id'],
+                         'pid': None,
+                         'error': str(ex)})
+            return
+        if pid == 0:
+            try:
+                self._start_runtime(command['path'], command['stdin'], command['stdout'])
+            except BaseException:
+                sys.stderr.write(traceback.format_exc())
+            os._exit(1)
+        self._children.add(pid)
+        self._write({'action': 'forked',
+                     'id': command['id'],
+                     'pid': pid})
+
+    def _usage(self, command):
+        """ Samples a runtime. As long as it's not reaped, its pid can't be reused by another process """
+        usage = None
+        if command['pid'] in self._children:
+            try:
+                process = psutil.Process(command['pid'])
+                cpu_times = process.cpu_times()
+                usage = {'cpu_time': cpu_times.user + cpu_times.system,
+                         'rss': process.memory_info().rss}
+            except psutil.Error:
+                pass
+        self._write({'action': 'usage',
+                     'id': command['id'],
+                     'usage': usage})
+
+    def _start_runtime(self, path, stdin_fifo, stdout_fifo):
+        """ Turns the forked process into a plugin runtime. Executed in the child process. """
+        # The gateway opened the stdout fifo for reading before requesting the fork, and keeps
+        # trying to open the stdin fifo for writing until it is opened for reading here.
+        stdout_fd = os.open(stdout_fifo, os.O_WRONLY)
+        stdin_fd = os.open(stdin_fifo, os.O_RDONLY)
+        os.dup2(stdin_fd, 0)
+        os.dup2(stdout_fd, 1)
+        os.close(stdin_fd)
+        os.close(stdout_fd)
+        sys.stdin = os.fdopen(0, 'r', 0)
+        sys.stdout = os.fdopen(1, 'w')
+        runtime.run(path, gateway_pid=self._gateway_pid)
+
+    def _reap_children(self):
+        for pid in list(self._children):
+            try:
+                waited_pid, status = os.waitpid(pid, os.WNOHANG)
+            except OSError:
+                waited_pid, status = pid, 0
+            if waited_pid == 0:
+                continue
+            self._children.discard(pid)
+            exit_code = -os.WTERMSIG(status) if os.WIFSIGNALED(status) else os.WEXITSTATUS(status)
+            self._write({'action': 'exited',
+                         'pid': pid,
+                         'exit_code': exit_code})
+
+    def _read(self):
+        """ Reads a single message """
+        header = self._read_bytes(PluginIPCStream.HEADER.size)
+        if header is None:
+            return None
+        data = self._read_bytes(PluginIPCStream.HEADER.unpack(header)[0])
+        if data is None:
+            return None
+        return msgpack.loads(data)
+
+    def _read_bytes(self, length):
+        data = ''
+        while len(data) < length:
+            chunk = os.read(self._stdin_fd, length - len(data))
+            if chunk == '':
+                return None
+            data += chunk
+        return data
+
+    def _write(self, message):
+        self._stdout.write(PluginIPCStream.write(message))
+        self._stdout.flush()
+
+
+if __name__ == '__main__':
+    try:
+        Zygote().run()
+    except BaseException:
+        sys.stderr.write(traceback.format_exc())
+        os._exit(1)
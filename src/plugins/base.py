@@ -17,11 +17,14 @@
 import logging
 import os
 import pkgutil
+import time
 import traceback
+from Queue import Queue, Empty
+from threading import Lock, Timer
 from gateway.observer import Event
-from datetime import datetime
 from ioc import Injectable, Inject, INJECTED, Singleton
-from plugins.runner import PluginRunner
+from plugins.logs import PluginLog
+from plugins.runner import PluginRunner, PluginZygote, RunnerWatchdog
 
 logger = logging.getLogger("openmotics")
 
@@ -31,6 +34,9 @@ logger = logging.getLogger("openmotics")
 class PluginController(object):
     """ The controller keeps track of all plugins in the system. """
 
+    OUTPUT_STATUS_WINDOW = 0.1
+    LOG_PERSIST_DELAY = 60
+
     @Inject
     def __init__(self,
                  web_interface=INJECTED, configuration_controller=INJECTED, observer=INJECTED,
@@ -48,12 +54,20 @@ class PluginController(object):
         self.__observer = observer
 
         self.__stopped = True
-        self.__logs = {}
+        self.__logs = {}  # name -> PluginLog
+        self.__log_lock = Lock()
+        self.__log_timer = None
         self.__runners = {}
+        self.__watchdogs = {}  # name -> RunnerWatchdog, of the runners that should be running
 
         self.__metrics_controller = None
         self.__metrics_collector = None
         self.__web_service = None
+        self.__zygote = PluginZygote(runtime_path)
+        self.__collected_metrics = Queue()
+        self.__output_lock = Lock()
+        self.__output_changes = set()
+        self.__output_timer = None
 
     def start(self):
         """ Start the plugins and expose them via the webinterface. """
@@ -66,6 +80,11 @@ class PluginController(object):
     def stop(self):
         for runner_name in self.__runners.keys():
             self.__destroy_plugin_runner(runner_name)
+        with self.__log_lock:
+            if self.__log_timer is not None:
+                self.__log_timer.cancel()
+                self.__log_timer = None
+        self.__zygote.stop()
         self.__stopped = True
 
     def set_metrics_controller(self, metrics_controller):
@@ -102,17 +121,43 @@ class PluginController(object):
                 return
             _logger = self.get_logger(plugin_name)
             plugin_path = os.path.join(self.__plugins_path, plugin_name)
-            runner = PluginRunner(plugin_name, self.__runtime_path, plugin_path, _logger)
+            runner = PluginRunner(plugin_name, self.__runtime_path, plugin_path, _logger,
+                                  web_interface=self.__webinterface, zygote=self.__zygote)
+            runner.set_limits(**self.__get_resource_limits(plugin_name))
             self.__runners[runner.name] = runner
             return runner
         except Exception as exception:
             self.log(plugin_name, '[Runner] Could not initialize plugin', exception)
 
+    def __get_resource_limits(self, plugin_name):
+        """
+        Loads the soft resource limits of a plugin. A plugin specific value (e.g. `plugin_limit_rss|Foo`)
+        takes precedence over the general value (e.g. `plugin_limit_rss`).
+        """
+        limits = {}
+        if self.__config_controller is None:
+            return limits
+        for key in ['cpu_percent', 'rss']:
+            setting = 'plugin_limit_{0}'.format(key)
+            value = self.__config_controller.get_setting(setting, None)
+            value = self.__config_controller.get_setting('{0}|{1}'.format(setting, plugin_name), value)
+            if value is not None:
+                limits[key] = float(value)
+        return limits
+
+    def get_resource_usage(self):
+        """ Returns the resource usage of all running plugins """
+        return dict((runner.name, runner.get_resource_usage()) for runner in self.__iter_running_runners())
+
     def __start_plugin_runner(self, runner, runner_name, update_dependencies):
         """ Starts a single plugin runner """
         try:
             logger.info('Plugin {0}: {1}'.format(runner_name, 'Starting...'))
             runner.start()
+            if runner_name not in self.__watchdogs:
+                watchdog = RunnerWatchdog(runner)
+                watchdog.start()
+                self.__watchdogs[runner_name] = watchdog
             if update_dependencies:
                 self.__update_dependencies()
             logger.info('Plugin {0}: {1}'.format(runner_name, 'Starting... Done'))
@@ -139,6 +184,9 @@ class PluginController(object):
             return
         try:
             logger.info('Plugin {0}: {1}'.format(runner.name, 'Stopping...'))
+            watchdog = self.__watchdogs.pop(runner_name, None)
+            if watchdog is not None:
+                watchdog.stop()
             runner.stop()
             if update_dependencies:
                 self.__update_dependencies()
@@ -157,13 +205,15 @@ class PluginController(object):
     def __destroy_plugin_runner(self, runner_name):
         """ Removes a runner """
         self.__stop_plugin_runner(runner_name, False)
-        self.__logs.pop(runner_name, None)
+        plugin_log = self.__logs.pop(runner_name, None)
+        if plugin_log is not None and plugin_log.dirty:
+            plugin_log.persist()
         self.__runners.pop(runner_name, None)
 
     def __update_dependencies(self):
         """ When a runner is added/removed, this call updates all code that needs to know about plugins """
         if self.__webinterface is not None and self.__web_service is not None:
-            self.__web_service.update_tree(self.__get_cherrypy_mounts())
+            self.__update_cherrypy_mounts()
         if self.__metrics_collector is not None:
             self.__metrics_collector.set_plugin_intervals(self.__get_metric_receivers())
         if self.__metrics_controller is not None:
@@ -224,7 +274,7 @@ class PluginController(object):
             runner.start()
             runner.stop()
             name, version = runner.name, runner.version
-            self.__logs.pop('new_pacakge', None)
+            self.__logs.pop('new_package', None)
 
             def parse_version(version_string):
                 """ Parse the version from a string "x.y.z" to a tuple(x, y, z). """
@@ -301,6 +351,9 @@ class PluginController(object):
         conf_file = '{0}/pi_{1}.conf'.format(self.__plugin_config_path, name)
         if os.path.exists(conf_file):
             os.remove(conf_file)
+        log_file = '{0}/pi_{1}.log'.format(self.__plugin_config_path, name)
+        if os.path.exists(log_file):
+            os.remove(log_file)
 
         return {'msg': 'Plugin successfully removed'}
 
@@ -319,12 +372,33 @@ class PluginController(object):
             for runner in self.__iter_running_runners():
                 runner.process_input_status(event)
         if event.type == Event.Types.OUTPUT_CHANGE:
-            # TODO: Implement versioning so a plugin can also receive "normal" events on version 2
-            # Should be called when the output status changes, notifies all plugins.
-            states = [(output['id'], output['dimmer']) for output in self.__observer.get_outputs()
+            # Changes within a short window are delivered at once, so e.g. a group action
+            # doesn't result in a delivery of all output states per changed output.
+            with self.__output_lock:
+                self.__output_changes.add(event.data['id'])
+                if self.__output_timer is None:
+                    self.__output_timer = Timer(PluginController.OUTPUT_STATUS_WINDOW, self.__process_output_changes)
+                    self.__output_timer.daemon = True
+                    self.__output_timer.start()
+
+    def __process_output_changes(self):
+        """ Notifies all plugins about the output changes since the last notification """
+        with self.__output_lock:
+            output_ids = self.__output_changes
+            self.__output_changes = set()
+            self.__output_timer = None
+        try:
+            outputs = self.__observer.get_outputs()
+            states = [(output['id'], output['dimmer']) for output in outputs
                       if output['status'] == 1]
+            changes = [{'id': output['id'],
+                        'status': output['status'] == 1,
+                        'dimmer': output['dimmer']} for output in outputs
+                       if output['id'] in output_ids]
             for runner in self.__iter_running_runners():
-                runner.process_output_status(states)
+                runner.process_output_status(states, changes)
+        except Exception as exception:
+            logger.exception('Could not process output changes: {0}'.format(exception))
 
     def process_shutter_status(self, shutter_status_inst):
         """ Should be called when the shutter status changes, notifies all plugins. """
@@ -342,14 +416,32 @@ class PluginController(object):
         if runner is not None:
             return runner.request(method, args=args, kwargs=kwargs)
 
-    def collect_metrics(self):
-        """ Collects all metrics from all plugins """
+    def collect_metrics(self, timeout=1.0):
+        """
+        Collects all metrics from all plugins. The due collectors of all plugins run in parallel. Metrics
+        of collectors that don't finish within the timeout are carried over to a subsequent call.
+        """
+        deadline = time.time() + timeout
+        jobs = set()
         for runner in self.__iter_running_runners():
-            for metric in runner.collect_metrics():
-                if metric is None:
-                    continue
+            jobs.update(runner.start_metric_collection(self.__collected_metrics, deadline))
+        while True:
+            remaining = deadline - time.time()
+            try:
+                if len(jobs) > 0 and remaining > 0:
+                    job, metric = self.__collected_metrics.get(timeout=remaining)
                 else:
-                    yield metric
+                    job, metric = self.__collected_metrics.get_nowait()
+            except Empty:
+                return
+            if metric is None:
+                jobs.discard(job)
+            else:
+                yield metric
+
+    def get_collector_statistics(self):
+        """ Returns the metric collector statistics of all plugins """
+        return dict((runner.name, runner.get_collector_statistics()) for runner in self.get_plugins())
 
     def distribute_metrics(self, metrics):
         """ Enqueues all metrics in a separate queue per plugin """
@@ -378,16 +470,16 @@ class PluginController(object):
                     self.log(runner.name, 'Exception while distributing metrics', ex, traceback.format_exc())
         return rates
 
-    def __get_cherrypy_mounts(self):
-        mounts = []
-        cors_enabled = self.__config_controller.get_setting('cors_enabled', False)
-        for runner in self.__iter_running_runners():
-            mounts.append({'root': runner.get_webservice(self.__webinterface),
-                           'script_name': '/plugins/{0}'.format(runner.name),
-                           'config': {'/': {'tools.sessions.on': False,
-                                            'tools.trailing_slash.on': False,
-                                            'tools.cors.on': cors_enabled}}})
-        return mounts
+    def __update_cherrypy_mounts(self):
+        """ Attaches the web services of running plugins and detaches those of stopped/removed plugins """
+        runners = dict((runner.name, runner) for runner in self.__iter_running_runners())
+        mounts = self.__web_service.get_plugin_mounts()
+        for name in mounts:
+            if name not in runners:
+                self.__web_service.unmount_plugin(name)
+        for name, runner in runners.iteritems():
+            if name not in mounts:
+                self.__web_service.mount_plugin(name, runner.get_webservice(self.__webinterface))
 
     def __get_metric_receivers(self):
         receivers = []
@@ -402,32 +494,63 @@ class PluginController(object):
             definitions[runner.name] = runner.get_metric_definitions()
         return definitions
 
+    def __get_log(self, plugin_name):
+        plugin_log = self.__logs.get(plugin_name)
+        if plugin_log is None:
+            with self.__log_lock:
+                plugin_log = self.__logs.get(plugin_name)
+                if plugin_log is None:
+                    log_file = '{0}/pi_{1}.log'.format(self.__plugin_config_path, plugin_name)
+                    plugin_log = PluginLog(log_file)
+                    self.__logs[plugin_name] = plugin_log
+        return plugin_log
+
+    def __append_log(self, plugin_name, message, level):
+        self.__get_log(plugin_name).append(message, level)
+        with self.__log_lock:
+            if self.__log_timer is None:
+                self.__log_timer = Timer(PluginController.LOG_PERSIST_DELAY, self.__persist_logs)
+                self.__log_timer.daemon = True
+                self.__log_timer.start()
+
+    def __persist_logs(self):
+        """ Persists the changed logs of the installed plugins """
+        with self.__log_lock:
+            self.__log_timer = None
+        for plugin_name, plugin_log in self.__logs.items():
+            if plugin_log.dirty and plugin_name in self.__runners:
+                plugin_log.persist()
+
     def log(self, plugin, msg, exception, stacktrace=None):
         """ Append an exception to the log for the plugins. This log can be retrieved using get_logs. """
-        if plugin not in self.__logs:
-            self.__logs[plugin] = []
-
         logger.error('Plugin {0}: {1} ({2})'.format(plugin, msg, exception))
         if stacktrace is None:
-            self.__logs[plugin].append('{0} - {1}: {2}'.format(datetime.now(), msg, exception))
+            self.__append_log(plugin, '{0}: {1}'.format(msg, exception), 'ERROR')
         else:
-            self.__logs[plugin].append('{0} - {1}: {2}\n{3}'.format(datetime.now(), msg, exception, stacktrace))
-        if len(self.__logs[plugin]) > 100:
-            self.__logs[plugin].pop(0)
+            self.__append_log(plugin, '{0}: {1}\n{2}'.format(msg, exception, stacktrace), 'ERROR')
 
     def get_logger(self, plugin_name):
         """ Get a logger for a plugin. """
-        if plugin_name not in self.__logs:
-            self.__logs[plugin_name] = []
+        self.__get_log(plugin_name)
 
-        def log(msg):
+        def log(msg, level='INFO'):
             """ Log function for the given plugin."""
-            self.__logs[plugin_name].append('{0} - {1}'.format(datetime.now(), msg))
-            if len(self.__logs[plugin_name]) > 100:
-                self.__logs[plugin_name].pop(0)
+            self.__append_log(plugin_name, msg, level)
 
         return log
 
     def get_logs(self):
         """ Get the logs for all plugins. Returns a dict where the keys are the plugin names and the value is a string. """
-        return dict((plugin, '\n'.join(entries)) for plugin, entries in self.__logs.iteritems())
+        return dict((plugin, plugin_log.format()) for plugin, plugin_log in self.__logs.items())
+
+    def get_log_records(self, plugin_name, cursor=None, limit=None):
+        """
+        Get the log records of a plugin that were added after the given cursor. The returned cursor
+        can be used to fetch the next records.
+        """
+        plugin_log = self.__logs.get(plugin_name)
+        if plugin_log is None:
+            return {'records': [], 'cursor': cursor}
+        records = plugin_log.get_records(cursor=cursor, limit=limit)
+        return {'records': records,
+                'cursor': records[-1]['id'] if records else cursor}
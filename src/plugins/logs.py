@@ -0,0 +1,99 @@
+# Copyright (C) 2020 OpenMotics BV
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+""" The log of a plugin. """
+
+import logging
+import os
+import time
+import ujson as json
+from collections import deque
+from datetime import datetime
+from itertools import islice
+from threading import Lock
+
+logger = logging.getLogger("openmotics")
+
+
+class PluginLog(object):
+    """
+    A bounded log of structured records: {'id': <id>, 'timestamp': <timestamp>, 'level': <level>, 'message': <message>}
+    The ids are consecutive, and are used as cursor to fetch the records that were added since.
+    The log is persisted as json lines, so it survives a restart.
+    """
+
+    SIZE = 100
+
+    def __init__(self, path=None, size=SIZE):
+        self._path = path
+        self._records = deque(maxlen=size)
+        self._last_id = 0
+        self._lock = Lock()
+        self.dirty = False
+        self._load()
+
+    def append(self, message, level='INFO'):
+        with self._lock:
+            self._last_id += 1
+            self._records.append({'id': self._last_id,
+                                  'timestamp': time.time(),
+                                  'level': level,
+                                  'message': message})
+            self.dirty = True
+
+    def get_records(self, cursor=None, limit=None):
+        """ Returns the records added after the given cursor, oldest first """
+        with self._lock:
+            start = 0
+            if cursor is not None and self._records:
+                # The ids are consecutive, so the position of the cursor can be calculated
+                start = max(0, cursor - self._records[0]['id'] + 1)
+            records = list(islice(self._records, start, None))
+        if limit is not None:
+            records = records[:limit]
+        return records
+
+    def format(self):
+        """ Returns the records as text, a line per record """
+        return '\n'.join('{0} - {1}'.format(datetime.fromtimestamp(record['timestamp']), record['message'])
+                         for record in self.get_records())
+
+    def persist(self):
+        if self._path is None:
+            return
+        with self._lock:
+            records = list(self._records)
+            self.dirty = False
+        try:
+            temp_path = '{0}.tmp'.format(self._path)
+            with open(temp_path, 'w') as log_file:
+                for record in records:
+                    log_file.write(json.dumps(record))
+                    log_file.write('\n')
+            os.rename(temp_path, self._path)
+        except Exception as ex:
+            logger.error('Could not persist plugin log {0}: {1}'.format(self._path, ex))
+
+    def _load(self):
+        if self._path is None or not os.path.exists(self._path):
+            return
+        try:
+            with open(self._path) as log_file:
+                for line in log_file:
+                    if line.strip():
+                        self._records.append(json.loads(line))
+            if self._records:
+                self._last_id = self._records[-1]['id']
+        except Exception as ex:
+            logger.error('Could not load plugin log {0}: {1}'.format(self._path, ex))
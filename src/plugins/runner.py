@@ -1,23 +1,43 @@
 import cherrypy
+import errno
+import fcntl
 import logging
+import os
+import psutil
+import shutil
+import signal
 import subprocess
 import sys
+import tempfile
 import time
 import traceback
 import ujson as json
 from threading import Thread, Lock
 from Queue import Queue, Empty, Full
-from toolbox import PluginIPCStream
+from toolbox import PluginIPCStream, IPCStreamSender, IPCStreamReceiver, Histogram
 
 logger = logging.getLogger("openmotics")
 
 
+class PluginTimeoutException(Exception):
+    pass
+
+
 class PluginRunner:
 
-    def __init__(self, name, runtime_path, plugin_path, logger, command_timeout=5):
+    COMMAND_LATENCY_BUCKETS = [1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000]  # milliseconds
+    COLLECTOR_BUCKETS = [10, 20, 50, 100, 200, 500, 1000, 2000, 5000, 10000]  # milliseconds
+    RESOURCE_CHECK_INTERVAL = 10
+    API_CALL_WORKERS = 5
+    API_CALL_QUEUE_SIZE = 10
+    THROTTLE_DELAY = 0.5
+
+    def __init__(self, name, runtime_path, plugin_path, logger, command_timeout=5, web_interface=None, zygote=None):
         self.runtime_path = runtime_path
         self.plugin_path = plugin_path
         self.command_timeout = command_timeout
+        self._web_interface = web_interface
+        self._zygote = zygote
 
         self._logger = logger
         self._cid = 0
@@ -25,8 +45,10 @@ class PluginRunner:
         self._running = False
         self._process_running = False
         self._command_lock = Lock()
-        self._response_queue = Queue()
+        self._response_queues = {}  # cid -> Queue, for every outstanding command
         self._stream = None
+        self._stream_senders = {}  # cid -> IPCStreamSender, for request bodies sent to the plugin
+        self._stream_receivers = {}  # cid -> IPCStreamReceiver, for response bodies sent by the plugin
 
         self.name = name
         self.version = None
@@ -34,16 +56,31 @@ class PluginRunner:
 
         self._receivers = []
         self._exposes = []
+        self._routes = {}  # name -> exposed method
         self._metric_collectors = []
         self._metric_receivers = []
+        self._receiver_versions = {}
 
         self._async_command_thread = None
         self._async_command_queue = None
+        self._api_call_queue = None
 
         self._commands_executed = 0
         self._commands_failed = 0
 
         self.__collector_runs = {}
+        self.__collectors_busy = set()
+        self.startup_times = {}
+
+        self._statistics_lock = Lock()
+        self._bytes_written = 0
+        self._queue_drops = 0
+        self._command_latency = Histogram(PluginRunner.COMMAND_LATENCY_BUCKETS)
+        self._resources = {}
+        self._last_resource_sample = None  # (timestamp, cpu time)
+        self._limits = {}
+        self._throttle = None  # None, 'slow' or 'pause'
+        self._collector_statistics = {}
 
     def start(self):
         if self._running:
@@ -51,14 +88,28 @@ class PluginRunner:
 
         self.logger('[Runner] Starting')
 
-        python_executable = sys.executable
-        if python_executable is None or len(python_executable) == 0:
-            python_executable = '/usr/bin/python'
-
-        self._proc = subprocess.Popen([python_executable, "runtime.py", "start", self.plugin_path],
-                                      stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=None,
-                                      cwd=self.runtime_path)
+        start = time.time()
+        self._proc = None
+        if self._zygote is not None:
+            try:
+                self._proc = self._zygote.spawn(self.plugin_path)
+            except Exception as exception:
+                self.logger('[Runner] Could not fork from the zygote, starting a new process: {0}'.format(exception))
+        if self._proc is None:
+            self._proc = subprocess.Popen([get_python_executable(), "runtime.py", "start", self.plugin_path],
+                                          stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=None,
+                                          cwd=self.runtime_path)
+        spawned = time.time()
         self._process_running = True
+        self._start_api_call_workers()  # The plugin can already call the API while it's starting
+
+        with self._statistics_lock:
+            self._bytes_written = 0
+            self._queue_drops = 0
+            self._command_latency = Histogram(PluginRunner.COMMAND_LATENCY_BUCKETS)
+        self._resources = {}
+        self._last_resource_sample = None
+        self._throttle = None
 
         self._commands_executed = 0
         self._commands_failed = 0
@@ -68,15 +119,27 @@ class PluginRunner:
                                        command_receiver=self._process_command)
         self._stream.start()
 
-        start_out = self._do_command('start', timeout=180)
+        api_manifest = None
+        if self._web_interface is not None:
+            api_manifest = self._web_interface.get_plugin_api_manifest()
+        start_out = self._do_command('start', {'api_manifest': api_manifest}, timeout=180)
         self.name = start_out['name']
         self.version = start_out['version']
         self.interfaces = start_out['interfaces']
 
         self._receivers = start_out['receivers']
         self._exposes = start_out['exposes']
+        self._routes = dict((exposed['name'], exposed) for exposed in self._exposes)
         self._metric_collectors = start_out['metric_collectors']
         self._metric_receivers = start_out['metric_receivers']
+        self._receiver_versions = start_out.get('receiver_versions', {})
+
+        self.startup_times = {'spawn': spawned - start,
+                              'start': time.time() - spawned,
+                              'zygote': isinstance(self._proc, ZygoteProcess)}
+        self.logger('[Runner] Started in {0:.2f}s (spawn: {1:.2f}s, start: {2:.2f}s, zygote: {3})'.format(
+            time.time() - start, self.startup_times['spawn'], self.startup_times['start'], self.startup_times['zygote']
+        ))
 
         exception = start_out.get('exception')
         if exception is not None:
@@ -90,9 +153,10 @@ class PluginRunner:
 
         self._running = True
 
-    def logger(self, message):
-        self._logger(message)
-        logger.info('Plugin {0} - {1}'.format(self.name, message))
+    def logger(self, message, level='INFO'):
+        self._logger(message, level)
+        logger.log(logging.ERROR if level == 'ERROR' else logging.INFO,
+                   'Plugin {0} - {1}'.format(self.name, message))
 
     def get_webservice(self, webinterface):
         class Service:
@@ -103,21 +167,35 @@ class PluginRunner:
 
             def _cp_dispatch(self, vpath):
                 method = vpath.pop()
-                for exposed in self.runner._exposes:
-                    if exposed['name'] == method:
-                        cherrypy.request.params['method'] = method
-                        cherrypy.response.headers['Content-Type'] = exposed['content_type']
-                        if exposed['auth'] is True:
-                            cherrypy.request.hooks.attach('before_handler',
-                                                          cherrypy.tools.authenticated.callable)
-                        return self
-
-                return None
+                exposed = self.runner._routes.get(method)
+                if exposed is None:
+                    return None
+                cherrypy.request.params['method'] = method
+                cherrypy.response.headers['Content-Type'] = exposed['content_type']
+                if exposed['auth'] is True:
+                    cherrypy.request.hooks.attach('before_handler',
+                                                  cherrypy.tools.authenticated.callable)
+                if exposed.get('stream_body') is True:
+                    # Leave the body unread, it's streamed to the plugin
+                    cherrypy.request.hooks.attach('before_request_body', Service._skip_body_processors)
+                return self
+
+            @staticmethod
+            def _skip_body_processors():
+                cherrypy.serving.request.body.processors = {}
 
             @cherrypy.expose
             def index(self, method, *args, **kwargs):
                 try:
-                    return self.runner.request(method, args=args, kwargs=kwargs)
+                    body = None
+                    if self.runner._routes[method].get('stream_body') is True:
+                        request = cherrypy.request
+                        body = request.body if request.process_request_body else ''
+                    response = self.runner.request(method, args=args, kwargs=kwargs, body=body)
+                    if isinstance(response, IPCStreamReceiver):
+                        cherrypy.response.stream = True
+                        return iter(response)
+                    return response
                 except Exception as ex:
                     cherrypy.response.headers["Content-Type"] = "application/json"
                     cherrypy.response.status = 500
@@ -126,10 +204,14 @@ class PluginRunner:
         return Service(self)
 
     def is_running(self):
+        if self._running and self._proc.poll() is not None:
+            # E.g. lost together with its zygote, without ever closing the IPC stream
+            self._set_exited()
         return self._running
 
     def stop(self):
-        if self._process_running:
+        # The process might already be gone, e.g. together with its zygote, the runner is stopped nonetheless
+        if self._running or self._process_running:
             self._running = False
 
             self.logger('[Runner] Sending stop command')
@@ -141,6 +223,11 @@ class PluginRunner:
 
             self._stream.stop()
             self._process_running = False
+            for receiver in self._stream_receivers.values():
+                receiver.process_message({'action': 'stream_end', 'error': 'Plugin was stopped'})
+            self._stream_receivers = {}
+            for sender in self._stream_senders.values():
+                sender.cancel()
 
             if self._proc.poll() is None:
                 self.logger('[Runner] Terminating process')
@@ -161,8 +248,15 @@ class PluginRunner:
         event_json = input_event.serialize()
         self._do_async('input_status', {'event': event_json}, should_filter=True)
 
-    def process_output_status(self, status):
-        self._do_async('output_status', {'status': status}, should_filter=True)
+    def process_output_status(self, status, changes=None):
+        # Only send the formats the receivers of the plugin are interested in
+        versions = self._receiver_versions.get('output_status', [1])
+        fields = {}
+        if 1 in versions:
+            fields['status'] = status
+        if 2 in versions and changes is not None:
+            fields['changes'] = changes
+        self._do_async('output_status', fields, should_filter=True)
 
     def process_shutter_status(self, status):
         self._do_async('shutter_status', status, should_filter=True)
@@ -170,22 +264,89 @@ class PluginRunner:
     def process_event(self, code):
         self._do_async('receive_events', {'code': code}, should_filter=True)
 
-    def collect_metrics(self):
+    def start_metric_collection(self, metrics_queue, deadline):
+        """
+        Starts all due metric collectors, each in a separate thread. The collected metrics are put on
+        the queue as (job, metric) tuples, followed by a (job, None) tuple once the collector is done.
+        A collector that is still busy (e.g. from a previous cycle) is not started again.
+
+        :param deadline: Timestamp at which the collection cycle ends, later results are counted as late
+        :returns: The started jobs
+        """
+        jobs = []
+        now = time.time()
         for mc in self._metric_collectors:
-            try:
-                now = time.time()
-                (name, interval) = (mc['name'], mc['interval'])
-
-                if self.__collector_runs.get(name, 0) < now - interval:
-                    self.__collector_runs[name] = now
-                    metrics = self._do_command('collect_metrics', {'name': name})['metrics']
-                    for metric in metrics:
-                        if metric is None:
-                            continue
-                        metric['source'] = self.name
-                        yield metric
-            except Exception as exception:
-                self.logger('[Runner] Exception while collecting metrics {0}: {1}'.format(exception, traceback.format_exc()))
+            (name, interval) = (mc['name'], mc['interval'])
+            if name in self.__collectors_busy or self.__collector_runs.get(name, 0) >= now - interval:
+                continue
+            last_run = self.__collector_runs.get(name)
+            skew = 0 if last_run is None else now - (last_run + interval)
+            self.__collector_runs[name] = now
+            self.__collectors_busy.add(name)
+            job = (self.name, name, now)
+            thread = Thread(target=self._collect_metrics, args=(job, name, skew, metrics_queue, deadline),
+                            name='PluginRunner {0} collector {1}'.format(self.plugin_path, name))
+            thread.daemon = True
+            thread.start()
+            jobs.append(job)
+        return jobs
+
+    def _collect_metrics(self, job, name, skew, metrics_queue, deadline):
+        start = time.time()
+        outcome = None
+        try:
+            metrics = self._do_command('collect_metrics', {'name': name})['metrics']
+            for metric in metrics:
+                if metric is None:
+                    continue
+                metric['source'] = self.name
+                metrics_queue.put((job, metric))
+        except PluginTimeoutException:
+            outcome = 'timeouts'
+        except Exception as exception:
+            outcome = 'errors'
+            self.logger('[Runner] Exception while collecting metrics {0}: {1}'.format(exception, traceback.format_exc()))
+        finally:
+            end = time.time()
+            with self._statistics_lock:
+                statistics = self._collector_statistics.get(name)
+                if statistics is None:
+                    statistics = {'runs': 0,
+                                  'errors': 0,
+                                  'timeouts': 0,
+                                  'late': 0,
+                                  'skew': Histogram(PluginRunner.COLLECTOR_BUCKETS),
+                                  'duration': Histogram(PluginRunner.COLLECTOR_BUCKETS)}
+                    self._collector_statistics[name] = statistics
+                statistics['runs'] += 1
+                if outcome is not None:
+                    statistics[outcome] += 1
+                if end > deadline:
+                    statistics['late'] += 1
+                statistics['skew'].add(skew * 1000.0)
+                statistics['duration'].add((end - start) * 1000.0)
+            metrics_queue.put((job, None))
+            self.__collectors_busy.discard(name)
+
+    def get_collector_statistics(self):
+        """
+        Returns per metric collector the amount of runs, errors, timeouts and results that arrived after
+        the collection deadline, and the skew (start delay) and duration in milliseconds
+        """
+        data = {}
+        with self._statistics_lock:
+            for name, statistics in self._collector_statistics.iteritems():
+                skew, duration = statistics['skew'], statistics['duration']
+                data[name] = {'runs': statistics['runs'],
+                              'errors': statistics['errors'],
+                              'timeouts': statistics['timeouts'],
+                              'late': statistics['late'],
+                              'skew_avg': skew.average,
+                              'skew_max': skew.max,
+                              'duration_avg': duration.average,
+                              'duration_p95': duration.percentile(95),
+                              'duration_max': duration.max}
+        return data
 
     def get_metric_receivers(self):
         return self._metric_receivers
@@ -197,65 +358,156 @@ class PluginRunner:
     def get_metric_definitions(self):
         return self._do_command('get_metric_definitions')['metric_definitions']
 
-    def request(self, method, args=None, kwargs=None):
+    def request(self, method, args=None, kwargs=None, body=None):
+        """
+        Executes an exposed method of the plugin. The body (a string, an iterable of strings or a
+        file-like object) is streamed to the plugin. A streamed response is returned as an
+        IPCStreamReceiver.
+        """
         if args is None:
             args = []
         if kwargs is None:
             kwargs = {}
         ret = self._do_command('request', {'method': method,
                                            'args': args,
-                                           'kwargs': kwargs})
+                                           'kwargs': kwargs}, body=body)
         if ret['success']:
+            if ret.get('stream') is True:
+                return ret['_stream']
             return ret['response']
         else:
             raise Exception('{0}: {1}'.format(ret['exception'], ret['stacktrace']))
 
+    def _set_exited(self):
+        self.logger('[Runner] Stopped with exit code {0}'.format(self._proc.poll()))
+        self._process_running = False
+        self._running = False  # Picked up by the watchdog, which starts it again
+
     def remove_callback(self):
         self._do_command('remove_callback')
 
     def _process_command(self, response):
         if not self._process_running:
             return
-        exit_code = self._proc.poll()
-        if exit_code is not None:
-            self.logger('[Runner] Stopped with exit code {0}'.format(exit_code))
-            self._process_running = False
+        if self._proc.poll() is not None:
+            self._set_exited()
             return
 
         if response['cid'] == 0:
             self._handle_async_response(response)
-        elif response['cid'] == self._cid:
-            self._response_queue.put(response)
+            return
+        response_queue = self._response_queues.get(response['cid'])
+        if response_queue is not None:
+            if response.get('stream') is True:
+                # Registered before the response is handed over, as the chunks follow right after it
+                receiver = IPCStreamReceiver(response['cid'], self._write)
+                self._stream_receivers[response['cid']] = receiver
+                response['_stream'] = receiver
+            response_queue.put(response)
         else:
             self.logger('[Runner] Received message with unknown cid: {0}'.format(response))
 
     def _handle_async_response(self, response):
         if response['action'] == 'logs':
-            self.logger(response['logs'])
+            self.logger(response['logs'], response.get('level', 'INFO'))
+        elif response['action'] == 'api_call':
+            # Executed by the api call workers, as the call might take a while and might even result
+            # in commands to this plugin (e.g. events), which need this thread to process the responses.
+            try:
+                self._api_call_queue.put(response, block=False)
+            except Full:
+                self._send_api_response(response, {'success': False, 'msg': 'Call temporarily unavailable'})
+        elif response['action'] in ['stream_chunk', 'stream_end']:
+            receiver = self._stream_receivers.get(response['stream_id'])
+            if receiver is not None:
+                receiver.process_message(response)
+                if response['action'] == 'stream_end':
+                    self._stream_receivers.pop(response['stream_id'], None)
+        elif response['action'] in ['stream_ack', 'stream_cancel']:
+            # Acknowledgements can arrive after the stream ended
+            sender = self._stream_senders.get(response['stream_id'])
+            if sender is not None:
+                if response['action'] == 'stream_ack':
+                    sender.ack()
+                else:
+                    sender.cancel()
         else:
             self.logger('[Runner] Unkown async message: {0}'.format(response))
 
+    def _start_api_call_workers(self):
+        self._api_call_queue = Queue(PluginRunner.API_CALL_QUEUE_SIZE)
+        for i in xrange(PluginRunner.API_CALL_WORKERS):
+            thread = Thread(target=self._process_api_calls, args=(self._api_call_queue,),
+                            name='PluginRunner {0} api call worker {1}'.format(self.plugin_path, i))
+            thread.daemon = True
+            thread.start()
+
+    def _process_api_calls(self, api_call_queue):
+        # Workers of a previous start stop as soon as the queue is replaced
+        while self._process_running and self._api_call_queue is api_call_queue:
+            try:
+                call = api_call_queue.get(block=True, timeout=10)
+            except Empty:
+                continue
+            self._handle_api_call(call)
+
+    def _handle_api_call(self, call):
+        """ Executes an API call of the plugin, directly on the web interface """
+        try:
+            if self._web_interface is None:
+                data = {'success': False, 'msg': 'Call temporarily unavailable'}
+            else:
+                _, data = self._web_interface.execute_api_call(call['name'], call.get('parameters'),
+                                                               plugin_exposed_only=True)
+            self._send_api_response(call, data)
+        except Exception as exception:
+            self.logger('[Runner] Failed to execute api call {0}: {1}'.format(call.get('name'), exception))
+
+    def _send_api_response(self, call, data):
+        self._write({'cid': 0,
+                     'action': 'api_response',
+                     'call_id': call['call_id'],
+                     'data': data})
+
     def _do_async(self, action, fields, should_filter=False):
         if (should_filter and action not in self._receivers) or not self._process_running:
             return
+        if should_filter and self._throttle == 'pause':
+            with self._statistics_lock:
+                self._queue_drops += 1
+            return
 
         try:
-            self._async_command_queue.put({'action': action, 'fields': fields}, block=False)
+            self._async_command_queue.put({'action': action, 'fields': fields, 'event': should_filter}, block=False)
         except Full:
+            with self._statistics_lock:
+                self._queue_drops += 1
             self.logger('Async action cannot be queued, queue is full')
 
     def _perform_async_commands(self):
         while self._process_running:
             try:
+                last_sample = self._last_resource_sample
+                if last_sample is None or time.time() - last_sample[0] >= PluginRunner.RESOURCE_CHECK_INTERVAL:
+                    self._check_resources()
                 # Give it a timeout in order to check whether the plugin is not stopped.
                 command = self._async_command_queue.get(block=True, timeout=10)
+                if command['event'] and self._throttle is not None:
+                    time.sleep(PluginRunner.THROTTLE_DELAY)
                 self._do_command(command['action'], command['fields'])
             except Empty:
                 pass
             except Exception as exception:
                 self.logger('[Runner] Failed to perform async command: {0}'.format(exception))
 
-    def _do_command(self, action, fields=None, timeout=None):
+    def _write(self, message):
+        data = PluginIPCStream.write(message)
+        with self._command_lock:
+            self._proc.stdin.write(data)
+            self._proc.stdin.flush()
+            self._bytes_written += len(data)
+
+    def _do_command(self, action, fields=None, timeout=None, body=None):
         if fields is None:
             fields = {}
         self._commands_executed += 1
@@ -265,23 +517,48 @@ class PluginRunner:
         if not self._process_running:
             raise Exception('Plugin was stopped')
 
+        # Multiple commands can be outstanding. The lock only covers writing the command, the
+        # response is matched on its cid, regardless of the order in which the responses arrive.
+        response_queue = Queue(1)
+        sender = None
+        start = time.time()
         with self._command_lock:
             command = self._create_command(action, fields)
-            self._proc.stdin.write(PluginIPCStream.write(command))
-            self._proc.stdin.flush()
-
+            cid = command['cid']
+            self._response_queues[cid] = response_queue
+            if body is not None:
+                # The body follows the command, as a stream with the cid as id
+                command['stream_body'] = True
+                sender = IPCStreamSender(cid, self._write)
+                self._stream_senders[cid] = sender
             try:
-                response = self._response_queue.get(block=True, timeout=timeout)
-                while response['cid'] != self._cid:
-                    response = self._response_queue.get(block=False)
-                exception = response.get('_exception')
-                if exception is not None:
-                    raise RuntimeError(exception)
-                return response
-            except Empty:
-                self.logger('[Runner] No response within {0}s ({1})'.format(timeout, action))
-                self._commands_failed += 1
-                raise Exception('Plugin did not respond')
+                data = PluginIPCStream.write(command)
+                self._proc.stdin.write(data)
+                self._proc.stdin.flush()
+                self._bytes_written += len(data)
+            except Exception:
+                self._response_queues.pop(cid, None)
+                self._stream_senders.pop(cid, None)
+                raise
+
+        try:
+            if sender is not None:
+                sender.send(body)
+                self._stream_senders.pop(cid, None)
+            response = response_queue.get(block=True, timeout=timeout)
+            with self._statistics_lock:
+                self._command_latency.add((time.time() - start) * 1000.0)
+            exception = response.get('_exception')
+            if exception is not None:
+                raise RuntimeError(exception)
+            return response
+        except Empty:
+            self.logger('[Runner] No response within {0}s ({1})'.format(timeout, action))
+            self._commands_failed += 1
+            raise PluginTimeoutException('Plugin did not respond')
+        finally:
+            self._response_queues.pop(cid, None)
+            self._stream_senders.pop(cid, None)
 
     def _create_command(self, action, fields=None):
         if fields is None:
@@ -306,6 +583,299 @@ class PluginRunner:
             return 0
         return self._async_command_queue.qsize()
 
+    def set_limits(self, cpu_percent=None, rss=None):
+        """
+        Sets soft resource limits. Event delivery is slowed down when the runtime exceeds
+        a limit, and paused (events are dropped) when it uses more than twice a limit.
+
+        :param cpu_percent: CPU usage, in percent of a single core
+        :param rss: Resident memory, in MB
+        """
+        self._limits = {'cpu_percent': cpu_percent,
+                        'rss': None if rss is None else rss * 1024 * 1024}
+
+    def _check_resources(self):
+        """ Samples the resource usage of the runtime and adjusts the event throttling """
+        now = time.time()
+        if isinstance(self._proc, ZygoteProcess):
+            # A forked runtime is not our child, so its pid can't be probed. The zygote samples it instead
+            usage = self._proc.get_usage()
+            if usage is None:
+                return
+            cpu_time, rss = usage['cpu_time'], usage['rss']
+        else:
+            try:
+                process = psutil.Process(self._proc.pid)
+                cpu_times = process.cpu_times()
+                rss = process.memory_info().rss
+            except psutil.Error:
+                return
+            cpu_time = cpu_times.user + cpu_times.system
+        cpu_percent = None
+        if self._last_resource_sample is not None and now > self._last_resource_sample[0]:
+            last_timestamp, last_cpu_time = self._last_resource_sample
+            cpu_percent = (cpu_time - last_cpu_time) / (now - last_timestamp) * 100.0
+        self._last_resource_sample = (now, cpu_time)
+        self._resources = {'cpu_time': cpu_time,
+                           'cpu_percent': cpu_percent,
+                           'rss': rss}
+
+        usage = 0.0
+        for key in ['cpu_percent', 'rss']:
+            limit = self._limits.get(key)
+            if limit and self._resources[key] is not None:
+                usage = max(usage, self._resources[key] / float(limit))
+        throttle = None
+        if usage > 2:
+            throttle = 'pause'
+        elif usage > 1:
+            throttle = 'slow'
+        if throttle != self._throttle:
+            if throttle is None:
+                self.logger('[Runner] Resource usage within limits, event delivery resumed')
+            else:
+                self.logger('[Runner] Resource usage over limits ({0}), event delivery throttled ({1})'.format(
+                    ', '.join('{0}: {1}'.format(key, value) for key, value in self._resources.iteritems()), throttle
+                ))
+        self._throttle = throttle
+
+    def get_resource_usage(self):
+        """ Returns the resource usage of the runtime and the IPC traffic to and from it """
+        with self._statistics_lock:
+            latency = self._command_latency
+            usage = {'ipc_in': 0 if self._stream is None else self._stream.bytes_read,
+                     'ipc_out': self._bytes_written,
+                     'commands': latency.count,
+                     'command_avg': latency.average,
+                     'command_p95': latency.percentile(95),
+                     'command_max': latency.max,
+                     'queue_length': self.get_queue_length(),
+                     'queue_drops': self._queue_drops,
+                     'throttle': self._throttle}
+        for key in ['cpu_time', 'cpu_percent', 'rss']:
+            usage[key] = self._resources.get(key)
+        return usage
+
+
+def get_python_executable():
+    python_executable = sys.executable
+    if python_executable is None or len(python_executable) == 0:
+        python_executable = '/usr/bin/python'
+    return python_executable
+
+
+class PluginZygote(object):
+    """
+    Manages the zygote process, which has the plugin runtime preloaded and forks a new runtime for
+    every plugin. The forked runtimes communicate over a pair of fifos, with the same IPC contract
+    as a runtime that is started as a separate process.
+    """
+
+    def __init__(self, runtime_path, spawn_timeout=10):
+        self._runtime_path = runtime_path
+        self._spawn_timeout = spawn_timeout
+        self._proc = None
+        self._stream = None
+        self._lock = Lock()
+        self._ready = Queue(1)
+        self._request_id = 0
+        self._response_queues = {}
+        self._processes = {}  # pid -> ZygoteProcess
+
+    def _ensure_running(self):
+        if self._proc is not None and self._proc.poll() is None:
+            return
+        if self._stream is not None:
+            self._stream.stop()
+        self._release_processes()
+        self._proc = subprocess.Popen([get_python_executable(), 'zygote.py'],
+                                      stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=None,
+                                      cwd=self._runtime_path)
+        self._stream = PluginIPCStream(stream=self._proc.stdout,
+                                       logger=lambda message, ex: logger.error('Zygote - {0}: {1}'.format(message, ex)),
+                                       command_receiver=self._process_message)
+        self._stream.start()
+        try:
+            self._ready.get(timeout=60)
+        except Empty:
+            self._terminate()
+            raise RuntimeError('Zygote did not start')
+
+    def spawn(self, plugin_path):
+        """
+        Forks a plugin runtime for the given plugin
+
+        :rtype: plugins.runner.ZygoteProcess
+        """
+        fifo_path = tempfile.mkdtemp(prefix='om_plugin_')
+        try:
+            stdin_fifo = os.path.join(fifo_path, 'stdin')
+            stdout_fifo = os.path.join(fifo_path, 'stdout')
+            os.mkfifo(stdin_fifo)
+            os.mkfifo(stdout_fifo)
+            # Open the read end first, so the runtime can open its stdout right away
+            stdout_fd = os.open(stdout_fifo, os.O_RDONLY | os.O_NONBLOCK)
+            try:
+                response_queue = Queue(1)
+                with self._lock:
+                    self._ensure_running()
+                    self._request_id += 1
+                    request_id = self._request_id
+                    self._response_queues[request_id] = response_queue
+                    self._proc.stdin.write(PluginIPCStream.write({'action': 'fork',
+                                                                  'id': request_id,
+                                                                  'path': plugin_path,
+                                                                  'stdin': stdin_fifo,
+                                                                  'stdout': stdout_fifo}))
+                    self._proc.stdin.flush()
+                try:
+                    response = response_queue.get(timeout=self._spawn_timeout)
+                except Empty:
+                    raise RuntimeError('Zygote did not respond')
+                finally:
+                    self._response_queues.pop(request_id, None)
+                if response.get('pid') is None:
+                    raise RuntimeError('Zygote could not fork: {0}'.format(response.get('error')))
+                process = ZygoteProcess(response['pid'], self._proc, self)
+                self._processes[process.pid] = process
+                stdin_fd = self._open_stdin(process, stdin_fifo)
+            except Exception:
+                os.close(stdout_fd)
+                raise
+            fcntl.fcntl(stdout_fd, fcntl.F_SETFL, fcntl.fcntl(stdout_fd, fcntl.F_GETFL) & ~os.O_NONBLOCK)
+            for fd in [stdin_fd, stdout_fd]:  # Other processes should not keep the fifos open
+                fcntl.fcntl(fd, fcntl.F_SETFD, fcntl.fcntl(fd, fcntl.F_GETFD) | fcntl.FD_CLOEXEC)
+            # Unbuffered, like the pipes of a subprocess. A buffered reader would keep data out of sight of select
+            process.stdin = os.fdopen(stdin_fd, 'w', 0)
+            process.stdout = os.fdopen(stdout_fd, 'r', 0)
+            return process
+        finally:
+            shutil.rmtree(fifo_path, ignore_errors=True)
+
+    def _open_stdin(self, process, stdin_fifo):
+        """ Opens the write end of the stdin fifo, as soon as the runtime opened the read end """
+        start = time.time()
+        while True:
+            try:
+                fd = os.open(stdin_fifo, os.O_WRONLY | os.O_NONBLOCK)
+                # Only the open itself should not block, writes must wait when the fifo is full
+                fcntl.fcntl(fd, fcntl.F_SETFL, fcntl.fcntl(fd, fcntl.F_GETFL) & ~os.O_NONBLOCK)
+                return fd
+            except OSError as ex:
+                if ex.errno != errno.ENXIO:
+                    raise
+            if process.poll() is not None or time.time() - start > self._spawn_timeout:
+                process.kill()
+                raise RuntimeError('Forked runtime did not open its stdin')
+            time.sleep(0.01)
+
+    def _process_message(self, message):
+        action = message.get('action')
+        if action == 'ready':
+            self._ready.put(True)
+        elif action in ['forked', 'usage']:
+            response_queue = self._response_queues.get(message['id'])
+            if response_queue is not None:
+                response_queue.put(message)
+        elif action == 'exited':
+            process = self._processes.pop(message['pid'], None)
+            if process is not None:
+                process.set_exit_code(message['exit_code'])
+
+    def get_usage(self, pid):
+        """ Returns the resource usage of a forked runtime, as sampled by the zygote, or None when it's unknown """
+        response_queue = Queue(1)
+        with self._lock:
+            if self._proc is None or self._proc.poll() is not None:
+                return None
+            self._request_id += 1
+            request_id = self._request_id
+            self._response_queues[request_id] = response_queue
+            try:
+                self._proc.stdin.write(PluginIPCStream.write({'action': 'usage',
+                                                              'id': request_id,
+                                                              'pid': pid}))
+                self._proc.stdin.flush()
+            except Exception:
+                self._response_queues.pop(request_id, None)
+                raise
+        try:
+            return response_queue.get(timeout=self._spawn_timeout).get('usage')
+        except Empty:
+            return None
+        finally:
+            self._response_queues.pop(request_id, None)
+
+    def stop(self):
+        with self._lock:
+            self._terminate()
+
+    def _release_processes(self):
+        """ The exits of the runtimes of a lost zygote are not reported anymore, so they are killed """
+        processes, self._processes = self._processes, {}
+        for process in processes.values():
+            process.set_lost()
+
+    def _terminate(self):
+        if self._proc is None:
+            return
+        if self._stream is not None:
+            self._stream.stop()
+            self._stream = None
+        self._release_processes()
+        if self._proc.poll() is None:
+            try:
+                self._proc.terminate()
+            except Exception as exception:
+                logger.error('Exception during terminating zygote: {0}'.format(exception))
+        self._proc = None
+
+
+class ZygoteProcess(object):
+    """ A plugin runtime forked by the zygote, offering the parts of the Popen interface used by the PluginRunner """
+
+    def __init__(self, pid, zygote_proc, zygote):
+        self.pid = pid
+        self.stdin = None
+        self.stdout = None
+        self._zygote_proc = zygote_proc
+        self._zygote = zygote
+        self._exit_code = None
+
+    def set_exit_code(self, exit_code):
+        self._exit_code = exit_code
+
+    def set_lost(self):
+        if self._exit_code is None:
+            # The zygote can't report the exit code anymore, so the runtime is killed to be sure it's gone. Its
+            # parent was the zygote, so the pid is only reused after the runtime exited, which is unlikely.
+            try:
+                os.kill(self.pid, signal.SIGKILL)
+            except OSError:
+                pass
+            self._exit_code = -signal.SIGKILL
+
+    def poll(self):
+        # The runtime is not our child, so its pid can't be probed. Only the zygote knows
+        if self._exit_code is None and self._zygote_proc.poll() is not None:
+            self.set_lost()
+        return self._exit_code
+
+    def get_usage(self):
+        if self.poll() is not None:
+            return None
+        return self._zygote.get_usage(self.pid)
+
+    def terminate(self):
+        self._send_signal(signal.SIGTERM)
+
+    def kill(self):
+        self._send_signal(signal.SIGKILL)
+
+    def _send_signal(self, sig):
+        if self.poll() is None:
+            os.kill(self.pid, sig)
+
 
 class RunnerWatchdog:
 
@@ -325,15 +895,17 @@ class RunnerWatchdog:
 
     def run(self):
         while not self._stopped:
-            try:
-                score = self._plugin_runner.error_score()
-                if score > self._threshold:
-                    self._plugin_runner.logger('[Watchdog] Stopping unhealthy runner')
-                    self._plugin_runner.stop()
-                if not self._plugin_runner.is_running():
-                    self._plugin_runner.logger('[Watchdog] Starting stopped runner')
-                    self._plugin_runner.start()
-            except Exception as e:
-                self._plugin_runner.logger('[Watchdog] Exception in watchdog: {0}'.format(e))
-
+            self._check()
             time.sleep(self._check_interval)
+
+    def _check(self):
+        try:
+            score = self._plugin_runner.error_score()
+            if score > self._threshold:
+                self._plugin_runner.logger('[Watchdog] Stopping unhealthy runner')
+                self._plugin_runner.stop()
+            if not self._stopped and not self._plugin_runner.is_running():
+                self._plugin_runner.logger('[Watchdog] Starting stopped runner')
+                self._plugin_runner.start()
+        except Exception as e:
+            self._plugin_runner.logger('[Watchdog] Exception in watchdog: {0}'.format(e))
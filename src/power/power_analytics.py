@@ -0,0 +1,188 @@
+# Copyright (C) 2020 OpenMotics BV
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+The power analytics reader reads the voltage and current samples of the energy modules into
+preallocated buffers, and summarizes them (RMS, peak, THD) so not every sample has to be shipped.
+"""
+
+import math
+from array import array
+from itertools import islice
+from threading import Lock, RLock
+from ioc import Injectable, Inject, INJECTED, Singleton
+from power import power_api
+
+TIME_SAMPLES = 100  # 2 blocks of 50 samples per input
+HARMONICS = 20  # The frequency sample contains 20 harmonics, followed by 20 phases
+
+
+def get_rms(samples):
+    """ The root mean square of the samples. """
+    if len(samples) == 0:
+        return 0.0
+    return math.sqrt(sum(sample * sample for sample in samples) / len(samples))
+
+
+def get_peak(samples):
+    """ The largest absolute value of the samples. """
+    if len(samples) == 0:
+        return 0.0
+    return max(max(samples), -min(samples))
+
+
+def get_thd(harmonics):
+    """ The total harmonic distortion, the first harmonic is the fundamental. """
+    values = iter(harmonics)
+    fundamental = next(values, 0.0)
+    if fundamental == 0:
+        return 0.0
+    return math.sqrt(sum(value * value for value in values)) / abs(fundamental)
+
+
+class SampleView(object):
+    """
+    A read-only view on a part of a sample buffer. The samples are not copied, so the view shows the
+    samples of the next read of the same input.
+    """
+
+    def __init__(self, samples, start, stop):
+        self._samples = samples
+        self._start = start
+        self._stop = stop
+
+    def __len__(self):
+        return self._stop - self._start
+
+    def __iter__(self):
+        return islice(self._samples, self._start, self._stop)
+
+    def __getitem__(self, index):
+        if index < 0:
+            index += len(self)
+        if not 0 <= index < len(self):
+            raise IndexError('sample index out of range')
+        return self._samples[self._start + index]
+
+    def tolist(self):
+        """ Copy the samples into a list. """
+        return self._samples[self._start:self._stop].tolist()
+
+
+class SampleBuffers(object):
+    """ The sample buffers of an energy module, with room for the samples of every input. """
+
+    def __init__(self, num_inputs):
+        self.time = dict((field, array('f', [0.0]) * (num_inputs * TIME_SAMPLES)) for field in ['voltage', 'current'])
+        self.time_length = dict((field, [0] * num_inputs) for field in ['voltage', 'current'])
+        self.frequency = dict((field, array('f', [0.0]) * (num_inputs * HARMONICS * 2)) for field in ['voltage', 'current'])
+        self.lock = RLock()  # Held while the buffers are written, or summarized
+
+
+@Injectable.named('power_analytics')
+@Singleton
+class PowerAnalytics(object):
+    """
+    Reads the samples of the energy modules. Every module gets a set of sample buffers that is
+    reused for every read, and the samples are returned as :class`SampleView` on these buffers.
+    """
+
+    @Inject
+    def __init__(self, power_communicator=INJECTED, power_controller=INJECTED):
+        """
+        :type power_communicator: power.power_communicator.PowerCommunicator
+        :type power_controller: power.power_controller.PowerController
+        """
+        self._power_communicator = power_communicator
+        self._power_controller = power_controller
+        self._buffers = {}  # module id -> SampleBuffers
+        self._buffers_lock = Lock()
+
+    def read_time_samples(self, module_id, input_id):
+        """
+        Read a 'time' sample of the voltage and current of an input.
+
+        :returns: dict with a :class`SampleView` for 'voltage' and 'current'
+        """
+        module, buffers = self._get_module(module_id, input_id)
+        sample = self._power_communicator.do_transaction(module.address, power_api.get_sample_time(module.version, input_id))
+        offset = input_id * TIME_SAMPLES
+        views = {}
+        with buffers.lock:
+            for field in ['voltage', 'current']:
+                samples = buffers.time[field]
+                length = 0
+                for block in getattr(sample, field):
+                    try:
+                        size = block.index(float('inf'))
+                    except ValueError:
+                        size = len(block)
+                    samples[offset + length:offset + length + size] = block[:size]
+                    length += size
+                    if size < len(block):
+                        break
+                buffers.time_length[field][input_id] = length
+                views[field] = SampleView(samples, offset, offset + length)
+        return views
+
+    def read_frequency_samples(self, module_id, input_id):
+        """
+        Read a 'frequency' sample of the voltage and current of an input.
+
+        :returns: dict with a (harmonics, phases) tuple of :class`SampleView` for 'voltage' and 'current'
+        """
+        module, buffers = self._get_module(module_id, input_id)
+        sample = self._power_communicator.do_transaction(module.address, power_api.get_sample_frequency(module.version, input_id))
+        offset = input_id * HARMONICS * 2
+        views = {}
+        with buffers.lock:
+            for field in ['voltage', 'current']:
+                samples = buffers.frequency[field]
+                samples[offset:offset + HARMONICS * 2] = getattr(sample, field)
+                views[field] = (SampleView(samples, offset, offset + HARMONICS),
+                                SampleView(samples, offset + HARMONICS, offset + HARMONICS * 2))
+        return views
+
+    def get_summary(self, module_id, input_id):
+        """
+        Read the samples of an input, and summarize them.
+
+        :returns: dict with the RMS, peak and THD of the voltage and current, e.g. 'voltage_rms'
+        """
+        _, buffers = self._get_module(module_id, input_id)
+        # The views are on the shared buffers, so no other read can be allowed until they are summarized
+        with buffers.lock:
+            time_samples = self.read_time_samples(module_id, input_id)
+            frequency_samples = self.read_frequency_samples(module_id, input_id)
+            summary = {}
+            for field in ['voltage', 'current']:
+                summary['{0}_rms'.format(field)] = get_rms(time_samples[field])
+                summary['{0}_peak'.format(field)] = get_peak(time_samples[field])
+                summary['{0}_thd'.format(field)] = get_thd(frequency_samples[field][0])
+        return summary
+
+    def _get_module(self, module_id, input_id):
+        module = self._power_controller.get_modules().get(module_id)
+        if module is None:
+            raise ValueError('Unknown power module')
+        if module.version != power_api.ENERGY_MODULE:
+            raise ValueError('Unknown power api version')
+        num_inputs = power_api.NUM_PORTS[module.version]
+        if not 0 <= input_id < num_inputs:
+            raise ValueError('Invalid input_id (should be 0-{0})'.format(num_inputs - 1))
+        buffers = self._buffers.get(module_id)
+        if buffers is None:
+            with self._buffers_lock:
+                buffers = self._buffers.setdefault(module_id, SampleBuffers(num_inputs))
+        return module, buffers
@@ -16,7 +16,9 @@
 Contains the definition of the power modules Api.
 """
 
-from power.power_command import PowerCommand
+from array import array
+from collections import namedtuple
+from power.power_command import PowerCommand, MeasurementTransaction
 
 BROADCAST_ADDRESS = 255
 
@@ -37,6 +39,13 @@ NUM_PORTS = {POWER_MODULE: 8,
 LARGEST_MODULE_TYPE = [module_type for module_type in NUM_PORTS.keys()
                        if NUM_PORTS[module_type] == max(*NUM_PORTS.values())][0]
 
+# The results of the measurement transactions, every field contains an array with a value per port
+RealtimePower = namedtuple('RealtimePower', ['voltage', 'frequency', 'current', 'power'])
+TotalEnergy = namedtuple('TotalEnergy', ['day', 'night'])
+# The results of the sample transactions of a single input
+SampleTime = namedtuple('SampleTime', ['voltage', 'current'])  # Every field contains the list of sample blocks (arrays)
+SampleFrequency = namedtuple('SampleFrequency', ['voltage', 'current'])  # Every field contains the harmonics followed by the phases
+
 
 def get_general_status(version):
     """
@@ -494,6 +503,118 @@ def get_version(version):
     return PowerCommand('G', 'FIV', '', '16s')
 
 
+# Below are the measurement transactions
+
+def parse_p1_fields(status, fields, num_ports=NUM_PORTS[P1_CONCENTRATOR]):
+    """
+    Parse the fixed width ascii fields of a P1 concentrator for all ports, in one pass. Ports that
+    are not connected according to the status, and fields that can't be parsed, are 0.
+    :param status: the P1 status, a bit per connected port
+    :param fields: list of (raw, width, digits): the field of a port is `width` characters, of which the
+    first `digits` characters contain the value.
+    :returns: list with an array of values per field
+    """
+    values = [array('d', [0.0]) * num_ports for _ in fields]
+    for port in xrange(num_ports):
+        if not status & 1 << port:
+            continue
+        for field_values, (raw, width, digits) in zip(values, fields):
+            offset = port * width
+            try:
+                field_values[port] = float(raw[offset:offset + digits])
+            except ValueError:
+                pass
+    return values
+
+
+def get_realtime_power(version):
+    """
+    Get the transaction that reads the voltage, frequency, current and power of all ports, the
+    result is a :class`RealtimePower` with an array per field.
+    :param version: power api version (POWER_MODULE, ENERGY_MODULE or P1_CONCENTRATOR).
+    """
+    num_ports = NUM_PORTS.get(version)
+    if version == POWER_MODULE:
+        def _combine(outputs):
+            raw_volt, raw_freq, current, power = outputs
+            return RealtimePower(array('f', [raw_volt[0]]) * num_ports, array('f', [raw_freq[0]]) * num_ports, current, power)
+        return MeasurementTransaction([get_voltage(version), get_frequency(version),
+                                       get_current(version), get_power(version)], _combine)
+    elif version == ENERGY_MODULE:
+        def _combine(outputs):
+            return RealtimePower(*outputs)
+        return MeasurementTransaction([get_voltage(version), get_frequency(version),
+                                       get_current(version), get_power(version)], _combine)
+    elif version == P1_CONCENTRATOR:
+        def _combine(outputs):
+            status, raw_volt, raw_current_ph1, raw_current_ph2, raw_current_ph3, delivered_power, received_power = [output[0] for output in outputs]
+            voltage, current_ph1, current_ph2, current_ph3, delivered, received = parse_p1_fields(
+                status, [(raw_volt, 7, 5), (raw_current_ph1, 5, 3), (raw_current_ph2, 5, 3), (raw_current_ph3, 5, 3),
+                         (delivered_power, 9, 6), (received_power, 9, 6)], num_ports
+            )
+            return RealtimePower(voltage,
+                                 array('d', [0.0]) * num_ports,
+                                 array('d', [current_ph1[i] + current_ph2[i] + current_ph3[i] for i in xrange(num_ports)]),
+                                 array('d', [(delivered[i] - received[i]) * 1000 for i in xrange(num_ports)]))
+        return MeasurementTransaction([get_status_p1(version), get_voltage(version, phase=1),
+                                       get_current(version, phase=1), get_current(version, phase=2),
+                                       get_current(version, phase=3), get_delivered_power(version),
+                                       get_received_power(version)], _combine)
+    else:
+        raise ValueError("Unknown power api version")
+
+
+def get_total_energy(version):
+    """
+    Get the transaction that reads the day and night energy (Wh) of all ports, the result is a
+    :class`TotalEnergy` with an array per field.
+    :param version: power api version (POWER_MODULE, ENERGY_MODULE or P1_CONCENTRATOR).
+    """
+    num_ports = NUM_PORTS.get(version)
+    if version in [POWER_MODULE, ENERGY_MODULE]:
+        def _combine(outputs):
+            return TotalEnergy(*outputs)
+        return MeasurementTransaction([get_day_energy(version), get_night_energy(version)], _combine)
+    elif version == P1_CONCENTRATOR:
+        def _combine(outputs):
+            status, raw_day, raw_night = [output[0] for output in outputs]
+            day, night = parse_p1_fields(status, [(raw_day, 14, 10), (raw_night, 14, 10)], num_ports)
+            return TotalEnergy(array('l', [int(value * 1000) for value in day]),
+                               array('l', [int(value * 1000) for value in night]))
+        return MeasurementTransaction([get_status_p1(version), get_day_energy(version),
+                                       get_night_energy(version)], _combine)
+    else:
+        raise ValueError("Unknown power api version")
+
+
+def get_sample_time(version, input_id):
+    """
+    Get the transaction that reads the voltage and current time samples (oscilloscope view) of an
+    input, the result is a :class`SampleTime` with the sample blocks per field. The last block is
+    terminated by an infinite value if it isn't full.
+    :param version: power api version
+    :param input_id: the input to sample
+    """
+    def _combine(outputs):
+        return SampleTime(outputs[0:2], outputs[2:4])
+    return MeasurementTransaction([get_voltage_sample_time(version), get_voltage_sample_time(version),
+                                   get_current_sample_time(version), get_current_sample_time(version)], _combine,
+                                  inputs=[(input_id, 0), (input_id, 1), (input_id, 0), (input_id, 1)])
+
+
+def get_sample_frequency(version, input_id):
+    """
+    Get the transaction that reads the voltage and current frequency samples of an input, the
+    result is a :class`SampleFrequency` with an array of 20 harmonics followed by 20 phases per field.
+    :param version: power api version
+    :param input_id: the input to sample
+    """
+    def _combine(outputs):
+        return SampleFrequency(*outputs)
+    return MeasurementTransaction([get_voltage_sample_frequency(version), get_current_sample_frequency(version)], _combine,
+                                  inputs=[(input_id, 20), (input_id, 20)])
+
+
 # Below are the debug functions
 
 def raw_command(mode, command, num_bytes):
@@ -17,7 +17,9 @@ Contains PowerCommandClass that describes a command to the power modules. The Po
 class is used to create the power_api.
 """
 
+import re
 import struct
+from array import array
 
 CRC_TABLE = [0, 49, 98, 83, 196, 245, 166, 151, 185, 136, 219, 234, 125, 76, 31, 46, 67, 114, 33,
              16, 135, 182, 229, 212, 250, 203, 152, 169, 62, 15, 92, 109, 134, 183, 228, 213, 66,
@@ -68,6 +70,63 @@ def crc8(to_send):
     return ret
 
 
+class CrcMismatchException(Exception):
+    """ Raised when the CRC of a response doesn't match its contents. """
+    def __init__(self, message=None):
+        Exception.__init__(self, message)
+
+
+def parse_response(buffer):
+    """
+    Parse the first response of a power module from a buffer that holds the received bytes. The
+    responses look like this: 'RTR' 'E' Address CID Mode(G/S) Type LEN Data CRC7/8 '\r\n'.
+    The parsed bytes and the bytes in front of the response are removed from the buffer, the bytes
+    of an incomplete response are kept until the rest is received.
+    :param buffer: bytearray with the received bytes
+    :returns: tuple (header, data) or None if the buffer doesn't contain a complete response.
+    """
+    start = buffer.find('RTR')
+    if start == -1:
+        del buffer[:-2]  # The start of a response might be split over two reads
+        return None
+    del buffer[:start]
+    if len(buffer) < 11:
+        return None
+    length = buffer[10]
+    end = 11 + length + 3
+    if len(buffer) < end:
+        return None
+    response = str(buffer[:end])
+    del buffer[:end]
+
+    header = response[3:11]
+    data = response[11:11 + length]
+    crc = ord(response[11 + length])
+    if response[-2:] != '\r\n':
+        raise Exception('Unexpected character')
+    crc_match = (crc7(header + data) == crc) if header[0] == 'E' else (crc8(data) == crc)
+    if not crc_match:
+        raise CrcMismatchException('CRC{0} doesn\'t match'.format('7' if header[0] == 'E' else '8'))
+    return header, data
+
+
+# Formats of a number of values of the same type, the native byte order and sizes of struct and array match
+HOMOGENEOUS_FORMAT = re.compile(r'^\d*([bBhHiIlLf])$')
+STRUCTS = {}  # format -> precompiled struct.Struct
+
+
+def get_struct(fmt):
+    """
+    Get the precompiled struct for a format.
+    :param fmt: struct format
+    :rtype: struct.Struct
+    """
+    compiled = STRUCTS.get(fmt)
+    if compiled is None:
+        compiled = STRUCTS.setdefault(fmt, struct.Struct(fmt))
+    return compiled
+
+
 class PowerCommand(object):
     """
     A PowerCommand is an command that can be send to a Power Module over RS485. The commands
@@ -90,6 +149,11 @@ class PowerCommand(object):
         self.output_format = output_format
         self.module_type = module_type
 
+        self._input_struct = get_struct(input_format)
+        self._output_struct = None if output_format is None else get_struct(output_format)
+        match = None if output_format is None else HOMOGENEOUS_FORMAT.match(output_format)
+        self._output_typecode = None if match is None else match.group(1)
+
     def create_input(self, address, cid, *data):
         """
         Create an input string for the power module using this command and the provided fields.
@@ -98,7 +162,7 @@ class PowerCommand(object):
         :param data: data to send to the power module
         :rtype: string
         """
-        data = struct.pack(self.input_format, *data)
+        data = self._input_struct.pack(*data)
         header = self.module_type + chr(address) + chr(cid) + str(self.mode) + str(self.type)
         payload = chr(len(data)) + str(data)
         if self.module_type == 'E':
@@ -116,13 +180,13 @@ class PowerCommand(object):
         :param data: data to send to the power module
         :rtype: string
         """
-        data = struct.pack(self.output_format, *data)
+        data = self._output_struct.pack(*data)
         header = self.module_type + chr(address) + chr(cid) + str(self.mode) + str(self.type)
         payload = chr(len(data)) + str(data)
         if self.module_type == 'E':
             crc = crc7(header + payload)
         else:
-            crc = crc8(payload)
+            crc = crc8(str(data))  # The responses of a P1 concentrator only cover the data
         return 'RTR{0}{1}{2}\r\n'.format(header, payload, chr(crc))
 
     def check_header(self, header, address, cid):
@@ -146,7 +210,37 @@ class PowerCommand(object):
         Parse the output using the output_format.
         :param data: string containing the data.
         """
-        if self.output_format is None:
+        if self._output_struct is None:
             return struct.unpack('%dB' % len(data), data)
         else:
-            return struct.unpack(self.output_format, data)
+            return self._output_struct.unpack(data)
+
+    def read_output_array(self, data):
+        """
+        Parse the output into an array, if the output consists of values of the same type. Other
+        outputs are parsed using the output_format.
+        :param data: string containing the data.
+        """
+        if self._output_typecode is None:
+            return self.read_output(data)
+        if len(data) != self._output_struct.size:
+            raise struct.error('unpack requires a string argument of length {0}'.format(self._output_struct.size))
+        return array(self._output_typecode, data)
+
+
+class MeasurementTransaction(object):
+    """
+    A MeasurementTransaction is the set of commands that is needed to read a measurement of a Power
+    Module. The PowerCommunicator executes the commands back to back, and the outputs are combined
+    into a single result.
+    """
+
+    def __init__(self, commands, combine, inputs=None):
+        """
+        :param commands: list of :class`PowerCommand`
+        :param combine: function that creates the result from the list of outputs of the commands
+        :param inputs: list with the input data (tuple) of every command, defaults to no input data
+        """
+        self.commands = commands
+        self.combine = combine
+        self.inputs = inputs if inputs is not None else [()] * len(commands)
@@ -18,12 +18,14 @@ Module to communicate with the power modules.
 
 import logging
 import time
-from Queue import Empty
+from collections import deque
 from ioc import Injectable, Inject, INJECTED, Singleton
 from threading import Thread, RLock
+from gateway.observer import Event
 from serial_utils import printable, CommunicationTimedOutException
 from power import power_api
-from power.power_command import crc7, crc8
+from power.power_command import parse_response, CrcMismatchException
+from power.power_statistics import PowerBusStatistics
 from power.time_keeper import TimeKeeper
 
 logger = logging.getLogger("openmotics")
@@ -34,6 +36,10 @@ logger = logging.getLogger("openmotics")
 class PowerCommunicator(object):
     """ Uses a serial port to communicate with the power modules. """
 
+    # In address mode, the bus is used to listen for new modules in slices, so other commands can be executed in between
+    ADDRESS_MODE_SLICE = 0.5  # seconds
+    ADDRESS_MODE_PAUSE = 0.1  # seconds
+
     @Inject
     def __init__(self, power_serial=INJECTED, power_controller=INJECTED, verbose=False, time_keeper_period=60,
                  address_mode_timeout=300):
@@ -48,15 +54,19 @@ class PowerCommunicator(object):
         self.__serial_lock = RLock()
         self.__serial_bytes_written = 0
         self.__serial_bytes_read = 0
+        self.__read_buffer = bytearray()
         self.__cid = 1
 
         self.__address_mode = False
         self.__address_mode_stop = False
         self.__address_thread = None
         self.__address_mode_timeout = address_mode_timeout
+        self.__address_messages = deque()  # Want an address messages that were received by other commands
         self.__power_controller = power_controller
+        self.__event_subscriptions = []
 
         self.__last_success = 0
+        self.__statistics = PowerBusStatistics()
 
         if time_keeper_period != 0:
             self.__time_keeper = TimeKeeper(self, power_controller, time_keeper_period)
@@ -70,6 +80,13 @@ class PowerCommunicator(object):
         if self.__time_keeper is not None:
             self.__time_keeper.start()
 
+    def subscribe_events(self, callback):
+        """
+        Subscribes a callback to the power events
+        :param callback: the callback to call
+        """
+        self.__event_subscriptions.append(callback)
+
     def get_bytes_written(self):
         """ Get the number of bytes written to the power modules. """
         return self.__serial_bytes_written
@@ -78,6 +95,16 @@ class PowerCommunicator(object):
         """ Get the number of bytes read from the power modules. """
         return self.__serial_bytes_read
 
+    def get_statistics(self):
+        """ Get the latency, failure and bus utilization statistics of the power modules.
+
+        :returns: dict with the summaries per module ('modules') and per command ('commands'), and
+        the bus utilization (percentage) per window in seconds ('utilization')
+        """
+        summaries = self.__statistics.get_summaries()
+        summaries['utilization'] = self.__statistics.get_utilization()
+        return summaries
+
     def get_seconds_since_last_success(self):
         """ Get the number of seconds since the last successful communication. """
         if self.__last_success == 0:
@@ -117,40 +144,55 @@ class PowerCommunicator(object):
         :type cmd: :class`PowerCommand`
         :param data: data for the command
         :raises: :class`CommunicationTimedOutException` if power module did not respond in time
-        :raises: :class`InAddressModeException` if communicator is in address mode
         :returns: dict containing the output fields of the command
         """
-        if self.__address_mode:
-            raise InAddressModeException()
+        response_data = self.__do_command(address, cmd, data)
+        return None if response_data is None else cmd.read_output(response_data)
 
+    def __do_command(self, address, cmd, data):
+        """ Send a command and return the data of the response, None for a broadcast. """
         def do_once(_address, _cmd, *_data):
             """ Send the command once. """
             cid = self.__get_cid()
             send_data = _cmd.create_input(_address, cid, *_data)
-            self.__write_to_serial(send_data)
-
-            if _address == power_api.BROADCAST_ADDRESS:
-                return None  # No reply on broadcast messages !
-            else:
-                tries = 0
-                while True:
-                    # In this loop we might receive data that didn't match the expected header. This might happen
-                    # if we for some reason had a timeout on the previous call, and we now read the response
-                    # to that call. In this case, we just re-try (up to 3 times), as the correct data might be
-                    # next in line.
-                    header, response_data = self.__read_from_serial()
-                    if not _cmd.check_header(header, _address, cid):
-                        if _cmd.is_nack(header, _address, cid) and response_data == "\x02":
-                            raise UnkownCommandException('Unknown command')
-                        tries += 1
-                        logger.warning("Header did not match command ({0})".format(tries))
-                        if tries == 3:
-                            raise Exception("Header did not match command ({0})".format(tries))
-                    else:
-                        break
-
-                self.__last_success = time.time()
-                return _cmd.read_output(response_data)
+            start = time.time()
+            try:
+                self.__write_to_serial(send_data)
+
+                if _address == power_api.BROADCAST_ADDRESS:
+                    return None  # No reply on broadcast messages !
+                else:
+                    tries = 0
+                    while True:
+                        # In this loop we might receive data that didn't match the expected header. This might happen
+                        # if we for some reason had a timeout on the previous call, and we now read the response
+                        # to that call. In this case, we just re-try (up to 3 times), as the correct data might be
+                        # next in line.
+                        header, response_data = self.__read_from_serial()
+                        if self.__address_mode and self.__is_address_message(header):
+                            self.__address_messages.append(header)  # Handled by the address mode thread
+                            continue
+                        if not _cmd.check_header(header, _address, cid):
+                            if _cmd.is_nack(header, _address, cid) and response_data == "\x02":
+                                raise UnkownCommandException('Unknown command')
+                            tries += 1
+                            logger.warning("Header did not match command ({0})".format(tries))
+                            if tries == 3:
+                                raise Exception("Header did not match command ({0})".format(tries))
+                        else:
+                            break
+
+                    self.__last_success = time.time()
+                    self.__statistics.register_command(_address, _cmd.mode + _cmd.type, self.__last_success - start)
+                    return response_data
+            except CommunicationTimedOutException:
+                self.__statistics.register_failure(_address, 'timeouts')
+                raise
+            except CrcMismatchException:
+                self.__statistics.register_failure(_address, 'crc_errors')
+                raise
+            finally:
+                self.__statistics.register_busy(start, time.time())
 
         with self.__serial_lock:
             try:
@@ -160,25 +202,45 @@ class PowerCommunicator(object):
                 logger.error("Got UnkownCommandException")
                 do_once(address, power_api.bootloader_jump_application())
                 time.sleep(1)
-                return self.do_command(address, cmd, *data)
+                return self.__do_command(address, cmd, data)
             except CommunicationTimedOutException:
                 # Communication timed out, try again.
+                self.__statistics.register_failure(address, 'retries')
                 return do_once(address, cmd, *data)
             except Exception as ex:
                 logger.exception("Unexpected error: {0}".format(ex))
+                self.__statistics.register_failure(address, 'retries')
                 time.sleep(0.25)
                 return do_once(address, cmd, *data)
 
+    def do_transaction(self, address, transaction):
+        """ Execute the commands of a measurement transaction back to back, without other commands
+        in between, and combine their outputs (parsed into arrays).
+
+        :param address: Address of the power module
+        :type address: 2 bytes string
+        :param transaction: the transaction to execute
+        :type transaction: :class`MeasurementTransaction`
+        :raises: :class`CommunicationTimedOutException` if power module did not respond in time
+        :returns: the result of the transaction
+        """
+        with self.__serial_lock:
+            outputs = [cmd.read_output_array(self.__do_command(address, cmd, data))
+                       for cmd, data in zip(transaction.commands, transaction.inputs)]
+        return transaction.combine(outputs)
+
     def start_address_mode(self):
-        """ Start address mode.
+        """ Start address mode. Other commands keep working while the modules are discovered, the
+        progress is reported through POWER_ADDRESS_MODE events.
 
-        :raises: :class`InAddressModeException` if communicator is in maintenance mode.
+        :raises: :class`InAddressModeException` if communicator is already in address mode.
         """
         if self.__address_mode:
             raise InAddressModeException()
 
         self.__address_mode = True
         self.__address_mode_stop = False
+        self.__address_messages.clear()
 
         with self.__serial_lock:
             self.__address_thread = Thread(target=self.__do_address_mode,
@@ -196,74 +258,111 @@ class PowerCommunicator(object):
         expire = time.time() + self.__address_mode_timeout
         address_mode = power_api.set_addressmode(power_api.ENERGY_MODULE)
         address_mode_p1c = power_api.set_addressmode(power_api.P1_CONCENTRATOR)
-        want_an_address_8 = power_api.want_an_address(power_api.POWER_MODULE)
-        want_an_address_12 = power_api.want_an_address(power_api.ENERGY_MODULE)
-        want_an_address_p1c = power_api.want_an_address(power_api.P1_CONCENTRATOR)
-        set_address = power_api.set_address(power_api.ENERGY_MODULE)
-        set_address_p1c = power_api.set_address(power_api.P1_CONCENTRATOR)
+        found = []
 
         # AGT start
-        data = address_mode.create_input(power_api.BROADCAST_ADDRESS,
-                                         self.__get_cid(),
-                                         power_api.ADDRESS_MODE)
-        self.__write_to_serial(data)
-        data = address_mode_p1c.create_input(power_api.BROADCAST_ADDRESS,
+        with self.__serial_lock:
+            data = address_mode.create_input(power_api.BROADCAST_ADDRESS,
                                              self.__get_cid(),
                                              power_api.ADDRESS_MODE)
-        self.__write_to_serial(data)
-
-        # Wait for WAA and answer.
+            self.__write_to_serial(data)
+            data = address_mode_p1c.create_input(power_api.BROADCAST_ADDRESS,
+                                                 self.__get_cid(),
+                                                 power_api.ADDRESS_MODE)
+            self.__write_to_serial(data)
+        self.__publish_address_mode_event('STARTED', found, expire)
+
+        # Wait for WAA and answer, a slice at a time.
         while not self.__address_mode_stop and time.time() < expire:
-            try:
-                header, data = self.__read_from_serial()
-
-                if set_address.check_header_partial(header) or set_address_p1c.check_header_partial(header):
-                    continue
-
-                version = None
-                if want_an_address_8.check_header_partial(header):
-                    version = power_api.POWER_MODULE
-                elif want_an_address_12.check_header_partial(header):
-                    version = power_api.ENERGY_MODULE
-                elif want_an_address_p1c.check_header_partial(header):
-                    version = power_api.P1_CONCENTRATOR
-
-                if version is None:
-                    logger.warning("Received unexpected message in address mode")
-                else:
-                    (old_address, cid) = (ord(header[:2][1]), header[2:3])
-                    # Ask power_controller for new address, and register it.
-                    new_address = self.__power_controller.get_free_address()
-
-                    if self.__power_controller.module_exists(old_address):
-                        self.__power_controller.readdress_power_module(old_address, new_address)
-                    else:
-                        self.__power_controller.register_power_module(new_address, version)
-
-                    # Send new address to module
-                    if version == power_api.P1_CONCENTRATOR:
-                        address_data = set_address_p1c.create_input(old_address, ord(cid), new_address)
-                    else:
-                        # Both power- and energy module share the same API
-                        address_data = set_address.create_input(old_address, ord(cid), new_address)
-                    self.__write_to_serial(address_data)
-
-            except CommunicationTimedOutException:
-                pass  # Didn't receive a command, no problem.
-            except Exception as exception:
-                logger.exception("Got exception in address mode: %s", exception)
+            with self.__serial_lock:
+                slice_end = min(expire, time.time() + PowerCommunicator.ADDRESS_MODE_SLICE)
+                while not self.__address_mode_stop and time.time() < slice_end:
+                    try:
+                        if self.__address_messages:
+                            header = self.__address_messages.popleft()
+                        else:
+                            # Don't keep the bus after the slice, other commands are waiting
+                            header, _ = self.__read_from_serial(timeout=max(0.0, min(0.25, slice_end - time.time())))
+                        module = self.__process_address_message(header)
+                        if module is not None:
+                            found.append(module)
+                            self.__publish_address_mode_event('MODULE_FOUND', found, expire)
+                    except CommunicationTimedOutException:
+                        pass  # Didn't receive a command, no problem.
+                    except Exception as exception:
+                        logger.exception("Got exception in address mode: %s", exception)
+            if not self.__address_mode_stop and time.time() < expire:
+                time.sleep(PowerCommunicator.ADDRESS_MODE_PAUSE)  # Let other commands use the bus
 
         # AGT stop
-        data = address_mode.create_input(power_api.BROADCAST_ADDRESS,
-                                         self.__get_cid(),
-                                         power_api.NORMAL_MODE)
-        self.__write_to_serial(data)
-        data = address_mode_p1c.create_input(power_api.BROADCAST_ADDRESS,
+        with self.__serial_lock:
+            data = address_mode.create_input(power_api.BROADCAST_ADDRESS,
                                              self.__get_cid(),
                                              power_api.NORMAL_MODE)
-        self.__write_to_serial(data)
+            self.__write_to_serial(data)
+            data = address_mode_p1c.create_input(power_api.BROADCAST_ADDRESS,
+                                                 self.__get_cid(),
+                                                 power_api.NORMAL_MODE)
+            self.__write_to_serial(data)
 
         self.__address_mode = False
+        self.__publish_address_mode_event('STOPPED', found, expire)
+
+    @staticmethod
+    def __is_address_message(header):
+        """ Checks whether the header is a want an address message of a module, or a set address reply. """
+        return (any(power_api.want_an_address(version).check_header_partial(header)
+                    for version in [power_api.POWER_MODULE, power_api.ENERGY_MODULE, power_api.P1_CONCENTRATOR]) or
+                any(power_api.set_address(version).check_header_partial(header)
+                    for version in [power_api.ENERGY_MODULE, power_api.P1_CONCENTRATOR]))
+
+    def __process_address_message(self, header):
+        """ Gives a module that wants an address a new address, returns the module or None. """
+        set_address = power_api.set_address(power_api.ENERGY_MODULE)
+        set_address_p1c = power_api.set_address(power_api.P1_CONCENTRATOR)
+        if set_address.check_header_partial(header) or set_address_p1c.check_header_partial(header):
+            return None
+
+        version = None
+        if power_api.want_an_address(power_api.POWER_MODULE).check_header_partial(header):
+            version = power_api.POWER_MODULE
+        elif power_api.want_an_address(power_api.ENERGY_MODULE).check_header_partial(header):
+            version = power_api.ENERGY_MODULE
+        elif power_api.want_an_address(power_api.P1_CONCENTRATOR).check_header_partial(header):
+            version = power_api.P1_CONCENTRATOR
+
+        if version is None:
+            logger.warning("Received unexpected message in address mode")
+            return None
+
+        (old_address, cid) = (ord(header[:2][1]), header[2:3])
+        # Ask power_controller for new address, and register it.
+        new_address = self.__power_controller.get_free_address()
+
+        if self.__power_controller.module_exists(old_address):
+            self.__power_controller.readdress_power_module(old_address, new_address)
+        else:
+            self.__power_controller.register_power_module(new_address, version)
+
+        # Send new address to module
+        if version == power_api.P1_CONCENTRATOR:
+            address_data = set_address_p1c.create_input(old_address, ord(cid), new_address)
+        else:
+            # Both power- and energy module share the same API
+            address_data = set_address.create_input(old_address, ord(cid), new_address)
+        self.__write_to_serial(address_data)
+        return {'address': new_address, 'version': version}
+
+    def __publish_address_mode_event(self, state, found, expire):
+        event = Event(event_type=Event.Types.POWER_ADDRESS_MODE,
+                      data={'state': state,
+                            'modules': list(found),
+                            'remaining': max(0, int(expire - time.time()))})
+        for callback in self.__event_subscriptions:
+            try:
+                callback(event)
+            except Exception as ex:
+                logger.exception('Could not publish address mode event: {0}'.format(ex))
 
     def stop_address_mode(self):
         """ Stop address mode. """
@@ -278,77 +377,26 @@ class PowerCommunicator(object):
         """ Returns whether the PowerCommunicator is in address mode. """
         return self.__address_mode
 
-    def __read_from_serial(self):
-        """ Read a PowerCommand from the serial port. """
-        phase = 0
-        index = 0
-
-        header = ""
-        length = 0
-        data = ""
-        crc = 0
-
-        command = ""
+    def __read_from_serial(self, timeout=0.25):
+        """ Read a PowerCommand from the serial port.
 
+        :param timeout: the time (in seconds) to wait for the next bytes
+        """
+        received = ''
         try:
-            while phase < 8:
-                byte = self.__serial.read_queue.get(True, 0.25)
-                command += byte
-                self.__serial_bytes_read += 1
-                if phase == 0:  # Skip non 'R' bytes
-                    if byte == 'R':
-                        phase = 1
-                    else:
-                        phase = 0
-                elif phase == 1:  # Expect 'T'
-                    if byte == 'T':
-                        phase = 2
-                    else:
-                        raise Exception("Unexpected character")
-                elif phase == 2:  # Expect 'R'
-                    if byte == 'R':
-                        phase = 3
-                        index = 0
-                    else:
-                        raise Exception("Unexpected character")
-                elif phase == 3:  # Read the header fields
-                    header += byte
-                    index += 1
-                    if index == 8:
-                        length = ord(byte)
-                        if length > 0:
-                            phase = 4
-                            index = 0
-                        else:
-                            phase = 5
-                elif phase == 4:  # Read the data
-                    data += byte
-                    index += 1
-                    if index == length:
-                        phase = 5
-                elif phase == 5:  # Read the CRC code
-                    crc = ord(byte)
-                    phase = 6
-                elif phase == 6:  # Expect '\r'
-                    if byte == '\r':
-                        phase = 7
-                    else:
-                        raise Exception("Unexpected character")
-                elif phase == 7:  # Expect '\n'
-                    if byte == '\n':
-                        phase = 8
-                    else:
-                        raise Exception("Unexpected character")
-            crc_match = (crc7(header + data) == crc) if header[0] == 'E' else (crc8(data) == crc)
-            if not crc_match:
-                raise Exception('CRC{0} doesn\'t match'.format('7' if header[0] == 'E' else '8'))
-        except Empty:
-            raise CommunicationTimedOutException('Communication timed out')
+            while True:
+                response = parse_response(self.__read_buffer)
+                if response is not None:
+                    return response
+                chunk = self.__serial.read_chunk(timeout)
+                if chunk == '':
+                    raise CommunicationTimedOutException('Communication timed out')
+                received += chunk
+                self.__serial_bytes_read += len(chunk)
+                self.__read_buffer += chunk
         finally:
             if self.__verbose:
-                PowerCommunicator.__log('reading from', command)
-
-        return header, data
+                PowerCommunicator.__log('reading from', received)
 
 
 class InAddressModeException(Exception):
@@ -23,10 +23,49 @@ from ioc import Injectable, Inject, INJECTED, Singleton
 from power_api import POWER_MODULE, ENERGY_MODULE, P1_CONCENTRATOR, NUM_PORTS, LARGEST_MODULE_TYPE
 
 
+class PowerPort(object):
+    """ The configuration of a port of a power module. """
+
+    def __init__(self, input, sensor, times, inverted):
+        self.input = input
+        self.sensor = sensor
+        self.times = times
+        self.inverted = inverted
+
+
+class PowerModule(object):
+    """ The configuration of a power module. """
+
+    def __init__(self, id, name, address, version, ports, day_night=None):
+        """
+        :param ports: the configuration of the ports, one :class`PowerPort` per port of the module
+        :param day_night: the day/night modes that were last set on the module
+        """
+        self.id = id
+        self.name = name
+        self.address = address
+        self.version = version
+        self.ports = ports
+        self.day_night = day_night
+
+    def to_dict(self):
+        """ The configuration as a dict, with a field per port setting (eg. 'input0'). """
+        module = {'id': self.id, 'name': self.name, 'address': self.address, 'version': self.version}
+        for i, port in enumerate(self.ports):
+            module.update({'input{0}'.format(i): port.input,
+                           'sensor{0}'.format(i): port.sensor,
+                           'times{0}'.format(i): port.times,
+                           'inverted{0}'.format(i): port.inverted})
+        return module
+
+
 @Injectable.named('power_controller')
 @Singleton
 class PowerController(object):
-    """ The PowerController keeps track of the registered power modules. """
+    """
+    The PowerController keeps track of the registered power modules. The configuration of the
+    modules is kept in memory, changes are written to the database and then reloaded.
+    """
 
     @Inject
     def __init__(self, power_db=INJECTED):
@@ -38,7 +77,8 @@ class PowerController(object):
 
         self._power_schema = {'name': 'TEXT default \'\'',
                               'address': 'INTEGER',
-                              'version': 'INTEGER'}
+                              'version': 'INTEGER',
+                              'day_night': 'TEXT'}  # The day/night modes that were last set on the module
         for i in xrange(NUM_PORTS[LARGEST_MODULE_TYPE]):
             self._power_schema.update({'input{0}'.format(i): 'TEXT default \'\'',
                                        'sensor{0}'.format(i): 'INT default 0',
@@ -51,8 +91,11 @@ class PowerController(object):
                                             isolation_level=None)
         self.__cursor = self.__connection.cursor()
         self.__lock = Lock()
+        self.__change_subscriptions = []
+        self.__modules = {}  # module id -> PowerModule
 
         self.__update_schema_if_needed()  # Table creations and/or migrations
+        self.__load_modules()
 
     @staticmethod
     def _power_setting_fields(amount):
@@ -84,6 +127,18 @@ class PowerController(object):
                         if field not in fields:
                             self.__cursor.execute('ALTER TABLE {0} ADD COLUMN {1} {2};'.format(table, field, default))
 
+    def __load_modules(self):
+        """ Loads the configuration of all modules from the database. """
+        fields = ['id', 'name', 'address', 'version', 'day_night'] + PowerController._power_setting_fields(NUM_PORTS[LARGEST_MODULE_TYPE])
+        modules = {}
+        with self.__lock:
+            for row in self.__cursor.execute('SELECT {0} FROM power_modules;'.format(', '.join(fields))):
+                version = row[3]
+                ports = [PowerPort(*row[5 + i * 4:9 + i * 4]) for i in xrange(NUM_PORTS.get(version, 0))]
+                day_night = None if row[4] is None else [int(mode) for mode in row[4].split(',')]
+                modules[row[0]] = PowerModule(row[0], row[1], row[2], version, ports, day_night)
+            self.__modules = modules
+
     def get_power_modules(self):
         """
         Get a dict containing all power modules. The key of the dict is the id of the module,
@@ -95,36 +150,54 @@ class PowerController(object):
         'input8', 'input9', 'input10', 'input11', 'times8', 'times9', 'times10', 'times11'.
         """
         power_modules = {}
-        fields = {}
-        for version in [POWER_MODULE, ENERGY_MODULE, P1_CONCENTRATOR]:
-            amount = NUM_PORTS[version]
-            fields[version] = ['id', 'name', 'address', 'version'] + PowerController._power_setting_fields(amount)
-        with self.__lock:
-            for row in self.__cursor.execute('SELECT {0} FROM power_modules;'.format(', '.join(fields[LARGEST_MODULE_TYPE]))):
-                version = row[3]
-                if version not in [POWER_MODULE, ENERGY_MODULE, P1_CONCENTRATOR]:
-                    raise ValueError('Unknown power api version')
-                power_modules[row[0]] = dict([(field, row[fields[version].index(field)])
-                                              for field in fields[version]])
-            return power_modules
+        for module in self.__modules.values():
+            if module.version not in [POWER_MODULE, ENERGY_MODULE, P1_CONCENTRATOR]:
+                raise ValueError('Unknown power api version')
+            power_modules[module.id] = module.to_dict()
+        return power_modules
+
+    def get_modules(self):
+        """ Get the configuration of all power modules, as :class`PowerModule` per module id. The
+        configuration is shared, and should not be changed. """
+        return dict(self.__modules)
 
     def get_address(self, id):
         """ Get the address of a module when the module id is provided. """
-        with self.__lock:
-            for row in self.__cursor.execute('SELECT address FROM power_modules WHERE id=?;', (id,)):
-                return row[0]
+        module = self.__modules.get(id)
+        return None if module is None else module.address
 
     def get_version(self, id):
         """ Get the version of a module when the module id is provided. """
-        with self.__lock:
-            for row in self.__cursor.execute('SELECT version FROM power_modules WHERE id=?;', (id,)):
-                return row[0]
+        module = self.__modules.get(id)
+        return None if module is None else module.version
 
     def module_exists(self, address):
         """ Check if a module with a certain address exists. """
+        return any(module.address == address for module in self.__modules.values())
+
+    def subscribe_module_changes(self, callback):
+        """
+        Subscribes a callback that is called when a module is registered, readdressed or updated
+        :param callback: the callback to call
+        """
+        self.__change_subscriptions.append(callback)
+
+    def __notify_module_changes(self):
+        for callback in self.__change_subscriptions:
+            callback()
+
+    def get_day_night_modes(self):
+        """ Get the day/night modes that were last set on the modules, per module id. """
+        return dict((module.id, list(module.day_night)) for module in self.__modules.values()
+                    if module.day_night is not None)
+
+    def set_day_night_modes(self, id, modes):
+        """ Store the day/night modes that were set on a module. """
         with self.__lock:
-            for row in self.__cursor.execute('SELECT count(id) FROM power_modules WHERE address=?;', (address,)):
-                return row[0] > 0
+            self.__cursor.execute('UPDATE power_modules SET day_night=? WHERE id=?;', (','.join(str(mode) for mode in modes), id))
+            module = self.__modules.get(id)
+            if module is not None:
+                module.day_night = list(modes)
 
     def update_power_module(self, module):
         """
@@ -146,24 +219,27 @@ class PowerController(object):
             self.__cursor.execute('UPDATE power_modules SET {0} WHERE id=?'.format(
                 ', '.join(['{0}=?'.format(field) for field in fields])
             ), tuple([module[field] for field in fields] + [module['id']]))
+        self.__load_modules()
+        self.__notify_module_changes()
 
     def register_power_module(self, address, version):
         """ Register a new power module using an address. """
         with self.__lock:
             self.__cursor.execute('INSERT INTO power_modules(address, version) VALUES (?, ?);', (address, version))
+        self.__load_modules()
+        self.__notify_module_changes()
 
     def readdress_power_module(self, old_address, new_address):
         """ Change the address of a power module. """
         with self.__lock:
             self.__cursor.execute('UPDATE power_modules SET address=? WHERE address=?;', (new_address, old_address))
+        self.__load_modules()
+        self.__notify_module_changes()
 
     def get_free_address(self):
         """ Get a free address for a power module. """
-        max_address = 0
-        with self.__lock:
-            for row in self.__cursor.execute('SELECT address FROM power_modules;'):
-                max_address = max(max_address, row[0])
-            return max_address + 1 if max_address < 255 else 1
+        max_address = max([0] + [module.address for module in self.__modules.values()])
+        return max_address + 1 if max_address < 255 else 1
 
     def close(self):
         """ Close the database connection. """
@@ -0,0 +1,123 @@
+# Copyright (C) 2020 OpenMotics BV
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+The power poll scheduler decides which power modules need to be read, so modules with stable
+readings are read less often than modules with changing readings.
+"""
+
+import time
+from threading import Lock
+
+
+class PowerPollScheduler(object):
+    """
+    Keeps a poll interval per power module. The interval starts at the requested interval, and
+    doubles after every read that shows stable readings (up to MAX_INTERVAL). A read that shows
+    changing readings, or a faster requested interval (e.g. a new subscriber), brings it back to
+    the requested interval. When reading all modules at their interval would keep the bus busy for
+    more than BUS_BUDGET of the time, all intervals are stretched.
+    """
+
+    MAX_INTERVAL = 60.0  # seconds
+    BUS_BUDGET = 0.5  # fraction of the time the bus can be used to poll the power modules
+    POWER_CHANGE = 0.05  # relative change of the power of a port
+    POWER_NOISE = 10.0  # W, changes below are never considered a change
+
+    def __init__(self):
+        self._modules = {}  # module id -> {'interval', 'last_read', 'power', 'duration', 'stable'}
+        self._requested_interval = None
+        self._lock = Lock()
+
+    def get_due_modules(self, module_ids, interval, now=None):
+        """
+        Returns the modules that need to be read.
+
+        :param module_ids: The ids of all power modules
+        :param interval: The requested poll interval (in seconds)
+        :param now: The current timestamp, defaults to the current time
+        """
+        now = time.time() if now is None else now
+        with self._lock:
+            for module_id in self._modules.keys():
+                if module_id not in module_ids:
+                    del self._modules[module_id]
+            if self._requested_interval is not None and interval < self._requested_interval:
+                for state in self._modules.itervalues():
+                    state['interval'] = interval
+            self._requested_interval = interval
+
+            stretch = self._get_stretch(interval)
+            due = []
+            for module_id in module_ids:
+                state = self._modules.get(module_id)
+                # Modules are read on the ticks of the requested interval, so the tick closest to the due time is used
+                if state is None or now >= state['last_read'] + self._get_interval(state, interval) * stretch - interval / 2.0:
+                    due.append(module_id)
+            return due
+
+    def update(self, module_id, power, duration, interval, now=None):
+        """
+        Registers a read of a power module.
+
+        :param module_id: The id of the power module
+        :param power: The power of every port of the module
+        :param duration: The time it took to read the module (in seconds)
+        :param interval: The requested poll interval (in seconds)
+        :param now: The timestamp of the read, defaults to the current time
+        """
+        now = time.time() if now is None else now
+        with self._lock:
+            state = self._modules.get(module_id)
+            if state is None:
+                self._modules[module_id] = {'interval': interval,
+                                            'last_read': now,
+                                            'power': list(power),
+                                            'duration': duration,
+                                            'stable': False}
+                return
+            stable = len(power) == len(state['power']) and all(
+                abs(new - old) <= max(PowerPollScheduler.POWER_NOISE, abs(old) * PowerPollScheduler.POWER_CHANGE)
+                for new, old in zip(power, state['power'])
+            )
+            if stable:
+                state['interval'] = min(max(interval, state['interval'] * 2), max(interval, PowerPollScheduler.MAX_INTERVAL))
+            else:
+                state['interval'] = interval
+            state['stable'] = stable
+            state['last_read'] = now
+            state['power'] = list(power)
+            state['duration'] = (state['duration'] + duration) / 2.0
+
+    def get_poll_rates(self):
+        """
+        Returns the effective poll rate per module:
+        {<module id>: {'interval': <seconds between reads>, 'stable': <bool>, 'bus_time': <seconds per read>}}
+        """
+        with self._lock:
+            if self._requested_interval is None:
+                return {}
+            stretch = self._get_stretch(self._requested_interval)
+            return dict((module_id, {'interval': self._get_interval(state, self._requested_interval) * stretch,
+                                     'stable': state['stable'],
+                                     'bus_time': state['duration']})
+                        for module_id, state in self._modules.iteritems())
+
+    @staticmethod
+    def _get_interval(state, interval):
+        return min(max(interval, state['interval']), max(interval, PowerPollScheduler.MAX_INTERVAL))
+
+    def _get_stretch(self, interval):
+        usage = sum(state['duration'] / self._get_interval(state, interval) for state in self._modules.itervalues())
+        return max(1.0, usage / PowerPollScheduler.BUS_BUDGET)
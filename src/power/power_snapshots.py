@@ -0,0 +1,157 @@
+# Copyright (C) 2020 OpenMotics BV
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+The power snapshot cache reads the realtime power and total energy of the power modules, and
+serves all consumers (API, metrics, plugins, ...) from timestamped snapshots.
+"""
+
+import logging
+import math
+import time
+from threading import Lock
+from ioc import Injectable, Inject, INJECTED, Singleton
+from power import power_api
+from serial_utils import CommunicationTimedOutException
+
+logger = logging.getLogger('openmotics')
+
+
+def convert_nan(number):
+    """ Convert nan to 0. """
+    if math.isnan(number):
+        logger.warning('Got an unexpected NaN')
+    return 0.0 if math.isnan(number) else number
+
+
+@Injectable.named('power_snapshot_cache')
+@Singleton
+class PowerSnapshotCache(object):
+    """
+    Keeps a snapshot of the realtime power and the total energy per power module. A module is only
+    read from the bus when its snapshot is older than the freshness bound, so consumers that ask for
+    the same values at about the same time share a single read.
+    """
+
+    MAX_AGE = 2.0  # seconds
+    SETTING_TTL = 60.0  # seconds, how long the `power_snapshot_max_age` setting is cached
+
+    @Inject
+    def __init__(self, power_communicator=INJECTED, power_controller=INJECTED, configuration_controller=INJECTED):
+        """
+        :type power_communicator: power.power_communicator.PowerCommunicator
+        :type power_controller: power.power_controller.PowerController
+        :type configuration_controller: gateway.config.ConfigurationController
+        """
+        self._power_communicator = power_communicator
+        self._power_controller = power_controller
+        self._config_controller = configuration_controller
+        self._snapshots = {}  # (kind, module id) -> (timestamp, values)
+        self._locks = {}  # (kind, module id) -> Lock, held while the module is read
+        self._locks_lock = Lock()
+        self._max_age = None  # (timestamp, `power_snapshot_max_age` setting)
+
+    def get_realtime_power(self, max_age=None, force_fresh=False, module_ids=None):
+        """
+        Get the realtime power measurement values.
+
+        :param max_age: Maximum age of the values in seconds, defaults to the `power_snapshot_max_age` setting.
+        :param force_fresh: Read the values from the modules, regardless of their age.
+        :param module_ids: Only get the values of these modules, defaults to all modules.
+        :returns: dict with the module id as key and the following array as value: \
+        [voltage, frequency, current, power].
+        """
+        return self._get('realtime_power', self._read_realtime_power, max_age, force_fresh, module_ids)
+
+    def get_total_energy(self, max_age=None, force_fresh=False, module_ids=None):
+        """
+        Get the total energy (kWh) consumed by the power modules.
+
+        :param max_age: Maximum age of the values in seconds, defaults to the `power_snapshot_max_age` setting.
+        :param force_fresh: Read the values from the modules, regardless of their age.
+        :param module_ids: Only get the values of these modules, defaults to all modules.
+        :returns: dict with the module id as key and the following array as value: [day, night].
+        """
+        return self._get('total_energy', self._read_total_energy, max_age, force_fresh, module_ids)
+
+    def get_snapshot_times(self):
+        """ Returns the time of the last snapshot, per kind and module id """
+        times = {}
+        for (kind, module_id), snapshot in self._snapshots.items():
+            times.setdefault(kind, {})[str(module_id)] = snapshot[0]
+        return times
+
+    def invalidate(self, module_id=None):
+        """ Drops the snapshots of a module (e.g. after changing its configuration), or of all modules """
+        for key in self._snapshots.keys():
+            if module_id is None or key[1] == module_id:
+                self._snapshots.pop(key, None)
+
+    def _get_max_age(self, now):
+        """ Returns the `power_snapshot_max_age` setting, only reading it from the configuration once in a while """
+        cached = self._max_age
+        if cached is None or now - cached[0] > PowerSnapshotCache.SETTING_TTL:
+            cached = (now, self._config_controller.get_setting('power_snapshot_max_age', PowerSnapshotCache.MAX_AGE))
+            self._max_age = cached
+        return cached[1]
+
+    def _get(self, kind, reader, max_age, force_fresh, module_ids):
+        output = {}
+        if self._power_communicator is None or self._power_controller is None:
+            return output
+        requested = time.time()
+        if max_age is None:
+            max_age = self._get_max_age(requested)
+        # A forced read is satisfied by a read that started after the request, e.g. one of a concurrent consumer
+        oldest = requested if force_fresh else requested - max_age
+        modules = self._power_controller.get_modules()
+        for module_id in sorted(modules.keys()):
+            if module_ids is not None and module_id not in module_ids:
+                continue
+            key = (kind, module_id)
+            with self._get_lock(key):
+                snapshot = self._snapshots.get(key)
+                if snapshot is None or snapshot[0] < oldest:
+                    start = time.time()
+                    try:
+                        snapshot = (start, reader(modules[module_id]))
+                    except CommunicationTimedOutException:
+                        logger.error('Communication timeout while fetching {0} from {1}: CommunicationTimedOutException'.format(kind, module_id))
+                        continue
+                    except Exception as ex:
+                        logger.exception('Got exception while fetching {0} from {1}: {2}'.format(kind, module_id, ex))
+                        continue
+                    self._snapshots[key] = snapshot
+            output[str(module_id)] = snapshot[1]
+        return output
+
+    def _get_lock(self, key):
+        lock = self._locks.get(key)
+        if lock is None:
+            with self._locks_lock:
+                lock = self._locks.setdefault(key, Lock())
+        return lock
+
+    def _read_realtime_power(self, module):
+        version = module.version
+        measurement = self._power_communicator.do_transaction(module.address, power_api.get_realtime_power(version))
+        return [[convert_nan(measurement.voltage[i]), convert_nan(measurement.frequency[i]),
+                 convert_nan(measurement.current[i]), convert_nan(measurement.power[i])]
+                for i in xrange(power_api.NUM_PORTS[version])]
+
+    def _read_total_energy(self, module):
+        version = module.version
+        measurement = self._power_communicator.do_transaction(module.address, power_api.get_total_energy(version))
+        return [[convert_nan(measurement.day[i]), convert_nan(measurement.night[i])]
+                for i in xrange(power_api.NUM_PORTS[version])]
@@ -0,0 +1,128 @@
+# Copyright (C) 2020 OpenMotics BV
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+The power bus statistics keep track of the command latencies, the failures and the utilization of
+the RS485 bus of the power modules.
+"""
+
+import time
+from threading import Lock
+from toolbox import Histogram
+
+
+class PowerBusStatistics(object):
+    """
+    Keeps track of command counts and latency histograms (in milliseconds) per module and per
+    command, of the retries, timeouts and CRC errors per module, and of the time the bus is busy.
+    The busy time is kept per second for the longest window, so all statistics use fixed memory.
+    """
+
+    BUCKETS = [2.5, 5, 10, 25, 50, 100, 250, 500, 1000, 2500]
+    WINDOWS = [10, 60, 300]  # seconds
+    COUNTERS = ['commands', 'retries', 'timeouts', 'crc_errors']
+
+    def __init__(self):
+        self._lock = Lock()
+        self._modules = {}  # address -> {'latency': Histogram, <counter>: int}
+        self._commands = {}  # command -> {'latency': Histogram, 'commands': int}
+        self._busy = [0.0] * max(PowerBusStatistics.WINDOWS)  # busy time per second, the slot of a second is second % length
+        self._second = None  # The last second that has a slot
+
+    def register_command(self, address, command, duration):
+        """
+        Registers a command that was answered.
+
+        :param address: Address of the power module
+        :param command: Name of the command, e.g. 'GVOL'
+        :param duration: Time (in seconds) between sending the command and receiving the answer
+        """
+        with self._lock:
+            command_statistics = self._commands.get(command)
+            if command_statistics is None:
+                command_statistics = {'commands': 0, 'latency': Histogram(PowerBusStatistics.BUCKETS)}
+                self._commands[command] = command_statistics
+            for statistics in [self._get_module(address), command_statistics]:
+                statistics['commands'] += 1
+                statistics['latency'].add(duration * 1000)
+
+    def register_failure(self, address, failure):
+        """
+        Registers a failure of a command.
+
+        :param address: Address of the power module
+        :param failure: 'retries', 'timeouts' or 'crc_errors'
+        """
+        with self._lock:
+            self._get_module(address)[failure] += 1
+
+    def register_busy(self, start, end):
+        """ Registers that the bus was used between start and end (timestamps). """
+        with self._lock:
+            self._advance(int(end))
+            oldest = self._second - len(self._busy)
+            while start < end:
+                second = int(start)
+                second_end = min(end, second + 1)
+                if second > oldest:
+                    self._busy[second % len(self._busy)] += second_end - start
+                start = second_end
+
+    def get_utilization(self, now=None):
+        """
+        :param now: The current timestamp, defaults to the current time
+        :returns: The percentage of the time the bus was busy, per window (in seconds)
+        """
+        second = int(time.time() if now is None else now)
+        with self._lock:
+            self._advance(second)
+            return dict((window, min(100.0, 100.0 * sum(self._busy[(second - i) % len(self._busy)] for i in xrange(window)) / window))
+                        for window in PowerBusStatistics.WINDOWS)
+
+    def get_summaries(self):
+        """
+        :returns: The counters and the average, 50th, 95th percentile and maximum latency per
+                  module and per command, e.g. {'modules': {<address>: {'commands': 10, 'retries': 0, ...,
+                  'latency_p95': 25}}, 'commands': {'GVOL': {...}}}
+        :rtype: dict
+        """
+        summaries = {'modules': {}, 'commands': {}}
+        with self._lock:
+            for section, items in [('modules', self._modules), ('commands', self._commands)]:
+                for name, statistics in items.iteritems():
+                    summary = dict((key, value) for key, value in statistics.iteritems() if key != 'latency')
+                    histogram = statistics['latency']
+                    summary['latency_avg'] = histogram.average
+                    summary['latency_max'] = histogram.max
+                    for percentile in [50, 95]:
+                        summary['latency_p{0}'.format(percentile)] = histogram.percentile(percentile)
+                    summaries[section][name] = summary
+        return summaries
+
+    def _get_module(self, address):
+        statistics = self._modules.get(address)
+        if statistics is None:
+            statistics = dict((counter, 0) for counter in PowerBusStatistics.COUNTERS)
+            statistics['latency'] = Histogram(PowerBusStatistics.BUCKETS)
+            self._modules[address] = statistics
+        return statistics
+
+    def _advance(self, second):
+        """ Clears the slots of the seconds up to the given second. """
+        if self._second is None:
+            self._second = second
+            return
+        for cleared in xrange(self._second + 1, min(second, self._second + len(self._busy)) + 1):
+            self._busy[cleared % len(self._busy)] = 0.0
+        self._second = max(self._second, second)
@@ -26,14 +26,28 @@ logger = logging.getLogger("openmotics")
 
 
 class TimeKeeper(object):
-    """ The TimeKeeper keeps track of time and sets the day or night mode on the power modules. """
+    """
+    The TimeKeeper keeps track of time and sets the day or night mode on the power modules. The
+    weekly schedules of the ports are compiled once, and the modes are only evaluated when the
+    next transition of a schedule is due, or when the modules are changed. The modes that were
+    set on the modules are stored, so they are not set again after a restart.
+    """
+
+    MAX_SLEEP = 3600  # seconds, the modes are evaluated at least this often, e.g. to follow clock changes
+    MINUTES_PER_WEEK = 7 * 24 * 60
 
     def __init__(self, power_communicator, power_controller, period):
+        """
+        :param period: the time (in seconds) it takes to pick up changed modules, and to retry after an error
+        """
         self.__power_communicator = power_communicator
         self.__power_controller = power_controller
         self.__period = period
 
-        self.__mode = {}
+        self.__mode = None  # module id -> modes, loaded from the power controller
+        self.__schedules = None  # module id -> (version, address, compiled schedule per port)
+        self.__transitions = []  # sorted minutes of the week on which a schedule changes
+        self.__next_run = 0
 
         self.__thread = None
         self.__stop = False
@@ -43,6 +57,7 @@ class TimeKeeper(object):
         if self.__thread is None:
             logger.info("Starting TimeKeeper")
             self.__stop = False
+            self.__power_controller.subscribe_module_changes(self.invalidate)
             self.__thread = Thread(target=self.__run, name="TimeKeeper thread")
             self.__thread.daemon = True
             self.__thread.start()
@@ -56,54 +71,93 @@ class TimeKeeper(object):
         else:
             raise Exception("TimeKeeper thread not running.")
 
+    def invalidate(self):
+        """ Reload the modules and their schedules. """
+        self.__schedules = None
+        self.__next_run = 0
+
     def __run(self):
         """ Code for the background thread. """
         while not self.__stop:
-            try:
-                self.__run_once()
-            except Exception:
-                logger.exception("Exception in TimeKeeper")
+            if time.time() >= self.__next_run:
+                try:
+                    self.__next_run = time.time() + self.__run_once()
+                except Exception:
+                    logger.exception("Exception in TimeKeeper")
+                    self.__next_run = time.time() + self.__period
 
-            time.sleep(self.__period)
+            time.sleep(max(0, min(self.__period, self.__next_run - time.time())))
 
         logger.info("Stopped TimeKeeper")
         self.__thread = None
 
-    def __run_once(self):
-        """ One run of the background thread. """
-        date = datetime.now()
-        for module in self.__power_controller.get_power_modules().values():
-            version = module['version']
-            if version == power_api.P1_CONCENTRATOR:
+    def __run_once(self, date=None):
+        """ One run of the background thread, returns the time (in seconds) until the next run. """
+        if self.__mode is None:
+            self.__mode = self.__power_controller.get_day_night_modes()
+        module_schedules = self.__schedules  # Read once, `invalidate` can reset it at any time
+        if module_schedules is None:
+            module_schedules = self.__load_schedules()
+
+        date = datetime.now() if date is None else date
+        for module_id, (version, address, schedules) in module_schedules.iteritems():
+            daynight = [power_api.DAY if TimeKeeper.is_day(schedule, date) else power_api.NIGHT
+                        for schedule in schedules]
+            self.__set_mode(module_id, version, address, daynight)
+
+        return self.__get_time_to_transition(date)
+
+    def __load_schedules(self):
+        """ Loads the compiled schedules of the modules and returns them. """
+        schedules = {}
+        transitions = set()
+        for module in self.__power_controller.get_modules().values():
+            if module.version == power_api.P1_CONCENTRATOR:
                 continue
-            daynight = []
-            for i in range(power_api.NUM_PORTS[version]):
-                if self.is_day_time(module['times%d' % i], date):
-                    daynight.append(power_api.DAY)
-                else:
-                    daynight.append(power_api.NIGHT)
-
-            self.__set_mode(version, module['address'], daynight)
+            ports = [TimeKeeper.compile_schedule(port.times) for port in module.ports]
+            schedules[module.id] = (module.version, module.address, ports)
+            for schedule in ports:
+                for day, (start, stop) in enumerate(schedule):
+                    if stop > start:
+                        transitions.update([day * 24 * 60 + start, day * 24 * 60 + stop])
+        self.__schedules = schedules
+        self.__transitions = sorted(transitions)
+        return schedules
+
+    def __get_time_to_transition(self, date):
+        if not self.__transitions:
+            return TimeKeeper.MAX_SLEEP
+        minute = date.weekday() * 24 * 60 + date.hour * 60 + date.minute
+        upcoming = [transition for transition in self.__transitions if transition > minute]
+        transition = upcoming[0] if upcoming else self.__transitions[0] + TimeKeeper.MINUTES_PER_WEEK
+        seconds = (transition - minute) * 60 - date.second - date.microsecond / 1000000.0
+        return min(TimeKeeper.MAX_SLEEP, seconds)
 
     @staticmethod
-    def is_day_time(times, date):
-        """ Check if a date is in day time. """
+    def compile_schedule(times):
+        """ Compiles the times of a port into a (start, stop) tuple, in minutes, per day of the week. """
         if times is None:
-            times = [0 for _ in range(14)]
-        else:
-            times = [int(t.replace(":", "")) for t in times.split(",")]
-
-        day_of_week = date.weekday()  # 0 = Monday, 6 = Sunday
-        current_time = date.hour * 100 + date.minute
-
-        start = times[day_of_week * 2]
-        stop = times[day_of_week * 2 + 1]
+            return [(0, 0)] * 7
+        times = [int(t.replace(":", "")) for t in times.split(",")]
+        return [((times[day * 2] / 100) * 60 + times[day * 2] % 100,
+                 (times[day * 2 + 1] / 100) * 60 + times[day * 2 + 1] % 100) for day in range(7)]
 
+    @staticmethod
+    def is_day(schedule, date):
+        """ Check if a date is in day time, according to a compiled schedule. """
+        start, stop = schedule[date.weekday()]  # 0 = Monday, 6 = Sunday
+        current_time = date.hour * 60 + date.minute
         return stop > current_time >= start
 
-    def __set_mode(self, version, address, bytes):
+    @staticmethod
+    def is_day_time(times, date):
+        """ Check if a date is in day time. """
+        return TimeKeeper.is_day(TimeKeeper.compile_schedule(times), date)
+
+    def __set_mode(self, module_id, version, address, bytes):
         """ Set the power modules mode. """
-        if address not in self.__mode or self.__mode[address] != bytes:
+        if self.__mode.get(module_id) != bytes:
             logger.info("Setting day/night mode to " + str(bytes))
             self.__power_communicator.do_command(address, power_api.set_day_night(version), *bytes)
-            self.__mode[address] = bytes
+            self.__mode[module_id] = bytes
+            self.__power_controller.set_day_night_modes(module_id, bytes)
@@ -20,8 +20,8 @@ Serial tools contains the RS485 wrapper, printable and CommunicationTimedOutExce
 
 import struct
 import fcntl
-from threading import Thread
-from Queue import Queue
+import time
+from threading import Thread, Condition
 
 
 class CommunicationTimedOutException(Exception):
@@ -43,7 +43,10 @@ def printable(data):
 
 
 class RS485(object):
-    """ Replicates the pyserial interface. """
+    """
+    Replicates the pyserial interface. The bytes received on the serial port are collected in a
+    buffer by a reader thread, and are handed out in chunks.
+    """
 
     def __init__(self, serial):
         """ Initialize a rs485 connection using the serial port. """
@@ -53,25 +56,66 @@ class RS485(object):
             serial_rs485 = struct.pack('hhhhhhhh', 3, 0, 0, 0, 0, 0, 0, 0)
             fcntl.ioctl(fileno, 0x542F, serial_rs485)
 
+        self.__buffer = bytearray()
+        self.__buffer_condition = Condition()
+        self.__stopped = False
+
         serial.timeout = None
         self.__thread = Thread(target=self._reader)
         self.__thread.daemon = True
         self.__thread.start()
-        self.read_queue = Queue()
 
     def write(self, data):
         """ Write data to serial port """
         self.__serial.write(data)
 
+    def read_chunk(self, timeout=None):
+        """
+        Returns all bytes that were received since the previous read, waits until at least one byte
+        is received. Returns an empty string if nothing was received within the timeout (in seconds).
+        """
+        end = None if timeout is None else time.time() + timeout
+        with self.__buffer_condition:
+            while not self.__buffer:
+                remaining = None if end is None else end - time.time()
+                if remaining is not None and remaining <= 0:
+                    break
+                self.__buffer_condition.wait(remaining)
+            data = str(self.__buffer)
+            del self.__buffer[:]
+        return data
+
+    def read(self, size=1, timeout=None):
+        """ Read size bytes from the serial port, less bytes are returned if the timeout expires """
+        end = None if timeout is None else time.time() + timeout
+        with self.__buffer_condition:
+            while len(self.__buffer) < size:
+                remaining = None if end is None else end - time.time()
+                if remaining is not None and remaining <= 0:
+                    break
+                self.__buffer_condition.wait(remaining)
+            data = str(self.__buffer[:size])
+            del self.__buffer[:size]
+        return data
+
+    def close(self):
+        """ Stops the reader thread and closes the serial port """
+        self.__stopped = True
+        self.__serial.cancel_read()
+        self.__thread.join()
+        self.__serial.close()
+
     def _reader(self):
         try:
-            while True:
-                byte = self.__serial.read(1)
-                if len(byte) == 1:
-                    self.read_queue.put(byte)
+            while not self.__stopped:
+                data = self.__serial.read(1)
                 size = self.__serial.inWaiting()
                 if size > 0:
-                    for byte in self.__serial.read(size):
-                        self.read_queue.put(byte)
+                    data += self.__serial.read(size)
+                if data:
+                    with self.__buffer_condition:
+                        self.__buffer += data
+                        self.__buffer_condition.notify_all()
         except Exception as ex:
-            print 'Error in reader: {0}'.format(ex)
+            if not self.__stopped:
+                print 'Error in reader: {0}'.format(ex)
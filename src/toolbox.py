@@ -16,11 +16,14 @@
 A few helper classes
 """
 
+import io
+import struct
 import time
 import msgpack
+from bisect import bisect_left
 from select import select
 from collections import deque
-from threading import Thread
+from threading import Thread, Condition
 
 
 class Full(Exception):
@@ -64,26 +67,81 @@ class Queue(object):
         return self._queue.clear()
 
 
+class Histogram(object):
+    """
+    A histogram with fixed buckets. A value is counted in the first bucket of which the upper
+    bound is equal to or larger than the value. Larger values go to an overflow bucket.
+    """
+
+    def __init__(self, buckets):
+        self.buckets = list(buckets)
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.count = 0
+        self.total = 0.0
+        self.max = None
+
+    def add(self, value):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.total += value
+        if self.max is None or value > self.max:
+            self.max = value
+
+    @property
+    def average(self):
+        if self.count == 0:
+            return None
+        return self.total / self.count
+
+    def percentile(self, percentile):
+        """ Estimates a percentile as the upper bound of the bucket in which it falls """
+        if self.count == 0:
+            return None
+        threshold = self.count * percentile / 100.0
+        cumulative = 0
+        for index, count in enumerate(self.counts):
+            cumulative += count
+            if cumulative >= threshold and count > 0:
+                if index < len(self.buckets):
+                    return min(self.buckets[index], self.max)
+                return self.max
+        return self.max
+
+    def serialize(self):
+        return {'buckets': self.buckets,
+                'counts': list(self.counts),
+                'count': self.count,
+                'total': self.total,
+                'max': self.max}
+
+
 class PluginIPCStream(object):
     """
     This class handles IPC communications.
 
-    It uses netstring: <data_length>:<data>,\n
-    * data_length: The length of `data`
-    * data: The actual payload, using the format <encoding_type>:<encoded_data>
-      * encoding_type: A one-character reference to the used encoding protocol
-        * 1 = msgpack
-      * encoded_data: The encoded data
+    Every message is framed as <length><data>
+    * length: The length of `data`, as a 4 byte unsigned big-endian integer
+    * data: The msgpack encoded message
+
+    Data is received in a reusable buffer and fed to a streaming unpacker, which
+    avoids building a new string for every read.
     """
 
+    HEADER = struct.Struct('>I')
+    BUFFER_SIZE = 64 * 1024
+
     def __init__(self, stream, logger, command_receiver=None):
-        self._buffer = ''
+        self._buffer = bytearray(PluginIPCStream.BUFFER_SIZE)
+        self._header = bytearray()
+        self._remaining = 0  # Bytes of the current message that still need to be received
+        self._unpacker = msgpack.Unpacker()
         self._command_queue = Queue()
         self._stream = stream
         self._read_thread = None
         self._logger = logger
         self._running = False
         self._command_receiver = command_receiver
+        self.bytes_read = 0
 
     def start(self):
         self._running = True
@@ -97,63 +155,234 @@ class PluginIPCStream(object):
             self._read_thread.join()
 
     def _read(self):
-        wait_for_length = None
+        view = memoryview(self._buffer)
+        # A raw reader returns whatever is available, instead of waiting until the requested amount is read
+        reader = io.FileIO(self._stream.fileno(), 'rb', closefd=False)
         while self._running:
             try:
-                if wait_for_length is None:
-                    # Waiting for a new command to start. Let's do 1 second polls to make sure we're not blocking forever
-                    # in case no new data will come
-                    read_available, _, _ = select([self._stream], [], [], 1.0)
-                    if not read_available:
-                        continue
-                # Minimum dataset: 0:x:,\n = 6 characters, so we always read at least 6 chars
-                self._buffer += self._stream.read(6 if wait_for_length is None else wait_for_length)
-                if wait_for_length is None:
-                    if ':' not in self._buffer:
-                        # This is unexpected, discard data
-                        self._buffer = ''
-                        continue
-                    length, self._buffer = self._buffer.split(':', 1)
-                    # The length defines the encoded data length. We to add 4 because of the `<encoding_protocol>:` and `,\n`
-                    wait_for_length = int(length) - len(self._buffer) + 2
-                    if wait_for_length > 0:
-                        continue
-                if self._buffer.endswith(',\n'):
-                    protocol, self._buffer = self._buffer.split(':', 1)
-                    command = PluginIPCStream._decode(protocol, self._buffer[:-2])
-                    if command is None:
-                        # Unexpected protocol
-                        self._buffer = ''
-                        wait_for_length = None
-                        continue
-                    if self._command_receiver is not None:
-                        self._command_receiver(command)
-                    else:
-                        self._command_queue.put(command)
-                self._buffer = ''
-                wait_for_length = None
+                # Let's do 1 second polls to make sure we're not blocking forever in case no new data will come
+                read_available, _, _ = select([reader], [], [], 1.0)
+                if not read_available:
+                    continue
+                length = reader.readinto(view)
+                if not length:
+                    break  # The other end closed the stream
+                self.bytes_read += length
+                self._process(view[:length])
             except Exception as ex:
                 self._logger('Unexpected read exception', ex)
 
+    def _process(self, data):
+        offset = 0
+        while offset < len(data):
+            if self._remaining == 0:
+                # The header can be spread over multiple reads
+                needed = PluginIPCStream.HEADER.size - len(self._header)
+                self._header += data[offset:offset + needed].tobytes()
+                offset += needed
+                if len(self._header) < PluginIPCStream.HEADER.size:
+                    return
+                self._remaining = PluginIPCStream.HEADER.unpack(bytes(self._header))[0]
+                del self._header[:]
+                continue
+            chunk = data[offset:offset + self._remaining]
+            self._unpacker.feed(chunk)
+            offset += len(chunk)
+            self._remaining -= len(chunk)
+            if self._remaining == 0:
+                self._dispatch()
+
+    def _dispatch(self):
+        try:
+            for command in self._unpacker:
+                if self._command_receiver is not None:
+                    self._command_receiver(command)
+                else:
+                    self._command_queue.put(command)
+        except Exception as ex:
+            # Discard the remainder of the message, the next one starts with a clean unpacker
+            self._unpacker = msgpack.Unpacker()
+            self._logger('Unexpected message', ex)
+
     def get(self, block=True, timeout=None):
         return self._command_queue.get(block, timeout)
 
     @staticmethod
     def write(data):
-        encode_type = '1'
-        data = PluginIPCStream._encode(encode_type, data)
-        return '{0}:{1}:{2},\n'.format(len(data) + 2, encode_type, data)
+        data = msgpack.dumps(data)
+        return PluginIPCStream.HEADER.pack(len(data)) + data
 
-    @staticmethod
-    def _encode(encode_type, data):
-        if encode_type == '1':
-            return msgpack.dumps(data)
-        return ''
+
+class IPCStreamSender(object):
+    """
+    Sends a body in chunks over the plugin IPC stream, as async messages:
+    * {'action': 'stream_chunk', 'stream_id': <id>, 'data': <chunk>} for every chunk
+    * {'action': 'stream_end', 'stream_id': <id>, 'error': <error or None>} after the last chunk
+
+    The receiver acknowledges every chunk it consumed with a 'stream_ack' message, and at most
+    WINDOW chunks can be unacknowledged. A 'stream_cancel' message stops the sender.
+    """
+
+    CHUNK_SIZE = 32 * 1024
+    WINDOW = 4
+
+    def __init__(self, stream_id, write, timeout=30.0):
+        self._stream_id = stream_id
+        self._write = write
+        self._timeout = timeout
+        self._credits = IPCStreamSender.WINDOW
+        self._cancelled = False
+        self._condition = Condition()
+
+    def ack(self):
+        with self._condition:
+            self._credits += 1
+            self._condition.notify()
+
+    def cancel(self):
+        with self._condition:
+            self._cancelled = True
+            self._condition.notify()
+
+    def send(self, body):
+        """ Sends the body (a string, an iterable of strings or a file-like object) """
+        error = None
+        try:
+            for chunk in IPCStreamSender._split(body):
+                if not self._acquire_credit():
+                    break
+                self._write({'cid': 0,
+                             'action': 'stream_chunk',
+                             'stream_id': self._stream_id,
+                             'data': chunk})
+        except Exception as ex:
+            error = str(ex) or ex.__class__.__name__
+        finally:
+            if hasattr(body, 'close'):
+                body.close()
+        self._write({'cid': 0,
+                     'action': 'stream_end',
+                     'stream_id': self._stream_id,
+                     'error': error})
+        return error is None
+
+    def _acquire_credit(self):
+        with self._condition:
+            end = time.time() + self._timeout
+            while self._credits == 0 and not self._cancelled:
+                remaining = end - time.time()
+                if remaining <= 0:
+                    raise RuntimeError('Stream not consumed within {0}s'.format(self._timeout))
+                self._condition.wait(remaining)
+            if self._cancelled:
+                return False
+            self._credits -= 1
+            return True
 
     @staticmethod
-    def _decode(encode_type, data):
-        if data == '':
-            return None
-        if encode_type == '1':
-            return msgpack.loads(data)
-        return None
+    def _split(body):
+        if hasattr(body, 'read'):
+            while True:
+                data = body.read(IPCStreamSender.CHUNK_SIZE)
+                if not data:
+                    return
+                yield data
+        if isinstance(body, basestring):
+            body = [body]
+        # Small pieces (e.g. lines of an export) are combined into chunks
+        pending = ''
+        for data in body:
+            if isinstance(data, unicode):
+                data = data.encode('utf-8')
+            pending += data
+            while len(pending) >= IPCStreamSender.CHUNK_SIZE:
+                yield pending[:IPCStreamSender.CHUNK_SIZE]
+                pending = pending[IPCStreamSender.CHUNK_SIZE:]
+        if pending:
+            yield pending
+
+
+class IPCStreamReceiver(object):
+    """
+    Receives a body sent by an IPCStreamSender. The body can be consumed by iterating over the
+    chunks, or as a file-like object using `read`.
+    """
+
+    def __init__(self, stream_id, write, timeout=30.0):
+        self._stream_id = stream_id
+        self._write = write
+        self._timeout = timeout
+        self._chunks = deque()
+        self._buffer = ''
+        self._finished = False
+        self._closed = False
+        self._error = None
+        self._condition = Condition()
+
+    def process_message(self, message):
+        """ Processes a 'stream_chunk' or 'stream_end' message of this stream """
+        with self._condition:
+            if message['action'] == 'stream_chunk':
+                self._chunks.append(message['data'])
+            else:
+                self._finished = True
+                self._error = message.get('error')
+            self._condition.notify()
+
+    def __iter__(self):
+        try:
+            if self._buffer:
+                data, self._buffer = self._buffer, ''
+                yield data
+            while True:
+                chunk = self._next_chunk()
+                if chunk is None:
+                    return
+                yield chunk
+        finally:
+            self.close()
+
+    def read(self, size=-1):
+        while size < 0 or len(self._buffer) < size:
+            chunk = self._next_chunk()
+            if chunk is None:
+                break
+            self._buffer += chunk
+        if size < 0:
+            data, self._buffer = self._buffer, ''
+        else:
+            data, self._buffer = self._buffer[:size], self._buffer[size:]
+        return data
+
+    def close(self):
+        """ Stops the sender if the body isn't fully received """
+        with self._condition:
+            if self._closed:
+                return
+            self._closed = True
+            self._buffer = ''
+            finished = self._finished
+        if not finished:
+            self._write({'cid': 0,
+                         'action': 'stream_cancel',
+                         'stream_id': self._stream_id})
+
+    def _next_chunk(self):
+        with self._condition:
+            if self._closed:
+                return None
+            end = time.time() + self._timeout
+            while not self._chunks and not self._finished:
+                remaining = end - time.time()
+                if remaining <= 0:
+                    raise RuntimeError('No stream data received within {0}s'.format(self._timeout))
+                self._condition.wait(remaining)
+            if not self._chunks:
+                if self._error is not None:
+                    raise RuntimeError('Stream failed: {0}'.format(self._error))
+                return None
+            chunk = self._chunks.popleft()
+        self._write({'cid': 0,
+                     'action': 'stream_ack',
+                     'stream_id': self._stream_id})
+        return chunk
@@ -22,7 +22,7 @@ import time
 import fakesleep
 from threading import Lock, Semaphore
 from ioc import SetTestMode, SetUpTestInjections
-from gateway.webservice import WebInterface
+from gateway.webservice import WebInterface, ApiStatistics
 from gateway.scheduling import SchedulingController
 
 
@@ -73,7 +73,8 @@ class SchedulingControllerTest(unittest.TestCase):
                             maintenance_controller=None,
                             message_client=None,
                             configuration_controller=None,
-                            thermostat_controller=None)
+                            thermostat_controller=None,
+                            api_statistics=ApiStatistics())
         controller = SchedulingController()
         SetUpTestInjections(scheduling_controller=controller)
         controller.set_webinterface(WebInterface())
@@ -20,8 +20,10 @@ Tests for the users module.
 
 import unittest
 import xmlrunner
+import sqlite3
 import time
 import os
+import mock
 from threading import Lock
 from ioc import SetTestMode, SetUpTestInjections
 from gateway.users import UserController
@@ -37,11 +39,14 @@ class UserControllerTest(unittest.TestCase):
     def setUp(self):  # pylint: disable=C0103
         """ Run before each test. """
         self._db = "test.user.{0}.db".format(time.time())
+        self._controllers = []
         if os.path.exists(self._db):
             os.remove(self._db)
 
     def tearDown(self):  # pylint: disable=C0103
         """ Run after each test. """
+        for controller in self._controllers:
+            controller.stop()
         if os.path.exists(self._db):
             os.remove(self._db)
 
@@ -51,7 +56,9 @@ class UserControllerTest(unittest.TestCase):
                             user_db_lock=Lock(),
                             config={'username': 'om', 'password': 'pass'},
                             token_timeout=10)
-        return UserController()
+        controller = UserController()
+        self._controllers.append(controller)
+        return controller
 
     def test_empty(self):
         """ Test an empty database. """
@@ -174,6 +181,90 @@ class UserControllerTest(unittest.TestCase):
 
         self.assertEquals(['om', 'test'], user_controller.get_usernames())
 
+    def test_token_persistence(self):
+        """ Test the tokens surviving a restart """
+        user_controller = self._get_controller()
+        token = user_controller.login('om', 'pass')[1]
+        logged_out_token = user_controller.login('om', 'pass')[1]
+        user_controller.logout(logged_out_token)
+        user_controller.close()
+
+        user_controller = self._get_controller()
+        self.assertTrue(user_controller.check_token(token))
+        self.assertFalse(user_controller.check_token(logged_out_token))
+        self.assertFalse(user_controller.check_token(None))
+
+        with mock.patch('time.time', return_value=time.time() + 20):
+            user_controller.login('om', 'pass')  # Evicts all expired tokens
+        self.assertFalse(user_controller.check_token(token))
+        self.assertEqual(1, len(user_controller._tokens))
+        self.assertEqual(1, len(user_controller._token_expiries))
+        user_controller.close()
+
+        user_controller = self._get_controller()
+        self.assertFalse(user_controller.check_token(token))
+
+    def test_token_write_behind(self):
+        """ Test persisting the tokens in batches, as hashes """
+        user_controller = self._get_controller()
+        with mock.patch.object(user_controller, '_execute', wraps=user_controller._execute) as execute:
+            tokens = [user_controller.login('om', 'pass')[1] for _ in xrange(3)]
+            self.assertNotIn('tokens', ' '.join(str(call[0][0]) for call in execute.call_args_list))
+        self.assertTrue(all(user_controller.check_token(token) for token in tokens))
+        self.assertIsNotNone(user_controller._token_timer)
+        user_controller.logout(tokens[0])
+        self.assertFalse(user_controller.check_token(tokens[0]))
+
+        user_controller.persist_tokens()
+        self.assertIsNone(user_controller._token_timer)
+        rows = list(user_controller._execute("SELECT token_hash FROM tokens;"))
+        self.assertEqual(sorted(UserController._hash_token(token) for token in tokens[1:]), sorted(row[0] for row in rows))
+
+        user_controller.logout(tokens[1])
+        user_controller.close()
+        user_controller = self._get_controller()
+        self.assertFalse(user_controller.check_token(tokens[1]))
+        self.assertTrue(user_controller.check_token(tokens[2]))
+        self.assertFalse(user_controller.check_token(UserController._hash_token(tokens[2])))
+
+    def test_token_persist_failure(self):
+        """ Test that the tokens of a failed persist are persisted later on """
+        user_controller = self._get_controller()
+        token = user_controller.login('om', 'pass')[1]
+        with mock.patch.object(user_controller, '_cursor', wraps=user_controller._cursor) as cursor:
+            cursor.executemany.side_effect = sqlite3.OperationalError('database is locked')
+            user_controller.persist_tokens()
+        self.assertIsNotNone(user_controller._token_timer)
+        user_controller.persist_tokens()
+        rows = list(user_controller._execute("SELECT token_hash FROM tokens;"))
+        self.assertEqual([UserController._hash_token(token)], [row[0] for row in rows])
+
+        # Expired tokens are removed by the timer as well, not on the login path
+        with mock.patch('time.time', return_value=time.time() + 20):
+            with mock.patch.object(user_controller, '_execute', wraps=user_controller._execute) as execute:
+                user_controller.login('om', 'pass')
+                self.assertNotIn('tokens', ' '.join(str(call[0][0]) for call in execute.call_args_list))
+        self.assertEqual([UserController._hash_token(token)], list(user_controller._removed_tokens))
+
+    def test_credentials_cache(self):
+        """ Test caching verified credentials """
+        user_controller = self._get_controller()
+        user_controller.create_user('test', 'test', 'admin', True, True)
+        self.assertTrue(user_controller.login('test', 'test')[0])
+        with mock.patch.object(user_controller, '_execute', wraps=user_controller._execute) as execute:
+            self.assertTrue(user_controller.login('test', 'test')[0])
+            self.assertNotIn('SELECT', ' '.join(str(call[0][0]) for call in execute.call_args_list))
+        self.assertEqual('invalid_credentials', user_controller.login('test', 'other')[1])
+
+        user_controller.create_user('test', 'other', 'admin', True, True)
+        self.assertEqual('invalid_credentials', user_controller.login('test', 'test')[1])
+        self.assertTrue(user_controller.login('test', 'other')[0])
+
+        with mock.patch('time.time', return_value=time.time() + UserController.CREDENTIALS_CACHE_TIMEOUT + 1):
+            with mock.patch.object(user_controller, '_execute', wraps=user_controller._execute) as execute:
+                self.assertTrue(user_controller.login('test', 'other')[0])
+                self.assertIn('SELECT', ' '.join(str(call[0][0]) for call in execute.call_args_list))
+
 
 if __name__ == '__main__':
     unittest.main(testRunner=xmlrunner.XMLTestRunner(output='../gw-unit-reports'))
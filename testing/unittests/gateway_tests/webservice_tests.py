@@ -0,0 +1,244 @@
+# Copyright (C) 2020 OpenMotics BV
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+Tests for the webservice module.
+"""
+
+import gzip
+import unittest
+import xmlrunner
+import mock
+import zlib
+import cherrypy
+import ujson as json
+from StringIO import StringIO
+from cherrypy._cpdispatch import Dispatcher
+from cherrypy._cprequest import Request, Response
+from cherrypy.lib.httputil import Host, HeaderMap
+from ioc import SetTestMode, SetUpTestInjections
+from gateway.webservice import WebInterface, WebService, ServerStatistics, ApiStatistics, PluginDispatcher, \
+    compression_handler
+
+
+class WebInterfaceTest(unittest.TestCase):
+    """ Tests for the WebInterface. """
+
+    @classmethod
+    def setUpClass(cls):
+        SetTestMode()
+
+    def setUp(self):
+        self.gateway_api = mock.Mock()
+        SetUpTestInjections(user_controller=mock.Mock(),
+                            gateway_api=self.gateway_api,
+                            maintenance_controller=mock.Mock(),
+                            message_client=mock.Mock(),
+                            configuration_controller=mock.Mock(),
+                            scheduling_controller=mock.Mock(),
+                            thermostat_controller=mock.Mock(),
+                            api_statistics=ApiStatistics())
+        self.web = WebInterface()
+
+    def test_execute_api_call(self):
+        """ Test in-process execution of API calls """
+        self.gateway_api.get_outputs_status.return_value = [{'id': 1, 'status': 1}]
+        status, data = self.web.execute_api_call('get_output_status')
+        self.assertEqual(200, status)
+        self.assertEqual({'success': True, 'status': [{'id': 1, 'status': 1}]}, data)
+
+        self.gateway_api.set_output_status.return_value = {}
+        status, data = self.web.execute_api_call('set_output', {'id': '2', 'is_on': 'false'})
+        self.assertEqual(200, status)
+        self.assertTrue(data['success'])
+        self.gateway_api.set_output_status.assert_called_with(2, False, None, None)
+
+        for name, parameters in [('set_output', {'id': 'foo', 'is_on': True}),
+                                 ('set_output', {'id': [1], 'is_on': True}),
+                                 ('get_output_status', [1]),
+                                 ('get_output_status', 'foo')]:
+            status, data = self.web.execute_api_call(name, parameters)
+            self.assertEqual(406, status)
+            self.assertEqual({'success': False, 'msg': 'invalid_parameters'}, data)
+
+        for name in ['unknown', '_call_api', 'index', 'logout', 'set_plugin_controller']:
+            status, data = self.web.execute_api_call(name)
+            self.assertEqual(404, status)
+            self.assertEqual({'success': False, 'msg': 'unknown_call'}, data)
+
+        status, _ = self.web.execute_api_call('get_output_status', plugin_exposed_only=True)
+        self.assertEqual(200, status)
+        status, data = self.web.execute_api_call('get_api_statistics', plugin_exposed_only=True)
+        self.assertEqual(404, status)
+        self.assertEqual({'success': False, 'msg': 'unknown_call'}, data)
+
+    def test_batch(self):
+        """ Test executing multiple calls in one request """
+        self.gateway_api.get_outputs_status.return_value = [{'id': 1, 'status': 1}]
+        self.gateway_api.get_input_status.return_value = [{'id': 2}]
+        self.gateway_api.set_output_status.side_effect = RuntimeError('foo')
+        for concurrent in [False, True]:
+            calls = [{'name': 'get_output_status'},
+                     {'name': 'get_input_status'},
+                     {'name': 'set_output', 'parameters': {'id': 1, 'is_on': True}},
+                     {'name': 'batch', 'parameters': {'calls': []}},
+                     'get_output_status',
+                     {'name': 'set_output', 'parameters': {'id': [1], 'is_on': True}},
+                     {'name': 'get_output_status', 'parameters': [1]},
+                     {'name': 'get_output_status'}]
+            response = json.loads(self.web.batch(calls=calls, concurrent=concurrent))
+            self.assertTrue(response['success'])
+            self.assertEqual([{'success': True, 'status': [{'id': 1, 'status': 1}]},
+                              {'success': True, 'status': [{'id': 2}]},
+                              {'success': False, 'msg': 'foo'},
+                              {'success': False, 'msg': 'invalid_call'},
+                              {'success': False, 'msg': 'invalid_call'},
+                              {'success': False, 'msg': 'invalid_parameters'},
+                              {'success': False, 'msg': 'invalid_parameters'},
+                              {'success': True, 'status': [{'id': 1, 'status': 1}]}], response['results'])
+
+    def test_api_statistics(self):
+        """ Test collecting statistics of API calls """
+        statistics = self.web._api_statistics
+        self.gateway_api.get_outputs_status.return_value = []
+        self.web.get_output_status()
+        self.gateway_api.get_outputs_status.side_effect = RuntimeError('foo')
+        self.web.get_output_status()
+        self.web.execute_api_call('get_output_status')
+        data = statistics.get_statistics()
+        self.assertEqual(['get_output_status'], data.keys())
+        self.assertEqual(3, data['get_output_status']['requests'])
+        self.assertEqual(2, data['get_output_status']['errors'])
+        self.assertEqual(3, data['get_output_status']['timings']['total']['count'])
+        self.assertEqual(3, data['get_output_status']['timings']['handler']['count'])
+        self.assertEqual(2, data['get_output_status']['timings']['serialization']['count'])
+
+    def test_api_statistics_summaries(self):
+        """ Test summarizing the latency histograms """
+        statistics = ApiStatistics()
+        for duration in [0.0005, 0.004, 0.004, 0.02, 0.3]:
+            statistics.register('foo', False, {'total': duration})
+        statistics.register('foo', True, {'total': 20})
+        summary = statistics.get_summaries()['foo']
+        self.assertEqual(6, summary['requests'])
+        self.assertEqual(1, summary['errors'])
+        self.assertEqual(5, summary['total_p50'])
+        self.assertEqual(20000, summary['total_p95'])
+        self.assertEqual(20000, summary['total_max'])
+        self.assertAlmostEqual(20328.5 / 6, summary['total_avg'])
+        self.assertIsNone(summary['handler_avg'])
+        self.assertEqual([1, 0, 2, 0, 1, 0, 0, 0, 1, 0, 0, 0, 0, 1],
+                         statistics.get_statistics()['foo']['timings']['total']['counts'])
+
+
+class WebServiceToolsTest(unittest.TestCase):
+    """ Tests for the web service tools. """
+
+    def _load_request(self, body, accept_encoding=None):
+        cherrypy.serving.request = Request(Host('127.0.0.1', 80), Host('127.0.0.1', 1234))
+        cherrypy.serving.request.headers = HeaderMap()
+        if accept_encoding is not None:
+            cherrypy.serving.request.headers['Accept-Encoding'] = accept_encoding
+        cherrypy.serving.response = Response()
+        cherrypy.serving.response.headers['Content-Type'] = 'application/json'
+        cherrypy.serving.response.body = body
+        return cherrypy.serving.response
+
+    def test_compression(self):
+        """ Test compressing large responses """
+        large = json.dumps({'data': range(1000)})
+        response = self._load_request(large, 'gzip, deflate')
+        compression_handler(threshold=1024)
+        self.assertEqual('gzip', response.headers['Content-Encoding'])
+        self.assertEqual(large, gzip.GzipFile(fileobj=StringIO(''.join(response.body))).read())
+
+        response = self._load_request(large, 'deflate')
+        compression_handler(threshold=1024)
+        self.assertEqual('deflate', response.headers['Content-Encoding'])
+        self.assertEqual(large, zlib.decompress(''.join(response.body)))
+
+        for body, accept_encoding in [(large, None),
+                                      (large, 'gzip;q=0'),
+                                      ('{"success": true}', 'gzip')]:
+            response = self._load_request(body, accept_encoding)
+            compression_handler(threshold=1024)
+            self.assertNotIn('Content-Encoding', response.headers)
+            self.assertEqual(body, ''.join(response.body))
+
+    def test_statistics(self):
+        """ Test collecting the server statistics """
+        server = mock.Mock(socket_port=443)
+        server.httpserver.requests = mock.Mock(qsize=2, idle=3, _threads=range(10))
+        statistics = ServerStatistics()
+        statistics.add_server('https', server)
+        statistics.register(443, 0.1, 200)
+        statistics.register(443, 0.3, 500)
+        statistics.register(80, 0.5, 200)  # Unknown server
+        data = statistics.get_statistics()
+        self.assertEqual(['https'], data.keys())
+        data = data['https']
+        self.assertEqual(2, data['requests'])
+        self.assertEqual(1, data['errors'])
+        self.assertAlmostEqual(0.2, data['latency_avg'])
+        self.assertAlmostEqual(0.3, data['latency_max'])
+        self.assertEqual(2, data['queue'])
+        self.assertEqual(10, data['threads'])
+        self.assertEqual(7, data['active_connections'])
+
+
+class PluginDispatcherTest(unittest.TestCase):
+    """ Tests for dispatching plugin requests. """
+
+    @classmethod
+    def setUpClass(cls):
+        SetTestMode()
+
+    def test_mounting(self):
+        """ Test attaching and detaching plugins at runtime """
+        class Service(object):
+            def __init__(self):
+                self.method = None
+
+            def _cp_dispatch(self, vpath):
+                self.method = vpath.pop()
+                return self
+
+            @cherrypy.expose
+            def index(self):
+                pass
+
+        SetUpTestInjections(web_interface=mock.Mock(),
+                            configuration_controller=mock.Mock())
+        web_service = WebService()
+        cherrypy.serving.request = Request(Host('127.0.0.1', 80), Host('127.0.0.1', 1234))
+        cherrypy.serving.request.app = cherrypy.Application(PluginDispatcher(web_service._plugin_services), '/plugins')
+
+        def _find_handler(path):
+            handler = Dispatcher().find_handler(path)
+            return None if handler[0] is None else handler[0].__self__
+
+        service = Service()
+        self.assertIsNone(_find_handler('/foo/bar'))
+        web_service.mount_plugin('foo', service)
+        self.assertEqual(['foo'], web_service.get_plugin_mounts())
+        self.assertIs(service, _find_handler('/foo/bar'))
+        self.assertEqual('bar', service.method)
+        self.assertIsNone(_find_handler('/other/bar'))
+        web_service.unmount_plugin('foo')
+        self.assertEqual([], web_service.get_plugin_mounts())
+        self.assertIsNone(_find_handler('/foo/bar'))
+
+
+if __name__ == '__main__':
+    unittest.main(testRunner=xmlrunner.XMLTestRunner(output='../gw-unit-reports'))
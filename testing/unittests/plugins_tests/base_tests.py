@@ -18,14 +18,18 @@ Tests for plugins.base.
 
 import hashlib
 import inspect
+import json
+import mock
 import os
 import plugin_runtime
 import shutil
+import signal
 import tempfile
 import time
 import unittest
 import xmlrunner
 from subprocess import call
+from threading import Thread
 
 from gateway.observer import Event
 from plugin_runtime.base import PluginConfigChecker, PluginException
@@ -75,9 +79,9 @@ class PluginControllerTest(unittest.TestCase):
             shutil.rmtree(path)
 
     @staticmethod
-    def _get_controller(observer=None):
+    def _get_controller(observer=None, web_interface=None):
         from plugins.base import PluginController
-        controller = PluginController(web_interface=None,
+        controller = PluginController(web_interface=web_interface,
                                       configuration_controller=None,
                                       observer=observer,
                                       runtime_path=PluginControllerTest.RUNTIME_PATH,
@@ -178,6 +182,7 @@ class P1(OMPluginBase):
         self._input_data = None
         self._input_data_version_2 = None
         self._output_data = None
+        self._output_data_version_2 = None
         self._event_data = None
 
     @om_expose(auth=True)
@@ -190,6 +195,7 @@ class P1(OMPluginBase):
                 'input_data': self._input_data,
                 'input_data_version_2': self._input_data_version_2,
                 'output_data': self._output_data,
+                'output_data_version_2': self._output_data_version_2,
                 'event_data': self._event_data}
 
     @input_status
@@ -207,6 +213,10 @@ class P1(OMPluginBase):
     @output_status
     def output(self, output_status_inst):
         self._output_data = output_status_inst
+
+    @output_status(version=2)
+    def output_version_2(self, output_status_inst):
+        self._output_data_version_2 = output_status_inst
         
     @receive_events
     def recv_events(self, code):
@@ -244,7 +254,7 @@ class P1(OMPluginBase):
             controller.process_observer_event(Event(event_type=Event.Types.OUTPUT_CHANGE, data=output_event))
             controller.process_event(1)
 
-            keys = ['input_data', 'input_data_version_2', 'output_data', 'event_data']
+            keys = ['input_data', 'input_data_version_2', 'output_data', 'output_data_version_2', 'event_data']
             start = time.time()
             while time.time() - start < 2:
                 response = controller._request('P1', 'get_log')
@@ -255,15 +265,89 @@ class P1(OMPluginBase):
                                         'input_data': [1, None],  # only rising edges should be triggered
                                         'input_data_version_2': {'input_id': 2, 'status': False},
                                         'output_data': [[1, 5]],
+                                        'output_data_version_2': [{'id': 1, 'status': True, 'dimmer': 5}],
                                         'event_data': 1})
 
             plugin_logs = controller.get_logs().get('P1', '')
             self.assertTrue('Version 3 is not supported for input status decorators' in plugin_logs)
+            records = controller.get_log_records('P1')['records']
+            errors = [record for record in records if 'Version 3 is not supported' in record['message']]
+            self.assertEqual({'ERROR'}, set(record['level'] for record in errors))
+            cursor = controller.get_log_records('P1', cursor=errors[0]['id'] - 1, limit=1)['cursor']
+            self.assertEqual(errors[0]['id'], cursor)
+
+            # The logs are persisted, and loaded again on restart
+            controller.stop()
+            controller = PluginControllerTest._get_controller(observer=observer)
+            controller.start()
+            self.assertEqual(records, controller.get_log_records('P1', limit=len(records))['records'])
         finally:
             if controller is not None:
                 controller.stop()
             PluginControllerTest._destroy_plugin('P1')
 
+    def test_output_status_coalescing(self):
+        """ Validates that output changes within a short window are delivered at once """
+        controller = None
+        try:
+            PluginControllerTest._create_plugin('Outputs', """
+from plugins.base import *
+
+class Outputs(OMPluginBase):
+    name = 'Outputs'
+    version = '1.0.0'
+    interfaces = []
+
+    def __init__(self, webservice, logger):
+        OMPluginBase.__init__(self, webservice, logger)
+        self._states = []
+        self._changes = []
+
+    @om_expose(auth=False)
+    def get_log(self):
+        return {'states': self._states,
+                'changes': self._changes}
+
+    @output_status
+    def states(self, status):
+        self._states.append(status)
+
+    @output_status(version=2)
+    def changes(self, changes):
+        self._changes.append(changes)
+""")
+            outputs = [{'id': output_id, 'dimmer': 100, 'status': 0} for output_id in range(40)]
+            observer = type('Observer', (), {})()
+            observer.get_outputs = lambda: outputs
+            controller = PluginControllerTest._get_controller(observer=observer)
+            controller.start()
+
+            for output in outputs:
+                output['status'] = 1
+                controller.process_observer_event(Event(event_type=Event.Types.OUTPUT_CHANGE,
+                                                        data={'id': output['id'],
+                                                              'status': {'on': True, 'value': 100}}))
+            time.sleep(0.5)
+            outputs[3]['status'] = 0
+            controller.process_observer_event(Event(event_type=Event.Types.OUTPUT_CHANGE,
+                                                    data={'id': 3,
+                                                          'status': {'on': False, 'value': 100}}))
+            start = time.time()
+            while time.time() - start < 2:
+                response = controller._request('Outputs', 'get_log')
+                if len(response['states']) == 2:
+                    break
+                time.sleep(0.1)
+            self.assertEqual(2, len(response['states']))
+            self.assertEqual(40, len(response['states'][0]))
+            self.assertEqual(39, len(response['states'][1]))
+            self.assertEqual([[{'id': output_id, 'status': True, 'dimmer': 100} for output_id in range(40)],
+                              [{'id': 3, 'status': False, 'dimmer': 100}]], response['changes'])
+        finally:
+            if controller is not None:
+                controller.stop()
+            PluginControllerTest._destroy_plugin('Outputs')
+
     def test_update_plugin(self):
         """ Validates whether a plugin can be updated """
         test_1_md5, test_1_data = PluginControllerTest._create_plugin_package('Test', """
@@ -297,6 +381,329 @@ class Test(OMPluginBase):
         self.assertEqual(result, 'Plugin successfully installed')
         self.assertEqual([r.name for r in controller.get_plugins()], ['Test'])
 
+    def test_concurrent_requests(self):
+        """ Validates that a slow request does not block other requests to the same plugin """
+        controller = None
+        try:
+            PluginControllerTest._create_plugin('Slow', """
+import time
+from plugins.base import *
+
+class Slow(OMPluginBase):
+    name = 'Slow'
+    version = '1.0.0'
+    interfaces = []
+
+    @om_expose(auth=False)
+    def slow(self):
+        time.sleep(2)
+        return 'slow'
+
+    @om_expose(auth=False)
+    def fast(self):
+        return 'fast'
+""")
+            controller = PluginControllerTest._get_controller()
+            controller.start()
+
+            responses = []
+            thread = Thread(target=lambda: responses.append(controller._request('Slow', 'slow')))
+            thread.start()
+            time.sleep(0.2)
+            start = time.time()
+            responses.append(controller._request('Slow', 'fast'))
+            self.assertLess(time.time() - start, 1)
+            thread.join()
+            self.assertEqual(['fast', 'slow'], responses)
+        finally:
+            if controller is not None:
+                controller.stop()
+            PluginControllerTest._destroy_plugin('Slow')
+
+    def test_zygote(self):
+        """ Validates that plugins are forked from the zygote, and that it's restarted when it's gone """
+        controller = None
+        try:
+            PluginControllerTest._create_plugin('Forked', """
+import os
+from plugins.base import *
+
+class Forked(OMPluginBase):
+    name = 'Forked'
+    version = '1.0.0'
+    interfaces = []
+
+    @om_expose(auth=False)
+    def pid(self):
+        return str(os.getpid())
+""")
+            controller = PluginControllerTest._get_controller()
+            controller.start()
+            runner = controller._PluginController__runners['Forked']
+            self.assertTrue(runner.startup_times['zygote'])
+            self.assertEqual(str(runner._proc.pid), controller._request('Forked', 'pid'))
+            zygote = controller._PluginController__zygote
+            zygote_pid = zygote._proc.pid
+            self.assertIn(runner._proc.pid, zygote._processes)
+
+            controller.stop_plugin('Forked')
+            self._wait_for_exit(runner._proc)
+            controller.start_plugin('Forked')
+            self.assertTrue(runner.startup_times['zygote'])
+            self.assertEqual(zygote_pid, zygote._proc.pid)
+
+            zygote._proc.kill()
+            zygote._proc.wait()
+            lost_process = runner._proc
+            with mock.patch('os.kill', wraps=os.kill) as kill:
+                self.assertFalse(runner.is_running())  # Its exit can't be reported anymore, so it's killed
+                kill.assert_called_once_with(lost_process.pid, signal.SIGKILL)
+            self.assertEqual(-signal.SIGKILL, lost_process.poll())
+            # The watchdog starts the runner again, on a new zygote
+            controller._PluginController__watchdogs['Forked']._check()
+            self.assertTrue(runner.is_running())
+            self.assertTrue(runner.startup_times['zygote'])
+            self.assertNotEqual(zygote_pid, zygote._proc.pid)
+            self.assertEqual(str(runner._proc.pid), controller._request('Forked', 'pid'))
+        finally:
+            if controller is not None:
+                controller.stop()
+            PluginControllerTest._destroy_plugin('Forked')
+
+    def test_resource_usage(self):
+        """ Validates the resource accounting of plugins, and the throttling of plugins over budget """
+        controller = None
+        try:
+            PluginControllerTest._create_plugin('Hungry', """
+from plugins.base import *
+
+class Hungry(OMPluginBase):
+    name = 'Hungry'
+    version = '1.0.0'
+    interfaces = []
+
+    def __init__(self, webservice, logger):
+        OMPluginBase.__init__(self, webservice, logger)
+        self.events = []
+
+    @om_expose(auth=False)
+    def ping(self):
+        return 'pong'
+
+    @om_expose(auth=False)
+    def get_events(self):
+        return str(len(self.events))
+
+    @receive_events
+    def recv_events(self, code):
+        self.events.append(code)
+""")
+            controller = PluginControllerTest._get_controller()
+            controller.start()
+            for _ in range(5):
+                self.assertEqual('pong', controller._request('Hungry', 'ping'))
+            runner = controller._PluginController__runners['Hungry']
+            self.assertTrue(runner.startup_times['zygote'])
+            with mock.patch('psutil.Process') as process:
+                runner._check_resources()
+                self.assertFalse(process.called)  # A forked runtime is sampled by the zygote
+            usage = controller.get_resource_usage()['Hungry']
+            self.assertGreater(usage['rss'], 0)
+            self.assertGreaterEqual(usage['cpu_time'], 0)
+            self.assertGreater(usage['ipc_in'], 0)
+            self.assertGreater(usage['ipc_out'], 0)
+            self.assertGreaterEqual(usage['commands'], 5)
+            self.assertIsNotNone(usage['command_p95'])
+            self.assertEqual(0, usage['queue_drops'])
+            self.assertIsNone(usage['throttle'])
+
+            runner.set_limits(rss=1)  # MB
+            runner._check_resources()
+            self.assertEqual('pause', runner.get_resource_usage()['throttle'])
+            for code in range(3):
+                controller.process_event(code)
+            self.assertEqual('0', controller._request('Hungry', 'get_events'))
+            self.assertEqual(3, runner.get_resource_usage()['queue_drops'])
+
+            runner.set_limits()
+            runner._check_resources()
+            self.assertIsNone(runner.get_resource_usage()['throttle'])
+            controller.process_event(4)
+            time.sleep(0.5)
+            self.assertEqual('1', controller._request('Hungry', 'get_events'))
+        finally:
+            if controller is not None:
+                controller.stop()
+            PluginControllerTest._destroy_plugin('Hungry')
+
+    def test_collect_metrics(self):
+        """ Validates that metric collectors run in parallel, and late results are carried over """
+        controller = None
+        try:
+            PluginControllerTest._create_plugin('Collectors', """
+import time
+from plugins.base import *
+
+class Collectors(OMPluginBase):
+    name = 'Collectors'
+    version = '1.0.0'
+    interfaces = []
+
+    @om_metric_data(interval=60)
+    def fast(self):
+        yield {'type': 'fast', 'timestamp': 0, 'tags': {}, 'values': {'value': 1}}
+
+    @om_metric_data(interval=60)
+    def slow(self):
+        time.sleep(1)
+        yield {'type': 'slow', 'timestamp': 0, 'tags': {}, 'values': {'value': 2}}
+""")
+            controller = PluginControllerTest._get_controller()
+            controller.start()
+
+            start = time.time()
+            metrics = list(controller.collect_metrics(timeout=0.5))
+            self.assertLess(time.time() - start, 0.9)
+            self.assertEqual(['fast'], [metric['type'] for metric in metrics])
+            self.assertEqual('Collectors', metrics[0]['source'])
+
+            time.sleep(1)
+            metrics = list(controller.collect_metrics(timeout=0.5))
+            self.assertEqual(['slow'], [metric['type'] for metric in metrics])  # Carried over, fast isn't due
+
+            statistics = controller.get_collector_statistics()['Collectors']
+            self.assertEqual(1, statistics['fast']['runs'])
+            self.assertEqual(0, statistics['fast']['late'])
+            self.assertEqual(1, statistics['slow']['runs'])
+            self.assertEqual(1, statistics['slow']['late'])
+            self.assertEqual(0, statistics['slow']['timeouts'])
+            self.assertGreaterEqual(statistics['slow']['duration_max'], 1000)
+        finally:
+            if controller is not None:
+                controller.stop()
+            PluginControllerTest._destroy_plugin('Collectors')
+
+    def _wait_for_exit(self, process, timeout=5):
+        end = time.time() + timeout
+        while process.poll() is None and time.time() < end:
+            time.sleep(0.1)
+        self.assertIsNotNone(process.poll())
+
+    def test_api_channel(self):
+        """ Validates that plugins execute API calls over the IPC pipe """
+        controller = None
+        try:
+            PluginControllerTest._create_plugin('Api', """
+from plugins.base import *
+
+class Api(OMPluginBase):
+    name = 'Api'
+    version = '1.0.0'
+    interfaces = []
+
+    def __init__(self, webinterface, logger):
+        super(Api, self).__init__(webinterface, logger)
+        self.status = self.webinterface.get_output_status()  # Answered while the plugin is being started
+
+    @om_expose(auth=False)
+    def outputs(self):
+        return self.webinterface.get_output_status()
+
+    @om_expose(auth=False)
+    def set_output(self):
+        return self.webinterface.set_output(id=1, is_on=True)
+""")
+            calls = []
+
+            def _execute_api_call(name, parameters=None, plugin_exposed_only=False):
+                calls.append((name, parameters, plugin_exposed_only))
+                return 200, {'success': True, 'status': [{'id': 1, 'status': 1}]}
+
+            web_interface = type('WebInterface', (), {'execute_api_call': staticmethod(_execute_api_call),
+                                                      'get_plugin_api_manifest': staticmethod(lambda: {
+                                                          'version': 1,
+                                                          'calls': {'get_output_status': [],
+                                                                    'set_output': ['id', 'is_on', 'dimmer', 'timer']}
+                                                      })})()
+            controller = PluginControllerTest._get_controller(web_interface=web_interface)
+            start = time.time()
+            controller.start()
+            self.assertLess(time.time() - start, 10)  # The call in __init__ doesn't wait for the timeout
+
+            response = controller._request('Api', 'outputs')
+            self.assertEqual({'success': True, 'status': [{'id': 1, 'status': 1}]}, json.loads(response))
+            controller._request('Api', 'set_output')
+            self.assertEqual([('get_output_status', {}, True),
+                              ('get_output_status', {}, True),
+                              ('set_output', {'id': 1, 'is_on': True}, True)], calls)
+        finally:
+            if controller is not None:
+                controller.stop()
+            PluginControllerTest._destroy_plugin('Api')
+
+    def test_streaming(self):
+        """ Validates streaming request and response bodies in chunks """
+        controller = None
+        try:
+            PluginControllerTest._create_plugin('Streams', """
+from plugins.base import *
+
+class Streams(OMPluginBase):
+    name = 'Streams'
+    version = '1.0.0'
+    interfaces = []
+
+    @om_expose(auth=False, content_type='text/csv')
+    def export(self, rows):
+        for i in xrange(int(rows)):
+            yield '{0},{1}\\n'.format(i, 'x' * 100)
+
+    @om_expose(auth=False, stream_body=True)
+    def upload(self, body):
+        size = 0
+        lines = 0
+        while True:
+            data = body.read(1000)
+            if not data:
+                break
+            size += len(data)
+            lines += data.count('\\n')
+        return {'size': size, 'lines': lines}
+
+    @om_expose(auth=False, stream_body=True)
+    def peek(self, body):
+        return body.read(5)
+""")
+            controller = PluginControllerTest._get_controller()
+            controller.start()
+            runner = controller._PluginController__runners['Streams']
+            self.assertEqual({'export': False, 'upload': True, 'peek': True},
+                             dict((name, exposed['stream_body']) for name, exposed in runner._routes.iteritems()))
+
+            # The response is larger than the window, so it's only sent as it is consumed
+            response = runner.request('export', kwargs={'rows': 2000})
+            data = ''.join(response)
+            self.assertEqual(2000, data.count('\n'))
+            self.assertTrue(data.startswith('0,x'))
+            self.assertEqual({}, runner._stream_receivers)
+
+            body = ['{0}\n'.format('y' * 1000) for _ in xrange(500)]
+            self.assertEqual({'size': 500500, 'lines': 500}, runner.request('upload', body=iter(body)))
+            self.assertEqual({'size': 0, 'lines': 0}, runner.request('upload', body=''))
+            # The remainder of a body that isn't read is cancelled
+            self.assertEqual('yyyyy', runner.request('peek', body=iter(body)))
+            self.assertEqual({}, runner._stream_senders)
+
+            # A response which isn't consumed is cancelled when it's closed
+            response = iter(runner.request('export', kwargs={'rows': 10000}))
+            self.assertTrue(next(response).startswith('0,x'))
+            response.close()
+            self.assertEqual('yyyyy', runner.request('peek', body=iter(body)))
+        finally:
+            if controller is not None:
+                controller.stop()
+            PluginControllerTest._destroy_plugin('Streams')
+
     def test_plugin_metric_reference(self):
         """ Validates whether two plugins won't get the same metric instance """
         controller = None
@@ -701,11 +1108,12 @@ class PluginConfigCheckerTest(unittest.TestCase):
         ])
         checker.check_config({'log_inputs': True, 'log_outputs': False})
 
-    def test_load_webinterface(self):
-        """ Tests whether the webinterface.py parsing works as expected """
-        from plugin_runtime import web
+    def test_plugin_api_manifest(self):
+        """ Tests whether the API manifest contains the calls exposed to the plugins """
         from gateway.webservice import WebInterface
-        found_calls = web._load_webinterface()
+        manifest = WebInterface.get_plugin_api_manifest()
+        self.assertEqual(1, manifest['version'])
+        found_calls = manifest['calls']
 
         ramaining_methods = found_calls.keys()
         for method_info in inspect.getmembers(WebInterface, predicate=lambda m: inspect.ismethod(m)):
@@ -725,6 +1133,24 @@ class PluginConfigCheckerTest(unittest.TestCase):
             self.assertEquals(arg_spec.args[1:], call_info)
             ramaining_methods.remove(method_name)
         self.assertEqual(ramaining_methods, [])
+        self.assertIn('set_output', found_calls)
+        self.assertNotIn('get_plugin_api_manifest', found_calls)
+
+    def test_webinterface_dispatcher(self):
+        """ Tests whether the plugin runtime loads the calls from the API manifest """
+        from plugin_runtime.web import WebInterfaceDispatcher
+        calls = []
+        api_channel = type('ApiChannel', (), {'call': lambda _self, name, parameters: calls.append((name, parameters)) or {'success': True}})()
+        dispatcher = WebInterfaceDispatcher(lambda message: None, api_channel=api_channel)
+        with self.assertRaises(AttributeError):
+            dispatcher.set_output(id=1, is_on=True)
+        dispatcher.set_api_manifest({'version': 1, 'calls': {'set_output': ['id', 'is_on', 'dimmer', 'timer']}})
+        self.assertEqual({'success': True}, json.loads(dispatcher.set_output('token', 1, True)))
+        self.assertEqual({'success': True}, json.loads(dispatcher.set_output(id=2, is_on=False)))
+        self.assertEqual([('set_output', {'id': 1, 'is_on': True}),
+                          ('set_output', {'id': 2, 'is_on': False})], calls)
+        with self.assertRaises(AttributeError):
+            dispatcher.get_output_status()
 
 
 if __name__ == "__main__":
@@ -0,0 +1,170 @@
+# Copyright (C) 2020 OpenMotics BV
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+Tests for the plugin IPC stream.
+"""
+
+import os
+import time
+import unittest
+import xmlrunner
+from threading import Thread
+from StringIO import StringIO
+from toolbox import PluginIPCStream, IPCStreamSender, IPCStreamReceiver
+
+
+class PluginIPCStreamTest(unittest.TestCase):
+    """ Tests for the PluginIPCStream. """
+
+    def setUp(self):
+        self.received = []
+        self.errors = []
+        self.stream = PluginIPCStream(stream=None,
+                                      logger=lambda message, ex: self.errors.append(message),
+                                      command_receiver=self.received.append)
+
+    def test_framing(self):
+        """ Test decoding messages, regardless of how they are split over reads """
+        messages = [{'cid': 1, 'action': 'start'},
+                    {'cid': 0, 'action': 'logs', 'logs': 'x' * 100000},
+                    {'cid': 2, 'data': [1, 2.5, None, True]}]
+        data = ''.join(PluginIPCStream.write(message) for message in messages)
+        for chunk_size in [1, 3, 4, 7, 1000, len(data)]:
+            del self.received[:]
+            for offset in xrange(0, len(data), chunk_size):
+                self.stream._process(memoryview(bytearray(data[offset:offset + chunk_size])))
+            self.assertEqual(messages, self.received)
+        self.assertEqual([], self.errors)
+
+    def test_invalid_message(self):
+        """ Test recovering from an invalid message """
+        data = PluginIPCStream.HEADER.pack(2) + '\xc1\xc1' + PluginIPCStream.write({'cid': 1})
+        self.stream._process(memoryview(bytearray(data)))
+        self.assertEqual([{'cid': 1}], self.received)
+        self.assertEqual(['Unexpected message'], self.errors)
+
+    def test_pipe(self):
+        """ Test reading from a pipe """
+        read_fd, write_fd = os.pipe()
+        reader = os.fdopen(read_fd, 'r', 0)
+        writer = os.fdopen(write_fd, 'w', 0)
+        stream = PluginIPCStream(stream=reader, logger=lambda message, ex: self.errors.append(message))
+        stream.start()
+        try:
+            for cid in xrange(100):
+                writer.write(PluginIPCStream.write({'cid': cid, 'data': 'x' * cid * 1000}))
+            for cid in xrange(100):
+                self.assertEqual({'cid': cid, 'data': 'x' * cid * 1000}, stream.get(timeout=2))
+            writer.close()
+            stream._read_thread.join(2)
+            self.assertFalse(stream._read_thread.is_alive())  # Stops reading at the end of the stream
+            self.assertEqual(sum(len(PluginIPCStream.write({'cid': cid, 'data': 'x' * cid * 1000}))
+                                 for cid in xrange(100)), stream.bytes_read)
+        finally:
+            stream.stop()
+            reader.close()
+
+
+class IPCStreamTest(unittest.TestCase):
+    """ Tests for streaming bodies over the PluginIPCStream. """
+
+    def setUp(self):
+        self.sender_messages = []
+        self.receiver_messages = []
+        self.sender = IPCStreamSender(1, self.sender_messages.append, timeout=1)
+        self.receiver = IPCStreamReceiver(1, self.receiver_messages.append, timeout=1)
+
+    def _send(self, body):
+        thread = Thread(target=self.sender.send, args=(body,))
+        thread.daemon = True
+        thread.start()
+        return thread
+
+    def _deliver(self):
+        """ Delivers the messages of the sender to the receiver and vice versa """
+        for message in self.sender_messages:
+            self.receiver.process_message(message)
+        del self.sender_messages[:]
+        for message in self.receiver_messages:
+            if message['action'] == 'stream_ack':
+                self.sender.ack()
+            else:
+                self.sender.cancel()
+        del self.receiver_messages[:]
+
+    def test_chunks(self):
+        """ Test splitting bodies in chunks """
+        chunk_size = IPCStreamSender.CHUNK_SIZE
+        for body, expected in [('', []),
+                               ('x' * (chunk_size + 1), ['x' * chunk_size, 'x']),
+                               (['a', u'\xe9', 'b' * chunk_size], ['a\xc3\xa9' + 'b' * (chunk_size - 3), 'bbb']),
+                               (StringIO('y' * (2 * chunk_size)), ['y' * chunk_size] * 2),
+                               ((line for line in ['1,2\n', '3,4\n']), ['1,2\n3,4\n'])]:
+            self.assertEqual(expected, list(IPCStreamSender._split(body)))
+
+    def test_window(self):
+        """ Test that the sender waits for acknowledgements """
+        body = ['z' * IPCStreamSender.CHUNK_SIZE] * (IPCStreamSender.WINDOW + 2)
+        thread = self._send(body)
+        time.sleep(0.2)
+        self.assertEqual(IPCStreamSender.WINDOW, len(self.sender_messages))
+        self._deliver()
+        self.assertEqual(body[0], self.receiver.read(IPCStreamSender.CHUNK_SIZE))
+        self._deliver()
+        time.sleep(0.2)
+        self.assertEqual(1, len(self.sender_messages))  # A single chunk was acknowledged
+        self._deliver()
+        for chunk in body[1:-1]:
+            self.assertEqual(chunk, self.receiver.read(IPCStreamSender.CHUNK_SIZE))
+        self._deliver()
+        thread.join(1)
+        self.assertFalse(thread.is_alive())
+        self._deliver()
+        self.assertEqual(body[-1], self.receiver.read())
+        self.assertEqual('', self.receiver.read())
+
+    def test_cancel(self):
+        """ Test closing a receiver before the body is received """
+        thread = self._send(['z' * IPCStreamSender.CHUNK_SIZE] * 100)
+        time.sleep(0.2)
+        self._deliver()
+        self.assertEqual('zzz', self.receiver.read(3))
+        self.receiver.close()
+        self.assertEqual([{'cid': 0, 'action': 'stream_ack', 'stream_id': 1},
+                          {'cid': 0, 'action': 'stream_cancel', 'stream_id': 1}], self.receiver_messages)
+        self._deliver()
+        thread.join(1)
+        self.assertFalse(thread.is_alive())
+        self.assertEqual({'cid': 0, 'action': 'stream_end', 'stream_id': 1, 'error': None}, self.sender_messages[-1])
+        self.assertEqual('', self.receiver.read())
+
+    def test_errors(self):
+        """ Test failing senders and receivers """
+        def _body():
+            yield 'a' * IPCStreamSender.CHUNK_SIZE
+            raise ValueError('Export failed')
+        self.assertFalse(self.sender.send(_body()))
+        self._deliver()
+        with self.assertRaises(RuntimeError) as context:
+            list(self.receiver)
+        self.assertEqual('Stream failed: Export failed', str(context.exception))
+
+        receiver = IPCStreamReceiver(2, self.receiver_messages.append, timeout=0.1)
+        with self.assertRaises(RuntimeError):
+            receiver.read()
+
+
+if __name__ == '__main__':
+    unittest.main(testRunner=xmlrunner.XMLTestRunner(output='../gw-unit-reports'))
@@ -0,0 +1,75 @@
+# Copyright (C) 2020 OpenMotics BV
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+Tests for the plugin log.
+"""
+
+import os
+import shutil
+import tempfile
+import unittest
+import xmlrunner
+from plugins.logs import PluginLog
+
+
+class PluginLogTest(unittest.TestCase):
+    """ Tests for the PluginLog. """
+
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        self.log_file = os.path.join(self.path, 'pi_test.log')
+
+    def tearDown(self):
+        shutil.rmtree(self.path)
+
+    def test_ring(self):
+        """ Test that the log is bounded, and fetching records since a cursor """
+        plugin_log = PluginLog(size=5)
+        for i in xrange(8):
+            plugin_log.append('message {0}'.format(i), 'ERROR' if i == 7 else 'INFO')
+        records = plugin_log.get_records()
+        self.assertEqual([4, 5, 6, 7, 8], [record['id'] for record in records])
+        self.assertEqual({'id': 8, 'timestamp': records[-1]['timestamp'], 'level': 'ERROR', 'message': 'message 7'},
+                         records[-1])
+        self.assertEqual([7, 8], [record['id'] for record in plugin_log.get_records(cursor=6)])
+        self.assertEqual([], plugin_log.get_records(cursor=8))
+        self.assertEqual([4, 5, 6, 7, 8], [record['id'] for record in plugin_log.get_records(cursor=1)])
+        self.assertEqual([6, 7], [record['id'] for record in plugin_log.get_records(cursor=5, limit=2)])
+        lines = plugin_log.format().split('\n')
+        self.assertEqual(5, len(lines))
+        self.assertTrue(lines[0].endswith(' - message 3'))
+
+    def test_persist(self):
+        """ Test persisting and loading the log """
+        plugin_log = PluginLog(self.log_file, size=5)
+        self.assertFalse(plugin_log.dirty)
+        for i in xrange(3):
+            plugin_log.append('message {0}'.format(i))
+        self.assertTrue(plugin_log.dirty)
+        plugin_log.persist()
+        self.assertFalse(plugin_log.dirty)
+
+        loaded_log = PluginLog(self.log_file, size=5)
+        self.assertEqual(plugin_log.get_records(), loaded_log.get_records())
+        loaded_log.append('message 3')
+        self.assertEqual([4], [record['id'] for record in loaded_log.get_records(cursor=3)])
+
+        with open(self.log_file, 'w') as log_file:
+            log_file.write('{"id": 1, "timest')
+        self.assertEqual([], PluginLog(self.log_file).get_records())
+
+
+if __name__ == '__main__':
+    unittest.main(testRunner=xmlrunner.XMLTestRunner(output='../gw-unit-reports'))
@@ -16,12 +16,15 @@
 Tests for plugin runner
 """
 
+import mock
 import os
 import plugin_runtime
 import shutil
 import tempfile
+import time
 import unittest
 import xmlrunner
+from threading import Event
 from plugins.runner import PluginRunner
 
 
@@ -50,6 +53,50 @@ class PluginRunnerTest(unittest.TestCase):
         runner = PluginRunner('foo', self.RUNTIME_PATH, self.PLUGIN_PATH, self._log)
         self.assertEqual(runner.get_queue_length(), 0)
 
+    def test_api_call_workers(self):
+        release = Event()
+        responses = {}
+
+        def _execute_api_call(name, parameters, plugin_exposed_only):
+            _ = name, parameters, plugin_exposed_only
+            release.wait(5)
+            return None, {'success': True}
+
+        def _write(message):
+            responses[message['call_id']] = message['data']
+
+        web_interface = mock.Mock()
+        web_interface.execute_api_call.side_effect = _execute_api_call
+        runner = PluginRunner('foo', self.RUNTIME_PATH, self.PLUGIN_PATH, self._log, web_interface=web_interface)
+        runner._write = _write
+        runner._process_running = True
+        runner._start_api_call_workers()
+        try:
+            call_id = 0
+            for _ in xrange(PluginRunner.API_CALL_WORKERS):
+                runner._handle_async_response({'action': 'api_call', 'name': 'get_version', 'call_id': call_id})
+                call_id += 1
+            end = time.time() + 5
+            while web_interface.execute_api_call.call_count < PluginRunner.API_CALL_WORKERS and time.time() < end:
+                time.sleep(0.01)
+            self.assertEqual(web_interface.execute_api_call.call_count, PluginRunner.API_CALL_WORKERS)
+            for _ in xrange(PluginRunner.API_CALL_QUEUE_SIZE):
+                runner._handle_async_response({'action': 'api_call', 'name': 'get_version', 'call_id': call_id})
+                call_id += 1
+            self.assertEqual(responses, {})
+            runner._handle_async_response({'action': 'api_call', 'name': 'get_version', 'call_id': call_id})
+            self.assertEqual(responses, {call_id: {'success': False, 'msg': 'Call temporarily unavailable'}})
+            release.set()
+            end = time.time() + 5
+            while len(responses) < call_id + 1 and time.time() < end:
+                time.sleep(0.01)
+            self.assertEqual(len(responses), call_id + 1)
+            for i in xrange(call_id):
+                self.assertEqual(responses[i], {'success': True})
+        finally:
+            release.set()
+            runner._process_running = False
+
 
 if __name__ == "__main__":
     unittest.main(testRunner=xmlrunner.XMLTestRunner(output='../gw-unit-reports'))
@@ -0,0 +1,137 @@
+# Copyright (C) 2020 OpenMotics BV
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+Tests for the power analytics reader.
+"""
+
+import math
+import unittest
+import xmlrunner
+import mock
+from threading import Thread
+from ioc import SetTestMode, SetUpTestInjections
+import power.power_api as power_api
+from power.power_analytics import PowerAnalytics, get_rms, get_peak, get_thd
+from power.power_command import parse_response
+from power.power_controller import PowerModule
+
+INF = float('inf')
+
+
+class PowerAnalyticsTest(unittest.TestCase):
+    """ Tests for the PowerAnalytics. """
+
+    @classmethod
+    def setUpClass(cls):
+        SetTestMode()
+
+    def setUp(self):
+        self.responses = {}  # (command, input data) -> output values
+        self.transactions = []
+        self.power_communicator = mock.Mock()
+        self.power_communicator.do_transaction.side_effect = self._do_transaction
+        self.power_controller = mock.Mock()
+        self.power_controller.get_modules.return_value = {1: PowerModule(1, '', 11, power_api.ENERGY_MODULE, []),
+                                                          2: PowerModule(2, '', 12, power_api.POWER_MODULE, [])}
+        SetUpTestInjections(power_communicator=self.power_communicator,
+                            power_controller=self.power_controller)
+        self.analytics = PowerAnalytics()
+
+    def _do_transaction(self, address, transaction):
+        self.transactions.append((address, transaction.inputs))
+        outputs = []
+        for command, data in zip(transaction.commands, transaction.inputs):
+            response = command.create_output(address, 1, *self.responses[(command.type, data)])
+            outputs.append(command.read_output_array(parse_response(bytearray(response))[1]))
+        return transaction.combine(outputs)
+
+    def _set_time_samples(self, input_id, voltage, current):
+        for command, samples in [('VST', voltage), ('CST', current)]:
+            samples = samples + [INF] * (100 - len(samples))
+            self.responses[(command, (input_id, 0))] = samples[:50]
+            self.responses[(command, (input_id, 1))] = samples[50:]
+
+    def test_time_samples(self):
+        """ Test reading time samples into the buffers """
+        voltage = [325.0 * math.sin(2 * math.pi * i / 80) for i in xrange(80)]
+        self._set_time_samples(3, voltage, [1.0, -2.0] * 25)
+        samples = self.analytics.read_time_samples(1, 3)
+        self.assertEqual([(11, [(3, 0), (3, 1), (3, 0), (3, 1)])], self.transactions)
+        self.assertEqual(80, len(samples['voltage']))
+        self.assertEqual(50, len(samples['current']))  # The first block can be terminated as well
+        self.assertEqual([1.0, -2.0] * 25, samples['current'].tolist())
+        self.assertEqual(-2.0, samples['current'][-1])
+        self.assertAlmostEqual(voltage[20], samples['voltage'][20], places=3)
+
+        # The buffers are reused, and the views show the samples of the last read
+        buffer = samples['current']._samples
+        self._set_time_samples(3, voltage, [3.0] * 100)
+        samples = self.analytics.read_time_samples(1, 3)
+        self.assertIs(buffer, samples['current']._samples)
+        self.assertEqual([3.0] * 100, list(samples['current']))
+
+        with self.assertRaises(ValueError):
+            self.analytics.read_time_samples(1, 12)
+        with self.assertRaises(ValueError):
+            self.analytics.read_time_samples(2, 0)
+
+    def test_summary(self):
+        """ Test the summary of the samples of an input """
+        voltage = [325.0 * math.sin(2 * math.pi * i / 80) for i in xrange(80)]
+        self._set_time_samples(0, voltage, [2.0, -2.0] * 40)
+        self.responses[('VSF', (0, 20))] = [230.0, 0.0, 23.0] + [0.0] * 37
+        self.responses[('CSF', (0, 20))] = [0.0] * 40
+        frequency = self.analytics.read_frequency_samples(1, 0)
+        self.assertEqual([230.0, 0.0, 23.0] + [0.0] * 17, frequency['voltage'][0].tolist())
+        self.assertEqual([0.0] * 20, frequency['voltage'][1].tolist())
+
+        summary = self.analytics.get_summary(1, 0)
+        self.assertAlmostEqual(325.0 / math.sqrt(2), summary['voltage_rms'], places=2)
+        self.assertAlmostEqual(325.0, summary['voltage_peak'], places=2)
+        self.assertAlmostEqual(0.1, summary['voltage_thd'], places=5)
+        self.assertEqual({'rms': 2.0, 'peak': 2.0, 'thd': 0.0},
+                         {'rms': summary['current_rms'], 'peak': summary['current_peak'], 'thd': summary['current_thd']})
+
+    def test_summary_lock(self):
+        """ Test that the buffers can't be overwritten while they are summarized """
+        self._set_time_samples(0, [1.0] * 80, [1.0] * 80)
+        self.responses[('VSF', (0, 20))] = [0.0] * 40
+        self.responses[('CSF', (0, 20))] = [0.0] * 40
+        readers = []
+
+        def _get_rms(samples):
+            reader = Thread(target=self.analytics.read_time_samples, args=(1, 0))
+            reader.start()
+            reader.join(0.1)
+            readers.append(reader)
+            return get_rms(samples)
+
+        with mock.patch('power.power_analytics.get_rms', side_effect=_get_rms):
+            self.analytics.get_summary(1, 0)
+        self.assertTrue(all(reader.is_alive() for reader in readers))  # Blocked until the summary was finished
+        for reader in readers:
+            reader.join()
+
+    def test_helpers(self):
+        """ Test the summary functions """
+        self.assertEqual(0.0, get_rms([]))
+        self.assertEqual(0.0, get_peak([]))
+        self.assertEqual(0.0, get_thd([]))
+        self.assertEqual(5.0, get_peak([1.0, -5.0, 3.0]))
+        self.assertAlmostEqual(0.5, get_thd([-10.0, 3.0, 4.0]))
+
+
+if __name__ == '__main__':
+    unittest.main(testRunner=xmlrunner.XMLTestRunner(output='../gw-unit-reports'))
@@ -0,0 +1,87 @@
+# Copyright (C) 2020 OpenMotics BV
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+Tests for the decoding of the power module responses, using recorded responses.
+"""
+
+import unittest
+import xmlrunner
+from array import array
+import power.power_api as power_api
+from power.power_command import parse_response
+
+# Responses of an energy module (address 3) and a P1 concentrator (address 5), with the zero padding written out
+ENERGY_VOLTAGE = ('RTRE\x03\x11GVOL0'
+                  '\x00\x80gC\x00@gC\x00\x00fC\x00\xc0eC\x00\x80gC\x00\x00gC'
+                  '\x00\x80fC\x00@fC\x00\xc0gC\x00\x00hC\x00\x80eC\x00\x00fC'
+                  'Q\r\n')
+P1_REALTIME_POWER = ['RTRC\x05\x14GSP\x00\x01\x05\xf5\r\n',
+                     'RTRC\x05\x15GV1\x008' + '230.1V'.ljust(14, '\x00') + '229.8V'.ljust(42, '\x00') + '\x1a\r\n',
+                     'RTRC\x05\x16GC1\x00(' + '002A'.ljust(10, '\x00') + '011A'.ljust(30, '\x00') + '\x97\r\n',
+                     'RTRC\x05\x17GC2\x00(' + '001A'.ljust(10, '\x00') + '000A'.ljust(30, '\x00') + '\xb6\r\n',
+                     'RTRC\x05\x18GC3\x00(' + '000A'.ljust(10, '\x00') + '004A'.ljust(30, '\x00') + '\xb0\r\n',
+                     'RTRC\x05\x19GPD\x00H' + '00.542kW'.ljust(18, '\x00') + '02.513kW'.ljust(54, '\x00') + 'Y\r\n',
+                     'RTRC\x05\x1aGPR\x00H' + '00.000kW'.ljust(18, '\x00') + '00.013kW'.ljust(54, '\x00') + '*\r\n']
+P1_TOTAL_ENERGY = ['RTRC\x05\x14GSP\x00\x01\x05\xf5\r\n',
+                   'RTRC\x05\x1bGc1\x00p' + '004512.345kWh'.ljust(28, '\x00') + '000012.001kWh'.ljust(84, '\x00') + ']\r\n',
+                   'RTRC\x05\x1cGc2\x00p' + '003001.500kWh'.ljust(28, '\x00') + 'ERROR'.ljust(84, '\x00') + '\r\r\n']
+
+
+class PowerApiTest(unittest.TestCase):
+    """ Tests for the decoders of the power api. """
+
+    @staticmethod
+    def _read(command, response):
+        header, data = parse_response(bytearray(response))
+        return command.read_output_array(data)
+
+    def test_decoders(self):
+        """ Test decoding a response into a tuple and into an array """
+        voltage = [231.5, 231.25, 230.0, 229.75, 231.5, 231.0, 230.5, 230.25, 231.75, 232.0, 229.5, 230.0]
+        command = power_api.get_voltage(power_api.ENERGY_MODULE)
+        header, data = parse_response(bytearray(ENERGY_VOLTAGE))
+        self.assertTrue(command.check_header(header, 3, 17))
+        self.assertEqual(tuple(voltage), command.read_output(data))
+        self.assertEqual(array('f', voltage), command.read_output_array(data))
+        with self.assertRaises(Exception):
+            command.read_output_array(data[:-4])
+
+        # Outputs that mix types are parsed into a tuple, the decoders are shared
+        command = power_api.get_voltage(power_api.P1_CONCENTRATOR, phase=1)
+        raw = '230.1V'.ljust(56, '\x00')
+        self.assertEqual((raw, ), command.read_output_array(raw))
+        self.assertIs(command._output_struct, power_api.get_voltage(power_api.P1_CONCENTRATOR, phase=2)._output_struct)
+
+    def test_p1_realtime_power(self):
+        """ Test the realtime power transaction of a P1 concentrator, with port 0 and 2 connected """
+        transaction = power_api.get_realtime_power(power_api.P1_CONCENTRATOR)
+        result = transaction.combine([PowerApiTest._read(command, response)
+                                      for command, response in zip(transaction.commands, P1_REALTIME_POWER)])
+        self.assertEqual([230.1, 0.0, 229.8] + [0.0] * 5, list(result.voltage))
+        self.assertEqual([0.0] * 8, list(result.frequency))
+        self.assertEqual([3.0, 0.0, 15.0] + [0.0] * 5, list(result.current))
+        self.assertEqual([542.0, 0.0, 2500.0] + [0.0] * 5, list(result.power))
+
+    def test_p1_total_energy(self):
+        """ Test the total energy transaction of a P1 concentrator, with port 0 and 2 connected """
+        transaction = power_api.get_total_energy(power_api.P1_CONCENTRATOR)
+        result = transaction.combine([PowerApiTest._read(command, response)
+                                      for command, response in zip(transaction.commands, P1_TOTAL_ENERGY)])
+        self.assertEqual([4512345, 0, 12001] + [0] * 5, list(result.day))
+        self.assertEqual([3001500, 0, 0] + [0] * 5, list(result.night))  # Port 2 returned a field that can't be parsed
+
+
+if __name__ == '__main__':
+    unittest.main(testRunner=xmlrunner.XMLTestRunner(output='../gw-unit-reports'))
@@ -40,17 +40,20 @@ class PowerCommunicatorTest(unittest.TestCase):
 
     def setUp(self):
         """ Run before each test. """
+        self._serials = []
         if os.path.exists(PowerCommunicatorTest.FILE):
             os.remove(PowerCommunicatorTest.FILE)
 
     def tearDown(self):
         """ Run after each test. """
+        for serial in self._serials:
+            serial.close()
         if os.path.exists(PowerCommunicatorTest.FILE):
             os.remove(PowerCommunicatorTest.FILE)
 
-    @staticmethod
-    def _get_communicator(serial_mock, time_keeper_period=0, address_mode_timeout=60, power_controller=None):
-        """ Get a PowerCommunicator. """
+    def _get_communicator(self, serial_mock, time_keeper_period=0, address_mode_timeout=60, power_controller=None):
+        """ Get a PowerCommunicator, the serial is closed after the test. """
+        self._serials.append(serial_mock)
         SetUpTestInjections(power_db=PowerCommunicatorTest.FILE,
                             power_serial=serial_mock)
         if power_controller is not None:
@@ -66,7 +69,7 @@ class PowerCommunicatorTest(unittest.TestCase):
                         [sin(action.create_input(1, 1)),
                          sout(action.create_output(1, 1, 49.5))]))
 
-        comm = PowerCommunicatorTest._get_communicator(serial_mock)
+        comm = self._get_communicator(serial_mock)
         comm.start()
 
         output = comm.do_command(1, action)
@@ -84,12 +87,18 @@ class PowerCommunicatorTest(unittest.TestCase):
                                         sin(action.create_input(1, 2)),
                                         sout(action.create_output(1, 2, 49.5))]))
 
-        comm = PowerCommunicatorTest._get_communicator(serial_mock)
+        comm = self._get_communicator(serial_mock)
         comm.start()
 
         output = comm.do_command(1, action)
         self.assertEquals((49.5, ), output)
 
+        statistics = comm.get_statistics()
+        self.assertEquals({'commands': 1, 'retries': 1, 'timeouts': 1, 'crc_errors': 0},
+                          dict((key, statistics['modules'][1][key]) for key in ['commands', 'retries', 'timeouts', 'crc_errors']))
+        self.assertEquals(1, statistics['commands']['GVOL']['commands'])
+        self.assertGreater(statistics['utilization'][10], 0)
+
     def test_do_command_timeout_twice(self):
         """ Test for timeout in PowerCommunicator.do_command. """
         action = power_api.get_voltage(power_api.POWER_MODULE)
@@ -98,7 +107,7 @@ class PowerCommunicatorTest(unittest.TestCase):
                                         sin(action.create_input(1, 2)),
                                         sout('')]))
 
-        comm = PowerCommunicatorTest._get_communicator(serial_mock)
+        comm = self._get_communicator(serial_mock)
         comm.start()
 
         with self.assertRaises(CommunicationTimedOutException):
@@ -113,13 +122,51 @@ class PowerCommunicatorTest(unittest.TestCase):
                         [sin(action.create_input(1, 1)),
                          sout(out[:5]), sout(out[5:])]))
 
-        comm = PowerCommunicatorTest._get_communicator(serial_mock)
+        comm = self._get_communicator(serial_mock)
         comm.start()
 
         output = comm.do_command(1, action)
 
         self.assertEquals((49.5, ), output)
 
+    def test_do_command_chunked_data(self):
+        """ Test PowerCommunicator.do_command when responses are preceded by noise, split in the header or received together. """
+        action = power_api.get_voltage(power_api.POWER_MODULE)
+        out_1 = action.create_output(1, 1, 49.5)
+        out_2 = action.create_output(1, 2, 50.0)
+
+        serial_mock = RS485(SerialMock(
+                        [sin(action.create_input(1, 1)),
+                         sout('\x00R\x01RT'), sout(out_1[2:] + out_2),
+                         sin(action.create_input(1, 2))]))
+
+        comm = self._get_communicator(serial_mock)
+        comm.start()
+
+        self.assertEquals((49.5, ), comm.do_command(1, action))
+        self.assertEquals(3 + len(out_1) + len(out_2), comm.get_bytes_read())
+        # The second response was already received, and is kept until it is read
+        self.assertEquals((50.0, ), comm.do_command(1, action))
+
+    def test_do_transaction(self):
+        """ Test PowerCommunicator.do_transaction for a P1 concentrator. """
+        transaction = power_api.get_realtime_power(power_api.P1_CONCENTRATOR)
+        outputs = [(1, ), ('230.5V'.ljust(56), ), ('1.5A'.ljust(40), ), ('2.0A'.ljust(40), ), ('0.5A'.ljust(40), ),
+                   ('01.250kW'.ljust(72), ), ('00.250kW'.ljust(72), )]
+        sequence = []
+        for cid, (cmd, output) in enumerate(zip(transaction.commands, outputs), start=1):
+            sequence += [sin(cmd.create_input(1, cid)), sout(cmd.create_output(1, cid, *output))]
+
+        comm = self._get_communicator(RS485(SerialMock(sequence)))
+        comm.start()
+
+        result = comm.do_transaction(1, transaction)
+
+        self.assertEquals([230.5] + [0.0] * 7, list(result.voltage))
+        self.assertEquals([0.0] * 8, list(result.frequency))
+        self.assertEquals([4.0] + [0.0] * 7, list(result.current))
+        self.assertEquals([1000.0] + [0.0] * 7, list(result.power))
+
     def test_wrong_response(self):
         """ Test PowerCommunicator.do_command when the power module returns a wrong response. """
         action_1 = power_api.get_voltage(power_api.POWER_MODULE)
@@ -128,7 +175,7 @@ class PowerCommunicatorTest(unittest.TestCase):
         serial_mock = RS485(SerialMock([sin(action_1.create_input(1, 1)),
                                         sout(action_2.create_output(3, 2, 49.5))]))
 
-        comm = PowerCommunicatorTest._get_communicator(serial_mock)
+        comm = self._get_communicator(serial_mock)
         comm.start()
 
         with self.assertRaises(Exception):
@@ -156,7 +203,9 @@ class PowerCommunicatorTest(unittest.TestCase):
         SetUpTestInjections(power_db=PowerCommunicatorTest.FILE)
 
         controller = PowerController()
-        comm = PowerCommunicatorTest._get_communicator(serial_mock, power_controller=controller)
+        comm = self._get_communicator(serial_mock, power_controller=controller)
+        events = []
+        comm.subscribe_events(events.append)
         comm.start()
 
         self.assertEqual(controller.get_free_address(), 1)
@@ -169,8 +218,14 @@ class PowerCommunicatorTest(unittest.TestCase):
         self.assertEqual(controller.get_free_address(), 4)
         self.assertFalse(comm.in_address_mode())
 
+        self.assertEqual(['STARTED', 'MODULE_FOUND', 'MODULE_FOUND', 'MODULE_FOUND', 'STOPPED'],
+                         [event.data['state'] for event in events])
+        self.assertEqual([{'address': 1, 'version': power_api.POWER_MODULE},
+                          {'address': 2, 'version': power_api.ENERGY_MODULE},
+                          {'address': 3, 'version': power_api.P1_CONCENTRATOR}], events[-1].data['modules'])
+
     def test_do_command_in_address_mode(self):
-        """ Test the behavior of do_command in address mode."""
+        """ Test that do_command keeps working in address mode, and passes on modules that want an address. """
         action = power_api.get_voltage(power_api.POWER_MODULE)
         sad = power_api.set_addressmode(power_api.POWER_MODULE)
         sad_p1c = power_api.set_addressmode(power_api.P1_CONCENTRATOR)
@@ -178,25 +233,26 @@ class PowerCommunicatorTest(unittest.TestCase):
         serial_mock = RS485(SerialMock(
             [sin(sad.create_input(power_api.BROADCAST_ADDRESS, 1, power_api.ADDRESS_MODE)),
              sin(sad_p1c.create_input(power_api.BROADCAST_ADDRESS, 2, power_api.ADDRESS_MODE)),
-             sout(''),  # Timeout read after 1 second
-             sin(sad.create_input(power_api.BROADCAST_ADDRESS, 3, power_api.NORMAL_MODE)),
-             sin(sad_p1c.create_input(power_api.BROADCAST_ADDRESS, 4, power_api.NORMAL_MODE)),
-             sin(action.create_input(1, 5)),
-             sout(action.create_output(1, 5, 49.5))],
+             sin(action.create_input(1, 3)),
+             sout(power_api.want_an_address(power_api.ENERGY_MODULE).create_output(0, 0) + action.create_output(1, 3, 49.5)),
+             sin(power_api.set_address(power_api.ENERGY_MODULE).create_input(0, 0, 1)),
+             sin(sad.create_input(power_api.BROADCAST_ADDRESS, 4, power_api.NORMAL_MODE)),
+             sin(sad_p1c.create_input(power_api.BROADCAST_ADDRESS, 5, power_api.NORMAL_MODE))],
             1
         ))
+        SetUpTestInjections(power_db=PowerCommunicatorTest.FILE)
 
-        comm = PowerCommunicatorTest._get_communicator(serial_mock)
+        controller = PowerController()
+        comm = self._get_communicator(serial_mock, power_controller=controller)
         comm.start()
 
         comm.start_address_mode()
-
-        with self.assertRaises(InAddressModeException):
-            comm.do_command(1, action)
-
+        time.sleep(0.1)
+        self.assertEquals((49.5, ), comm.do_command(1, action))
+        time.sleep(1)
         comm.stop_address_mode()
 
-        self.assertEquals((49.5, ), comm.do_command(1, action))
+        self.assertEqual(controller.get_free_address(), 2)
 
     def test_address_mode_timeout(self):
         """ Test address mode timeout. """
@@ -215,7 +271,7 @@ class PowerCommunicatorTest(unittest.TestCase):
             1
         ))
 
-        comm = PowerCommunicatorTest._get_communicator(serial_mock, address_mode_timeout=1)
+        comm = self._get_communicator(serial_mock, address_mode_timeout=1)
         comm.start()
 
         comm.start_address_mode()
@@ -241,7 +297,7 @@ class PowerCommunicatorTest(unittest.TestCase):
             1
         ))
 
-        comm = PowerCommunicatorTest._get_communicator(serial_mock, 1, power_controller=power_controller)
+        comm = self._get_communicator(serial_mock, 1, power_controller=power_controller)
         comm.start()
 
         time.sleep(1.5)
@@ -178,6 +178,32 @@ class PowerControllerTest(unittest.TestCase):
 
         self.assertEquals(3, power_controller.get_address(1))
 
+    def test_cache(self):
+        """ Test that the modules are served from memory, and changes are written to the database. """
+        power_controller = self.__get_controller()
+        changes = []
+        power_controller.subscribe_module_changes(lambda: changes.append(True))
+        power_controller.register_power_module(1, POWER_MODULE)
+        module = power_controller.get_power_modules()[1]
+        module.update({'name': 'Kitchen', 'times0': '08:00,18:00' + ',00:00' * 12, 'sensor0': 2})
+        power_controller.update_power_module(module)
+        power_controller.set_day_night_modes(1, [1, 0, 0, 0, 0, 0, 0, 0])
+        self.assertEquals(2, len(changes))
+
+        expected = power_controller.get_power_modules()
+        self.assertEquals(module, expected[1])
+        self.assertEquals('Kitchen', power_controller.get_modules()[1].name)
+        self.assertEquals(2, power_controller.get_modules()[1].ports[0].sensor)
+
+        # A new controller loads the same configuration from the database
+        power_controller.close()
+        power_controller = self.__get_controller()
+        power_controller.close()
+        self.assertEquals(expected, power_controller.get_power_modules())
+        self.assertEquals({1: [1, 0, 0, 0, 0, 0, 0, 0]}, power_controller.get_day_night_modes())
+        self.assertTrue(power_controller.module_exists(1))
+        self.assertEquals(2, power_controller.get_free_address())
+
 
 if __name__ == "__main__":
     unittest.main(testRunner=xmlrunner.XMLTestRunner(output='../gw-unit-reports'))
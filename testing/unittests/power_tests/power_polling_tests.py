@@ -0,0 +1,77 @@
+# Copyright (C) 2020 OpenMotics BV
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+Tests for the power poll scheduler.
+"""
+
+import unittest
+import xmlrunner
+from power.power_polling import PowerPollScheduler
+
+
+class PowerPollSchedulerTest(unittest.TestCase):
+    """ Tests for the PowerPollScheduler. """
+
+    def _run(self, scheduler, now, power, interval=5.0, duration=0.1):
+        """ Executes a run of the metrics collector, returns the modules that were read """
+        due = scheduler.get_due_modules([1, 2], interval, now=now)
+        for module_id in due:
+            scheduler.update(module_id, power[module_id], duration, interval, now=now)
+        return due
+
+    def test_backoff(self):
+        """ Test that stable modules back off, and changing modules are read at the requested interval """
+        scheduler = PowerPollScheduler()
+        reads = {1: 0, 2: 0}
+        for tick in xrange(60):
+            power = {1: [100.0, 2000.0],  # Stable
+                     2: [100.0, 2000.0 + (tick % 2) * 500]}  # Heat pump
+            for module_id in self._run(scheduler, tick * 5.0, power):
+                reads[module_id] += 1
+        self.assertEqual(60, reads[2])
+        self.assertLess(reads[1], 15)
+
+        rates = scheduler.get_poll_rates()
+        self.assertEqual(60.0, rates[1]['interval'])
+        self.assertTrue(rates[1]['stable'])
+        self.assertEqual(5.0, rates[2]['interval'])
+        self.assertFalse(rates[2]['stable'])
+
+        # Small changes are considered stable
+        self._run(scheduler, 300.0, {1: [105.0, 2050.0], 2: [100.0, 2000.0]})
+        self.assertTrue(scheduler.get_poll_rates()[1]['stable'])
+
+        # A faster requested interval (e.g. a new subscriber) resets the backoff
+        self.assertEqual([1, 2], scheduler.get_due_modules([1, 2], 1.0, now=302.0))
+        self.assertEqual(1.0, scheduler.get_poll_rates()[1]['interval'])
+
+        # Removed modules are forgotten
+        scheduler.get_due_modules([2], 1.0, now=303.0)
+        self.assertEqual([2], scheduler.get_poll_rates().keys())
+
+    def test_bus_budget(self):
+        """ Test that the intervals are stretched when the modules would use too much bus time """
+        scheduler = PowerPollScheduler()
+        power = {1: [100.0], 2: [100.0]}
+        self._run(scheduler, 0.0, power, interval=1.0, duration=0.5)
+        # Reading both modules every second takes 100% of the bus time, twice the budget
+        self.assertEqual({1: 2.0, 2: 2.0}, dict((module_id, rate['interval'])
+                                                for module_id, rate in scheduler.get_poll_rates().iteritems()))
+        self.assertEqual([], scheduler.get_due_modules([1, 2], 1.0, now=1.0))
+        self.assertEqual([1, 2], scheduler.get_due_modules([1, 2], 1.0, now=2.0))
+
+
+if __name__ == '__main__':
+    unittest.main(testRunner=xmlrunner.XMLTestRunner(output='../gw-unit-reports'))
@@ -0,0 +1,125 @@
+# Copyright (C) 2020 OpenMotics BV
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+Tests for the power snapshot cache.
+"""
+
+import time
+import unittest
+import xmlrunner
+import mock
+from threading import Thread
+from ioc import SetTestMode, SetUpTestInjections
+import power.power_api as power_api
+from power.power_controller import PowerModule
+from power.power_snapshots import PowerSnapshotCache
+from serial_utils import CommunicationTimedOutException
+
+
+class PowerSnapshotCacheTest(unittest.TestCase):
+    """ Tests for the PowerSnapshotCache. """
+
+    @classmethod
+    def setUpClass(cls):
+        SetTestMode()
+
+    def setUp(self):
+        self.commands = []
+        self.delay = 0
+        self.power_communicator = mock.Mock()
+        self.power_communicator.do_transaction.side_effect = self._do_transaction
+        self.power_controller = mock.Mock()
+        self.power_controller.get_modules.return_value = {1: PowerModule(1, '', 11, power_api.POWER_MODULE, []),
+                                                          2: PowerModule(2, '', 12, power_api.ENERGY_MODULE, [])}
+        self.config_controller = mock.Mock()
+        self.config_controller.get_setting.side_effect = lambda setting, fallback=None: fallback
+        SetUpTestInjections(power_communicator=self.power_communicator,
+                            power_controller=self.power_controller,
+                            configuration_controller=self.config_controller)
+        self.cache = PowerSnapshotCache()
+
+    def _do_transaction(self, address, transaction):
+        return transaction.combine([self._do_command(address, api) for api in transaction.commands])
+
+    def _do_command(self, address, api):
+        self.commands.append((address, api))
+        time.sleep(self.delay)
+        if address == 13:
+            raise CommunicationTimedOutException()
+        ports = power_api.NUM_PORTS[power_api.POWER_MODULE if address == 11 else power_api.ENERGY_MODULE]
+        return [float(address)] * ports
+
+    def test_realtime_power(self):
+        """ Test reading the realtime power, and serving it from the snapshots """
+        output = self.cache.get_realtime_power()
+        self.assertEqual(['1', '2'], sorted(output.keys()))
+        self.assertEqual([[11.0, 11.0, 11.0, 11.0]] * 8, output['1'])
+        self.assertEqual([[12.0, 12.0, 12.0, 12.0]] * 12, output['2'])
+        self.assertEqual(8, len(self.commands))
+
+        self.assertEqual(output, self.cache.get_realtime_power())
+        self.assertEqual(8, len(self.commands))  # Served from the snapshots
+        self.assertEqual(1, self.config_controller.get_setting.call_count)  # The setting is cached as well
+        self.cache.get_realtime_power(force_fresh=True)
+        self.assertEqual(16, len(self.commands))
+        self.cache.get_realtime_power(max_age=0)
+        self.assertEqual(24, len(self.commands))
+        self.assertEqual(['1', '2'], sorted(self.cache.get_snapshot_times()['realtime_power'].keys()))
+        self.assertEqual(['2'], self.cache.get_realtime_power(module_ids=[2]).keys())
+
+        self.cache.invalidate(1)
+        del self.commands[:]
+        self.cache.get_realtime_power()
+        self.assertEqual([11], list(set(address for address, _ in self.commands)))
+
+        # The energy counters are kept separately
+        del self.commands[:]
+        self.assertEqual([[11.0, 11.0]] * 8, self.cache.get_total_energy()['1'])
+        self.assertEqual(4, len(self.commands))
+
+    def test_concurrent_consumers(self):
+        """ Test that concurrent consumers share a single read of a module """
+        self.delay = 0.05
+        results = []
+        threads = [Thread(target=lambda: results.append(self.cache.get_realtime_power())) for _ in xrange(5)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(5, len(results))
+        self.assertEqual(8, len(self.commands))
+
+        # A forced read waits for a read in progress, which started after it was requested
+        del self.commands[:]
+        threads = [Thread(target=lambda: self.cache.get_realtime_power(force_fresh=True)) for _ in xrange(2)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertIn(len(self.commands), [8, 12, 16])
+
+    def test_errors(self):
+        """ Test that modules that can't be read are left out """
+        self.power_controller.get_modules.return_value[3] = PowerModule(3, '', 13, power_api.POWER_MODULE, [])
+        output = self.cache.get_realtime_power()
+        self.assertEqual(['1', '2'], sorted(output.keys()))
+        self.assertEqual(['1', '2'], sorted(self.cache.get_total_energy().keys()))
+
+        SetUpTestInjections(power_communicator=None)
+        self.assertEqual({}, PowerSnapshotCache().get_realtime_power())
+
+
+if __name__ == '__main__':
+    unittest.main(testRunner=xmlrunner.XMLTestRunner(output='../gw-unit-reports'))
@@ -0,0 +1,75 @@
+# Copyright (C) 2020 OpenMotics BV
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+Tests for the power bus statistics.
+"""
+
+import unittest
+import xmlrunner
+from power.power_statistics import PowerBusStatistics
+
+
+class PowerBusStatisticsTest(unittest.TestCase):
+    """ Tests for the PowerBusStatistics. """
+
+    def test_summaries(self):
+        """ Test the counters and latencies per module and per command """
+        statistics = PowerBusStatistics()
+        for duration in [0.004, 0.008, 0.02, 0.3]:
+            statistics.register_command(1, 'GVOL', duration)
+        statistics.register_command(2, 'GCUR', 0.004)
+        statistics.register_failure(2, 'timeouts')
+        statistics.register_failure(2, 'retries')
+        statistics.register_failure(2, 'crc_errors')
+
+        summaries = statistics.get_summaries()
+        self.assertEqual([1, 2], sorted(summaries['modules'].keys()))
+        self.assertEqual(['GCUR', 'GVOL'], sorted(summaries['commands'].keys()))
+        module = summaries['modules'][1]
+        self.assertEqual({'commands': 4, 'retries': 0, 'timeouts': 0, 'crc_errors': 0},
+                         dict((key, module[key]) for key in PowerBusStatistics.COUNTERS))
+        self.assertEqual(10, module['latency_p50'])
+        self.assertEqual(300, module['latency_max'])
+        self.assertEqual({'commands': 1, 'retries': 1, 'timeouts': 1, 'crc_errors': 1},
+                         dict((key, summaries['modules'][2][key]) for key in PowerBusStatistics.COUNTERS))
+        self.assertEqual(4, summaries['commands']['GVOL']['commands'])
+        self.assertNotIn('retries', summaries['commands']['GVOL'])
+
+    def test_utilization(self):
+        """ Test the bus utilization over the windows """
+        statistics = PowerBusStatistics()
+        self.assertEqual({10: 0.0, 60: 0.0, 300: 0.0}, statistics.get_utilization(now=1000.0))
+        statistics.register_busy(1000.5, 1001.5)  # Spread over 2 seconds
+        statistics.register_busy(1005.0, 1006.0)
+        utilization = statistics.get_utilization(now=1009.9)
+        self.assertEqual(20.0, utilization[10])
+        self.assertAlmostEqual(200 / 60.0, utilization[60])
+        self.assertAlmostEqual(200 / 300.0, utilization[300])
+
+        # Old busy time leaves the windows
+        utilization = statistics.get_utilization(now=1020.0)
+        self.assertEqual(0.0, utilization[10])
+        self.assertAlmostEqual(200 / 60.0, utilization[60])
+        self.assertEqual({10: 0.0, 60: 0.0, 300: 0.0}, statistics.get_utilization(now=2000.0))
+
+        # Busy time that is older than the longest window is ignored
+        statistics.register_busy(1000.0, 2000.0)
+        utilization = statistics.get_utilization(now=1999.5)
+        self.assertEqual([100.0, 100.0], [utilization[10], utilization[60]])
+        self.assertAlmostEqual(299 / 3.0, utilization[300])  # The slot of second 1700 is reused by second 2000
+
+
+if __name__ == '__main__':
+    unittest.main(testRunner=xmlrunner.XMLTestRunner(output='../gw-unit-reports'))
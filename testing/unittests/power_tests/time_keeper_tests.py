@@ -20,6 +20,9 @@ import unittest
 import xmlrunner
 from datetime import datetime
 
+import power.power_api as power_api
+from mock import Mock
+from power.power_controller import PowerModule, PowerPort
 from power.time_keeper import TimeKeeper
 
 
@@ -77,6 +80,40 @@ class TimeKeeperTest(unittest.TestCase):
         self.assertFalse(tkeep.is_day_time(None, datetime(2013, 3, 10, 12, 20, 0)))  # Sunday 12:00
         self.assertFalse(tkeep.is_day_time(None, datetime(2013, 3, 10, 18, 0, 0)))  # Sunday 18:00
 
+    def test_transitions(self):
+        """ Test that the modes are only set when they change, and the time to the next transition. """
+        times = ','.join(['08:00', '18:00'] * 5 + ['00:00', '00:00'] * 2)  # Day time during the week
+        controller = Mock()
+        ports = [PowerPort('', 0, times if i == 0 else None, 0) for i in range(8)]
+        controller.get_modules.return_value = {1: PowerModule(1, '', 11, power_api.POWER_MODULE, ports),
+                                               2: PowerModule(2, '', 12, power_api.P1_CONCENTRATOR, [])}
+        controller.get_day_night_modes.return_value = {1: [power_api.NIGHT] * 8}
+        communicator = Mock()
+        tkeep = TimeKeeper(communicator, controller, 10)
+
+        # Monday 07:59:30, the modes are already set on the module
+        self.assertEqual(30, tkeep._TimeKeeper__run_once(datetime(2013, 3, 4, 7, 59, 30)))
+        self.assertEqual(0, communicator.do_command.call_count)
+
+        # Monday 08:00, port 0 switches to day time until 18:00
+        self.assertEqual(TimeKeeper.MAX_SLEEP, tkeep._TimeKeeper__run_once(datetime(2013, 3, 4, 8, 0, 0)))
+        modes = [power_api.DAY] + [power_api.NIGHT] * 7
+        self.assertEqual((11, ) + tuple(modes), communicator.do_command.call_args[0][:1] + communicator.do_command.call_args[0][2:])
+        controller.set_day_night_modes.assert_called_once_with(1, modes)
+        self.assertEqual(60, tkeep._TimeKeeper__run_once(datetime(2013, 3, 4, 17, 59, 0)))
+        self.assertEqual(1, communicator.do_command.call_count)
+
+        # Friday 18:00, the next transition is on Monday 08:00
+        self.assertEqual(TimeKeeper.MAX_SLEEP, tkeep._TimeKeeper__run_once(datetime(2013, 3, 8, 18, 0, 0)))
+        self.assertEqual(2, communicator.do_command.call_count)
+        self.assertEqual(1, controller.get_modules.call_count)
+
+        # Changed modules are reloaded on the next run
+        tkeep.invalidate()
+        controller.get_modules.return_value = {}
+        self.assertEqual(TimeKeeper.MAX_SLEEP, tkeep._TimeKeeper__run_once(datetime(2013, 3, 8, 18, 0, 0)))
+        self.assertEqual(2, controller.get_modules.call_count)
+
 
 if __name__ == "__main__":
     unittest.main(testRunner=xmlrunner.XMLTestRunner(output='../gw-unit-reports'))
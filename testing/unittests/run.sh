@@ -28,6 +28,9 @@ python2 master_tests/eeprom_extension_tests.py
 echo "Running users tests"
 python2 gateway_tests/users_tests.py
 
+echo "Running webservice tests"
+python2 gateway_tests/webservice_tests.py
+
 echo "Running scheduling tests"
 python2 gateway_tests/scheduling_tests.py
 
@@ -40,12 +43,33 @@ python2 power_tests/power_communicator_tests.py
 echo "Running time keeper tests"
 python2 power_tests/time_keeper_tests.py
 
+echo "Running power snapshot tests"
+python2 power_tests/power_snapshots_tests.py
+
+echo "Running power polling tests"
+python2 power_tests/power_polling_tests.py
+
+echo "Running power api tests"
+python2 power_tests/power_api_tests.py
+
+echo "Running power analytics tests"
+python2 power_tests/power_analytics_tests.py
+
+echo "Running power statistics tests"
+python2 power_tests/power_statistics_tests.py
+
 echo "Running plugin base tests"
 python2 plugins_tests/base_tests.py
 
 echo "Running plugin interfaces tests"
 python2 plugins_tests/interfaces_tests.py
 
+echo "Running plugin IPC tests"
+python2 plugins_tests/ipc_tests.py
+
+echo "Running plugin log tests"
+python2 plugins_tests/logs_tests.py
+
 echo "Running pulse counter controller tests"
 python2 gateway_tests/pulses_tests.py
 
@@ -23,7 +23,7 @@ import threading
 import unittest
 import xmlrunner
 
-from serial_utils import printable
+from serial_utils import printable, RS485
 
 
 def sin(data):
@@ -49,6 +49,7 @@ class SerialMock(object):
         gives the sout bytes to read(). """
         self.__sequence = sequence
         self.__timeout = timeout
+        self.__cancelled = False
 
         self.bytes_written = 0
         self.bytes_read = 0
@@ -67,6 +68,9 @@ class SerialMock(object):
     def read(self, size):
         """ Read size bytes from serial port """
         while len(self.__sequence) == 0 or self.__sequence[0][0] == 'i':
+            if self.__cancelled:
+                self.__cancelled = False
+                return ''
             time.sleep(0.01)
 
         if self.__timeout != 0 and self.__sequence[0][1] == '':
@@ -96,6 +100,14 @@ class SerialMock(object):
             raise Exception("Can only interrupt read at end of stream")
         self.__sequence.append(sout("\x00"))
 
+    def cancel_read(self):
+        """ Makes a waiting read return without data. """
+        self.__cancelled = True
+
+    def close(self):
+        """ Close the serial port """
+        pass
+
     def fileno(self):
         return None
 
@@ -157,5 +169,27 @@ class SerialMockTest(unittest.TestCase):
         self.assertEquals(1, phase['phase'])
 
 
+class RS485Test(unittest.TestCase):
+    """ Tests for the RS485 wrapper """
+
+    def setUp(self):
+        self.rs485 = None
+
+    def tearDown(self):
+        if self.rs485 is not None:
+            self.rs485.close()
+
+    def test_read_chunk(self):
+        """ Tests reading the received bytes in chunks. """
+        self.rs485 = rs485 = RS485(SerialMock([sin("abc"), sout("def"), sin("g"), sout("hij")]))
+        self.assertEquals('', rs485.read_chunk(0.05))
+        rs485.write("abc")
+        self.assertEquals("def", rs485.read_chunk(1))
+        rs485.write("g")
+        self.assertEquals("h", rs485.read(1, 1))
+        self.assertEquals("ij", rs485.read(3, 0.05))
+        self.assertEquals('', rs485.read_chunk(0.05))
+
+
 if __name__ == "__main__":
     unittest.main(testRunner=xmlrunner.XMLTestRunner(output='gw-unit-reports'))
@@ -0,0 +1,72 @@
+#!/bin/python2
+# Copyright (C) 2020 OpenMotics BV
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+Measures the throughput of the plugin IPC stream over a local pipe pair.
+
+Usage: python2 plugin_ipc_benchmark.py [amount of messages]
+"""
+import os
+import sys
+import time
+from threading import Thread
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src'))
+
+from toolbox import PluginIPCStream
+
+
+PAYLOADS = [('event', {'cid': 0, 'action': 'receive_events', 'code': 1}),
+            ('output status', {'cid': 0, 'action': 'output_status', 'status': [[i, 100] for i in xrange(40)]}),
+            ('metrics', {'cid': 0, 'action': 'distribute_metrics', 'name': 'receive',
+                         'metrics': [{'source': 'OpenMotics', 'type': 'energy', 'timestamp': 1580000000.0,
+                                      'tags': {'id': '{0}.{1}'.format(i / 8, i % 8), 'name': 'ct'},
+                                      'values': {'power': 123.4, 'voltage': 231.2, 'current': 0.53}}
+                                     for i in xrange(250)]})]
+
+
+def benchmark(name, payload, amount):
+    read_fd, write_fd = os.pipe()
+    reader = os.fdopen(read_fd, 'r', 0)
+    writer = os.fdopen(write_fd, 'w', 0)
+    received = [0]
+    stream = PluginIPCStream(stream=reader,
+                             logger=lambda message, ex: sys.stderr.write('{0}: {1}\n'.format(message, ex)),
+                             command_receiver=lambda command: received.__setitem__(0, received[0] + 1))
+    stream.start()
+
+    def _write():
+        for _ in xrange(amount):
+            writer.write(PluginIPCStream.write(payload))
+
+    start = time.time()
+    thread = Thread(target=_write)
+    thread.start()
+    thread.join()
+    while received[0] < amount:
+        time.sleep(0.001)
+    duration = time.time() - start
+    writer.close()
+    stream.stop()
+    reader.close()
+    print('{0:<15} {1:>8} bytes/message {2:>10.0f} messages/s {3:>8.2f} MB/s'.format(
+        name, stream.bytes_read / amount, amount / duration, stream.bytes_read / duration / 1024 / 1024
+    ))
+
+
+if __name__ == '__main__':
+    messages = int(sys.argv[1]) if len(sys.argv) > 1 else 10000
+    for payload_name, payload_data in PAYLOADS:
+        benchmark(payload_name, payload_data, messages)
@@ -0,0 +1,109 @@
+#!/bin/python2
+# Copyright (C) 2020 OpenMotics BV
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+Measures the throughput of the RS485 reader and the power module response parser, by replaying
+the responses of a realtime power and energy poll of the power modules.
+
+Usage: python2 power_rs485_benchmark.py [amount of polls]
+"""
+import os
+import struct
+import sys
+import time
+from Queue import Queue
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src'))
+
+from power import power_api
+from power.power_command import parse_response
+from serial_utils import RS485
+
+
+def _response(command, cid):
+    """ A response to the command, with a value for every field """
+    size = struct.calcsize(command.output_format)
+    fields = len(struct.unpack(command.output_format, '\x00' * size))
+    return command.create_output(1, cid, *range(fields))
+
+
+def _poll(version):
+    """ The responses of a module to a realtime power and energy poll """
+    commands = [power_api.get_voltage(version), power_api.get_frequency(version),
+                power_api.get_current(version), power_api.get_power(version),
+                power_api.get_day_energy(version), power_api.get_night_energy(version)]
+    return ''.join(_response(command, cid) for cid, command in enumerate(commands))
+
+
+POLLS = [('power module', _poll(power_api.POWER_MODULE), 6),
+         ('energy module', _poll(power_api.ENERGY_MODULE), 6)]
+CHUNK_SIZES = [1, 16, 64]  # The amount of bytes the uart hands over at once
+
+
+class ReplaySerial(object):
+    """ Replays the recorded bytes, in chunks of the given size """
+
+    def __init__(self, data, chunk_size):
+        self.timeout = None
+        self._chunks = Queue()
+        for i in xrange(0, len(data), chunk_size):
+            self._chunks.put(data[i:i + chunk_size])
+        self._pending = ''
+
+    def read(self, size):
+        if self._pending == '':
+            self._pending = self._chunks.get()
+        data, self._pending = self._pending[:size], self._pending[size:]
+        return data
+
+    def inWaiting(self):
+        return len(self._pending)
+
+    def cancel_read(self):
+        self._chunks.put('')
+
+    def close(self):
+        pass
+
+    def fileno(self):
+        return None
+
+
+def benchmark(name, poll, responses_per_poll, chunk_size, amount):
+    data = poll * amount
+    start = time.time()
+    rs485 = RS485(ReplaySerial(data, chunk_size))
+    buffer = bytearray()
+    received = 0
+    while received < responses_per_poll * amount:
+        if parse_response(buffer) is not None:
+            received += 1
+            continue
+        chunk = rs485.read_chunk(1)
+        if chunk == '':
+            raise RuntimeError('Replay stalled after {0} responses'.format(received))
+        buffer += chunk
+    duration = time.time() - start
+    rs485.close()
+    print('{0:<15} {1:>3} bytes/chunk {2:>10.0f} responses/s {3:>8.2f} MB/s'.format(
+        name, chunk_size, received / duration, len(data) / duration / 1024 / 1024
+    ))
+
+
+if __name__ == '__main__':
+    polls = int(sys.argv[1]) if len(sys.argv) > 1 else 1000
+    for poll_name, poll_data, poll_responses in POLLS:
+        for size in CHUNK_SIZES:
+            benchmark(poll_name, poll_data, poll_responses, size, polls)